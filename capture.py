@@ -0,0 +1,118 @@
+################################################################################################
+# Record and replay of raw sensor data. A capture file starts with MAGIC followed by records of
+# a little endian header (arrival time as float seconds since the epoch, length) and the bytes
+# as received from the interface, i.e. one chunk of a serial port or one BLE notification.
+#
+# A ReplayTransport feeds a capture to the readers in place of a SerialTransport, such the real
+# parsers, filters and writers can be run without sensors, either in real time or as fast as
+# possible.
+################################################################################################
+import asyncio, logging, struct, time
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'DLCAP\x01'
+RECORD = struct.Struct('<dI')
+
+class CaptureWriter:
+
+	def __init__(self, fname):
+		self.fname = fname
+		self._f = open(fname,'ab')
+		if self._f.tell() == 0:
+			self._f.write(MAGIC)
+		logger.info(f'Capturing raw data to {fname}')
+
+	def write(self, data, timestamp=None):
+		self._f.write(RECORD.pack(timestamp or time.time(), len(data)))
+		self._f.write(data)
+
+	def close(self):
+		self._f.close()
+
+def read_capture(fname):
+	"Generator of (timestamp, data) records of a capture file"
+	with open(fname,'rb') as f:
+		if f.read(len(MAGIC)) != MAGIC:
+			raise ValueError(f'{fname} is not a capture file')
+		while True:
+			header = f.read(RECORD.size)
+			if len(header) < RECORD.size:
+				return
+			timestamp, n = RECORD.unpack(header)
+			data = f.read(n)
+			if len(data) < n:
+				logger.warning(f'Capture {fname} is truncated')
+				return
+			yield timestamp, data
+
+class ReplayTransport:
+	"""
+	Same interface as transport.SerialTransport. Records are delivered with their original
+	time gaps divided by speed, or as fast as possible if speed is 0. EOFError is raised at the
+	end of the capture. timestamp is the recorded arrival time of the last record.
+	"""
+
+	def __init__(self, fname, speed=1.0, idle=0.1):
+		self.fname = fname
+		self.speed = speed
+		self.idle = idle
+		self.timestamp = None
+		self.records = 0
+		self.bytes = 0
+		self._records = read_capture(fname)
+		self._buffer = bytearray()
+		self._started = None
+
+	async def _next(self):
+		try:
+			timestamp, data = next(self._records)
+		except StopIteration:
+			elapsed = time.monotonic() - (self._started or time.monotonic())
+			logger.info(f'Replayed {self.records} records ({self.bytes} bytes) of {self.fname} in {elapsed:.3f} s')
+			raise EOFError(f'End of capture {self.fname}')
+		if self._started is None:
+			self._started = time.monotonic()
+			self._offset = timestamp
+		elif self.speed:
+			delay = (timestamp - self._offset)/self.speed - (time.monotonic() - self._started)
+			if delay > 0:
+				await asyncio.sleep(delay)
+		else:
+			await asyncio.sleep(0)	# let the writers work
+		self.timestamp = timestamp
+		self.records += 1
+		self.bytes += len(data)
+		return data
+
+	async def read(self):
+		"Return buffered bytes or the next record"
+		if self._buffer:
+			data = bytes(self._buffer)
+			self._buffer.clear()
+			return data
+		return await self._next()
+
+	async def readline(self, sep=b'\n', limit=None):
+		"""
+		Recorded chunks are split at sep or after limit bytes. As the idle gaps of the original
+		stream are gone, a line without separator ends with the record it belongs to.
+		"""
+		if not self._buffer:
+			self._buffer += await self._next()
+		i = self._buffer.find(sep)
+		n = i + len(sep) if i >= 0 else len(self._buffer)
+		if limit is not None:
+			n = min(n, limit)
+		line = bytes(self._buffer[:n])
+		del self._buffer[:n]
+		return line
+
+	def write(self, data):
+		return len(data)
+
+	def flush_input(self):
+		pass
+
+	def close(self):
+		self._records.close()
@@ -0,0 +1,111 @@
+################################################################################################
+# Compact wire format for mqtt. Instead of repeating names and units in every message, the
+# schema of a record is published once as a retained message on a sibling topic and the data
+# messages only carry the packed value vector:
+#
+#	<topic>/schema	{"id": ..., "name": ..., "fields": [...], "units": [...], "scales": [...]}
+#	<topic>		[id, v0, v1, ...]
+#
+# Values with a scale are sent as round(value*scale), which packs e.g. 21.53 °C with scale 100
+# into a 2 byte integer. The id is a checksum of the schema, such subscribers notice a changed
+# schema. The encoding is MessagePack (msgpack) or CBOR (cbor2), the packages are only needed
+# if the format is used.
+################################################################################################
+import logging, json, zlib
+from record import Record, getSchema
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ('json','msgpack','cbor')
+SCHEMA_SUFFIX = '/schema'
+
+def getCodec(format):
+	"(dumps, loads) of format"
+	if format == 'msgpack':
+		import msgpack
+		return msgpack.packb, msgpack.unpackb
+	elif format == 'cbor':
+		import cbor2
+		return cbor2.dumps, cbor2.loads
+	elif format == 'json':
+		return (lambda obj: json.dumps(obj).encode()), json.loads
+	raise ValueError(f'Unknown format "{format}". Choose one of {FORMATS}')
+
+def schema_topic(topic):
+	return topic + SCHEMA_SUFFIX
+
+class RecordPacker:
+	"""
+	Packs records of one or more schemas. scales maps field names to the factor, by which
+	their values are multiplied before rounding to int.
+	"""
+
+	def __init__(self, format='msgpack', scales={}):
+		self.format = format
+		self.dumps, self.loads = getCodec(format)
+		self.scales = dict(scales)
+		self._schemas = {}	# Schema -> (id, packed schema message, scales)
+
+	def describe(self, schema):
+		"Returns (id, packed schema message, scale of each field) of schema"
+		if schema not in self._schemas:
+			scales = [self.scales.get(f) for f in schema.fields]
+			desc = dict(name=schema.name, fields=list(schema.fields), units=list(schema.units), scales=scales)
+			desc['id'] = zlib.crc32(json.dumps(desc, sort_keys=True).encode())
+			self._schemas[schema] = desc['id'], self.dumps(desc), scales
+		return self._schemas[schema]
+
+	def pack(self, record):
+		id, desc, scales = self.describe(record.schema)
+		values = [v if s is None or v is None else round(v*s) for v,s in zip(record.values, scales)]
+		return self.dumps([id] + values)
+
+class RecordUnpacker:
+	"Inverse of RecordPacker. Keeps the last schema seen on each topic."
+
+	def __init__(self, format='msgpack'):
+		self.format = format
+		self.dumps, self.loads = getCodec(format)
+		self._schemas = {}	# data topic -> (id, Schema, scales)
+
+	def set_schema(self, topic, payload):
+		desc = self.loads(payload)
+		schema = getSchema(desc['name'], tuple(zip(desc['fields'], desc['units'])))
+		self._schemas[topic] = desc['id'], schema, desc['scales']
+		logger.debug(f'Received schema {schema} for {topic}')
+
+	def unpack(self, topic, payload):
+		"Returns the record or None, if the schema of topic is unknown yet"
+		id, *values = self.loads(payload)
+		if topic not in self._schemas or self._schemas[topic][0] != id:
+			logger.warning(f'Discarded message on {topic}: unknown schema {id}')
+			return None
+		id, schema, scales = self._schemas[topic]
+		values = [v if s is None or v is None else v/s for v,s in zip(values, scales)]
+		return Record(schema, values)
+
+def subscribe_records(mqtt, topic, callback, format='msgpack', qos=0):
+	"""
+	Subscribe a mqtt.Mqtt client to packed records on topic, which may contain wildcards.
+	callback(record, topic) is called for each decoded message. The schema topic is subscribed
+	first, such its retained schema arrives before the records and no record is lost.
+	"""
+	unpacker = RecordUnpacker(format)
+
+	def handle_message(client, userdata, message):
+		try:
+			if message.topic.endswith(SCHEMA_SUFFIX):
+				unpacker.set_schema(message.topic[:-len(SCHEMA_SUFFIX)], message.payload)
+				return
+			record = unpacker.unpack(message.topic, message.payload)
+		except Exception as e:
+			logger.error(f'Could not decode message on {message.topic}: {e}')
+			return
+		if record is not None:
+			callback(record, message.topic)
+
+	topics = (topic,) if topic.endswith('#') else (schema_topic(topic), topic)
+	for t in topics:
+		mqtt.on_topic(t)(handle_message)
+		mqtt.subscribe(t, qos)
+	return unpacker
@@ -1,19 +1,32 @@
 ################################################################################################
-# A DataLogger instance holds a configured Reader instance and one or more configured Writer
-# instances. All these instances might be configured from a configuration file, by 
-# parameterization during instantiation of a DataLogger instance or later on using initialize_atts 
-# or load_config. A config loader might be chosen for different formats.
+# A DataLogger instance holds one or more configured Reader instances and one or more configured
+# Writer instances, all sharing one event loop. All these instances might be configured from a 
+# configuration file, by parameterization during instantiation of a DataLogger instance or later 
+# on using initialize_atts or load_config. A config loader might be chosen for different formats.
 #
 # Repeated use of the given configuration methods will overwrite already set attributes except
-# for writers. Any new writer configuration will result in a new Writer instance appended to 
-# _writers!
+# for readers and writers. Any new reader or writer configuration will result in a new instance
+# added to _readers or _writers under its section name!
+#
+# The filters of all writers fed by a reader run in one pipeline.FilterGraph, in which the common
+# prefixes of their filter chains are computed once. The graph runs behind a dispatch.FilterQueue
+# in an executor thread, such the read loop only enqueues the records. Writers configured with a resolution in 
+# seconds receive wall-clock aligned rollups instead of the raw records. All resolutions of a 
+# source are computed by one stats.Rollup, which the optional rollup_cfg section configures 
+# (lateness, stats).
+#
+# Each reader runs supervised: if it fails with an error it does not handle itself, the error is
+# logged and the reader restarted after a growing delay, while the other readers keep running.
+# A reader failing max_restarts times in a row, or a replay, is dropped.
 ################################################################################################
-import logging
+import logging, asyncio, sys, time
 from os import path
 from loader import getConfigLoader
 from readers import * 
 from writers import * 
 from utils import Reducer
+from dispatch import WriterQueue, FilterQueue
+from pipeline import FilterGraph
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(format='%(asctime)s:[%(levelname)s][%(module)s][%(funcName)s][%(lineno)d] %(message)s',level=logging.INFO)
@@ -23,11 +36,22 @@ class DataLoggerBroker(object):
 
 	def __init__(self,config_fname=None,**kwargs):
 		"""
-		config or kwargs include one reader class and all parameters to instantiate a reader 
-		plus one or more writer classes and there respective parameters including a list of filters.
+		config or kwargs include one or more reader classes and all parameters to instantiate 
+		the readers plus one or more writer classes and there respective parameters including a 
+		list of filters. A reader section may route its data to a subset of writers by listing 
+		their section names under "writers", otherwise all writers receive its data.
 		"""
 		self._reader = None
-		self._writers = []
+		self._readers = {}
+		self._routes = {}
+		self._writers = {}
+		self._queues = {}
+		self._filters = {}
+		self._resolutions = {}
+		self._graphs = {}
+		self._rollup_cfg = {}
+		self._max_restarts = 5
+		self._supervision = {}
 		if config_fname:
 			self.load_config(config_fname)
 		self.initialize_atts(**kwargs)
@@ -35,19 +59,17 @@ class DataLoggerBroker(object):
 		
 	def initialize_atts(self, **kwargs):	
 		for k,v in kwargs.items():
-			if k == 'reader_cfg':
-				reader_cfg = kwargs.get('reader_cfg')
+			if k.casefold().find('reader')>-1:
+				reader_cfg = kwargs.get(k)
 				reader_cls = reader_cfg.pop('reader_cls')
 				logger.debug(reader_cls)
-				self.setReader(reader_cls,**reader_cfg)
-				@self._reader.onread
-				def handle_input(event):
-					for writer in self._writers:
-						writer.write(event.message)
+				self.addReader(k,reader_cls,**reader_cfg)
 			elif k.casefold().find('writer')>-1:
 				writer_cfg = kwargs.get(k)
 				writer_cls = writer_cfg.pop('writer_cls')
-				self.addWriter(writer_cls,**writer_cfg)
+				self.addWriter(writer_cls,name=k,**writer_cfg)
+			elif k == 'bluetooth_cfg':
+				ble_manager.configure(**v)
 			else:
 				setattr(self,'_'+k,v)
 			
@@ -66,16 +88,132 @@ class DataLoggerBroker(object):
 		basename,ext = path.splitext(config_fname)
 		self._config_loader = getConfigLoader(ext.casefold())
 			
-	def addWriter(self, writer_cls, **kwargs):
+	def addWriter(self, writer_cls, name=None, queue={}, resolution=None, **kwargs):
+		"""
+		Each writer runs behind its own bounded queue. queue may hold maxsize, the overflow 
+		policy, a spill_path and batch_size/batch_time (see dispatch.WriterQueue). A writer with a resolution in 
+		seconds gets the rollups of that resolution instead of the raw records.
+		"""
 		logger.debug(f"Appending {writer_cls} with {kwargs}")
-		self._writers.append(writer_cls(**kwargs))
+		name = name or f'writer_{len(self._writers)}'
+		self._writers[name] = writer_cls(**kwargs)
+		self._queues[name] = WriterQueue(self._writers[name], name, write=self._writers[name].write_filtered, write_batch=self._writers[name].write_filtered_batch, **queue)
+		self._resolutions[name] = resolution
+		self._graphs.clear()
 	
+	def addReader(self, name, reader_cls, writers=None, filter_queue={}, **kwargs):
+		"""
+		Instantiate a reader and route its data to the writers named in writers or,
+		if None, to all writers. The routes are resolved on each read, such writers
+		may be configured after the reader. filter_queue may hold maxsize and batch_size
+		of the queue in front of the filters (see dispatch.FilterQueue).
+		"""
+		logger.debug(f'Adding reader {name}')
+		reader = reader_cls(**kwargs)
+		self._readers[name] = reader
+		self._routes[name] = writers
+		self._graphs.pop(name, None)
+		self._filters[name] = FilterQueue(lambda records, source: self.get_graph(name).process_many(records, source),
+				lambda writer, record, source: self._queues[writer].offer(record, source), name, **filter_queue)
+		self._reader = reader
+		@reader.onread
+		def handle_input(event):
+			# readers serving several devices tell them apart by event.device
+			device = getattr(event,'device',None)
+			source = f'{name}/{device}' if device else name
+			return self._filters[name].offer(event.message, source)
+		return reader
+
+	def get_graph(self, reader_name):
+		"Lazily build the FilterGraph of the writers reader_name is routed to"
+		if reader_name not in self._graphs:
+			graph = FilterGraph(self._rollup_cfg)
+			for name in self._get_route(reader_name):
+				graph.add(name, self._writers[name].chain_cfgs(), self._resolutions[name])
+			logger.info(f'Filters of {reader_name}:\n{graph.describe()}')
+			self._graphs[reader_name] = graph
+		return self._graphs[reader_name]
+
 	def setReader(self, reader_cls,**kwargs):
 		logger.debug('Setting reader')
-		self._reader = reader_cls(**kwargs)
+		self.addReader('reader_cfg',reader_cls,**kwargs)
+	
+	def get_writers(self, reader_name):
+		"Writers to which reader_name is routed"
+		return [self._writers[name] for name in self._get_route(reader_name)]
+	
+	def get_queues(self, reader_name):
+		return [self._queues[name] for name in self._get_route(reader_name)]
+	
+	def _get_route(self, reader_name):
+		route = self._routes.get(reader_name)
+		return self._writers.keys() if route is None else route
+	
+	def get_stats(self):
+		"Connection metrics of each reader, filter time per record, queue depth and drop counters of each writer"
+		return dict(
+			readers = {name:dict(getattr(reader,'metrics',{}), **self._supervision.get(name,{})) for name,reader in self._readers.items()},
+			filters = {name:queue.stats() for name,queue in self._filters.items()},
+			writers = {name:queue.stats() for name,queue in self._queues.items()},
+			rollups = {source:metrics for graph in self._graphs.values() for source,metrics in graph.rollup_stats().items()}
+		)
+
+	async def read_forever(self):
+		"""
+		Run all readers concurrently on one event loop. If all readers come to an end, e.g. 
+		when replaying captures, the writers are given the time to write all queued data.
+		"""
+		for queue in list(self._queues.values()) + list(self._filters.values()):
+			queue.start()
+		started = time.monotonic()
+		try:
+			await asyncio.gather(*[self._supervise(name, reader) for name,reader in self._readers.items()])
+			for queue in self._filters.values():
+				await queue.drain()
+			for graph in self._graphs.values():
+				for writer, record, source in graph.flush():
+					await asyncio.gather(*[w for w in [self._queues[writer].offer(record, source)] if w])
+			for queue in self._queues.values():
+				await queue.drain()
+			elapsed = time.monotonic() - started
+			for name,queue in self._queues.items():
+				written = queue.counters['written']
+				logger.info(f'{name} wrote {written} messages in {elapsed:.3f} s ({written/elapsed:.1f}/s)')
+		finally:
+			for queue in self._filters.values():
+				await queue.stop()
+			for queue in self._queues.values():
+				await queue.stop()
+			logger.info(f'Statistics: {self.get_stats()}')
 		
+	async def _supervise(self, name, reader, backoff=1.0, max_backoff=300.0):
+		"Run reader, restarting it after unexpected errors. Failures count as consecutive, unless the reader ran for a minute."
+		state = self._supervision[name] = dict(running=True, failures=0, last_failure=None)
+		failures = 0
+		while True:
+			started = time.monotonic()
+			try:
+				await reader.read_forever()
+				break
+			except Exception as e:
+				failures = failures + 1 if time.monotonic() - started < 60 else 1
+				state['failures'] += 1
+				state['last_failure'] = f'{type(e).__name__}: {e}'
+				logger.exception(f'Reader {name} failed: {e}')
+				if getattr(reader, 'replay', None) or failures > self._max_restarts:
+					logger.error(f'Dropped reader {name}, the other readers keep running')
+					break
+				delay = min(max_backoff, backoff*2**(failures-1))
+				logger.info(f'Restarting reader {name} in {delay:.0f} s')
+				await asyncio.sleep(delay)
+		state['running'] = False
+
 	def run(self):
-		self._reader.run( self._reader.read_forever )
+		try:
+			asyncio.run(self.read_forever())
+		except asyncio.TimeoutError as e:
+			logger.error("TimeoutError: Couldn't establish a connection in the given time frame")
+			sys.exit(2)
 
 if __name__=='__main__':
 	'''
@@ -0,0 +1,350 @@
+################################################################################################
+# Decouples writers from the read loop. Each writer gets a bounded queue and a worker task that
+# calls the (blocking) writer in an executor thread. What happens, if a writer can't keep up, is
+# configured by an overflow policy:
+#
+#	block		the reader awaits free space (backpressure)
+#	drop_oldest	the oldest queued message is discarded
+#	drop_newest	the new message is discarded
+#	spill		messages are appended to a file and fed back once the queue has drained
+#
+# The spill file is read from the offset of the first message not fed back, which is kept in
+# <spill_path>.offset, and removed, once all its messages are fed back.
+#
+# With a batch_size > 1 the worker collects up to batch_size messages, waiting at most batch_time
+# seconds after the first one, and hands consecutive messages of a source to the writer's 
+# write_batch at once.
+#
+# Writers buffering data (see writers.Writer.flush) are flushed, when the queue stays empty for
+# their flush_interval, and closed, when the queue is stopped, after the write or flush in progress.
+#
+# The filters of a reader run behind a FilterQueue in an executor thread as well, such filters
+# and rollups don't hold up the read loop. The filter time per message is part of its stats.
+################################################################################################
+import asyncio, logging, json, os, time
+from itertools import groupby
+from operator import itemgetter
+from record import as_record
+
+logger = logging.getLogger(__name__)
+
+POLICIES = ('block','drop_oldest','drop_newest','spill')
+
+def copy_message(message):
+	"Writers run concurrently, such every writer gets its own copy of the record's values"
+	return as_record(message).copy()
+
+class WriterQueue:
+
+	def __init__(self, writer, name, maxsize=1000, policy='block', spill_path=None, batch_size=1, batch_time=1.0, write=None, write_batch=None):
+		"write and write_batch replace writer.write and writer.write_batch, e.g. by writer.write_filtered"
+		if policy not in POLICIES:
+			raise ValueError(f'Unknown overflow policy "{policy}". Choose one of {POLICIES}')
+		if policy == 'spill' and not spill_path:
+			spill_path = f'{name}.spill'
+		self.writer = writer
+		self._write = write or writer.write
+		self._write_batch = write_batch or writer.write_batch
+		self.batch_size = max(1, batch_size)
+		self.batch_time = batch_time
+		self.name = name
+		self.maxsize = maxsize
+		self.policy = policy
+		self.spill_path = spill_path
+		self.counters = dict(enqueued=0, written=0, dropped=0, spilled=0, errors=0)
+		self._spilled = 0
+		self._spill_file = None
+		self._spill_offset = 0
+		self._queue = None
+		self._worker = None
+		self._running = None	# write or flush in the executor
+		self._collected = []
+
+	def start(self):
+		"Must be called from within the running event loop"
+		self._queue = asyncio.Queue(self.maxsize)
+		if self.spill_path and os.path.exists(self.spill_path):
+			if os.path.exists(self.spill_path+'.offset'):
+				with open(self.spill_path+'.offset') as f:
+					self._spill_offset = int(f.read() or 0)
+			with open(self.spill_path) as f:
+				f.seek(self._spill_offset)
+				self._spilled = sum(1 for line in f)
+		self._worker = asyncio.ensure_future(self._work())
+
+	async def drain(self):
+		"Wait until all queued and spilled messages have been handed to the writer"
+		await self._queue.join()
+		while self._spilled:
+			await asyncio.sleep(0)	# let the worker recover the spilled messages
+			await self._queue.join()
+
+	async def stop(self):
+		"""
+		Cancel the worker and wait for the write or flush it started. Queued messages are 
+		spilled to disk if so configured, else lost.
+		"""
+		if self._worker:
+			self._worker.cancel()
+			try:
+				await self._worker
+			except asyncio.CancelledError:
+				pass
+		if self._running:
+			await asyncio.wait([self._running])	# the writer must not be closed while in use
+			self._running = None
+		if self._queue is None:
+			return
+		pending, self._collected = self._collected, []
+		while not self._queue.empty():
+			pending.append(self._queue.get_nowait())
+		if pending and self.policy == 'spill':
+			self._spill(*pending)
+		elif pending:
+			logger.warning(f'Discarded {len(pending)} queued messages of {self.name}')
+			self.counters['dropped'] += len(pending)
+		if self._spill_file:
+			self._spill_file.close()
+			self._spill_file = None
+		if hasattr(self.writer, 'close'):
+			try:
+				await asyncio.get_running_loop().run_in_executor(None, self.writer.close)
+			except Exception as e:
+				logger.error(f'{self.name} failed to close: {e}')
+
+	def offer(self, message, source=None):
+		"""
+		Enqueue a message without blocking. Returns a coroutine, which must be awaited, only
+		if the policy is "block" and the queue is full.
+		"""
+		item = (copy_message(message), source)
+		self.counters['enqueued'] += 1
+		if self._spilled and not self._queue.full():
+			self._unspill()
+		if self._spilled:
+			# keep the order as long as there are messages on disk
+			self._spill(item)
+		elif not self._queue.full():
+			self._queue.put_nowait(item)
+		elif self.policy == 'block':
+			return self._queue.put(item)
+		elif self.policy == 'drop_oldest':
+			self._queue.get_nowait()
+			self._queue.task_done()
+			self._queue.put_nowait(item)
+			self.counters['dropped'] += 1
+		elif self.policy == 'drop_newest':
+			self.counters['dropped'] += 1
+		else:
+			self._spill(item)
+
+	def _spill(self, *items):
+		if self._spill_file is None:
+			self._spill_file = open(self.spill_path,'a')
+		for message, source in items:
+			self._spill_file.write(json.dumps([message.as_dict(), source, message.schema.name]) + '\n')
+		self._spill_file.flush()
+		self._spilled += len(items)
+		self.counters['spilled'] += len(items)
+
+	def _unspill(self):
+		"Move as many spilled messages into the queue as fit, keep the rest on disk"
+		free = self.maxsize - self._queue.qsize() if self.maxsize > 0 else self._spilled
+		n = 0
+		with open(self.spill_path) as f:
+			f.seek(self._spill_offset)
+			while n < min(free, self._spilled):
+				message, source, name = json.loads(f.readline())
+				self._queue.put_nowait((as_record(message, name), source))
+				n += 1
+			self._spill_offset = f.tell()
+		self._spilled -= n
+		if self._spilled:
+			with open(self.spill_path+'.offset','w') as f:
+				f.write(str(self._spill_offset))
+		else:
+			# all fed back, start over with an empty file
+			if self._spill_file:
+				self._spill_file.close()
+				self._spill_file = None
+			os.remove(self.spill_path)
+			if os.path.exists(self.spill_path+'.offset'):
+				os.remove(self.spill_path+'.offset')
+			self._spill_offset = 0
+		logger.debug(f'Recovered {n} spilled messages of {self.name}')
+
+	async def _run(self, func, *args):
+		"Run func in the executor. A cancelled worker leaves it running for stop to await."
+		self._running = asyncio.get_running_loop().run_in_executor(None, func, *args)
+		await asyncio.shield(self._running)
+		self._running = None
+
+	async def _get(self):
+		"Next item. The writer is flushed, whenever the queue stays empty for its flush_interval."
+		interval = getattr(self.writer, 'flush_interval', None)
+		while True:
+			try:
+				return await asyncio.wait_for(self._queue.get(), interval)
+			except asyncio.TimeoutError:
+				await self._run(self._flush)
+
+	def _flush(self):
+		"Runs in the executor"
+		try:
+			self.writer.flush()
+		except Exception as e:
+			self.counters['errors'] += 1
+			logger.error(f'{self.name} failed to flush: {e}')
+
+	async def _next_batch(self):
+		"Up to batch_size items, waiting at most batch_time for more after the first one"
+		items = [await self._get()]
+		deadline = asyncio.get_running_loop().time() + self.batch_time
+		try:
+			while len(items) < self.batch_size:
+				if not self._queue.empty():
+					items.append(self._queue.get_nowait())
+					continue
+				timeout = deadline - asyncio.get_running_loop().time()
+				if timeout <= 0:
+					break
+				try:
+					items.append(await asyncio.wait_for(self._queue.get(), timeout))
+				except asyncio.TimeoutError:
+					break
+		except asyncio.CancelledError:
+			# keep the collected items for stop
+			self._collected = items
+			for item in items:
+				self._queue.task_done()
+			raise
+		return items
+
+	def _write_items(self, items):
+		"Runs in the executor and counts the written and failed messages"
+		written = errors = 0
+		for source, group in groupby(items, key=itemgetter(1)):
+			messages = [message for message, _ in group]
+			try:
+				if self.batch_size > 1:
+					self._write_batch(messages, source)
+				else:
+					for message in messages:
+						self._write(message, source)
+				written += len(messages)
+			except Exception as e:
+				errors += len(messages)
+				logger.error(f'{self.name} failed to write: {e}')
+		self.counters['written'] += written
+		self.counters['errors'] += errors
+
+	async def _work(self):
+		while True:
+			if self._spilled and self._queue.empty():
+				self._unspill()
+			items = await self._next_batch() if self.batch_size > 1 else [await self._get()]
+			try:
+				await self._run(self._write_items, items)
+			finally:
+				if self._spilled and self._queue.empty():
+					self._unspill()	# before task_done, such drain can't miss them
+				for item in items:
+					self._queue.task_done()
+
+	def stats(self):
+		"Queue depth and counters"
+		depth = self._queue.qsize() if self._queue else 0
+		stats = dict(depth=depth, maxsize=self.maxsize, spill_depth=self._spilled, **self.counters)
+		if hasattr(self.writer, 'metrics'):
+			stats['sink'] = dict(self.writer.metrics)
+		return stats
+
+class FilterQueue:
+	"""
+	Runs the filters of a reader off the event loop. Records are queued by offer and handed in 
+	batches of up to batch_size, split by source, to process(records, source), which runs in an
+	executor thread and returns (writer, record) pairs. These are passed to deliver(writer, record,
+	source) on the event loop, which may return a coroutine to await (see WriterQueue.offer). There is one
+	worker per queue, such the stateful filters are never called concurrently.
+	"""
+
+	def __init__(self, process, deliver, name, maxsize=1000, batch_size=100):
+		self._process = process
+		self._deliver = deliver
+		self.name = name
+		self.maxsize = maxsize
+		self.batch_size = max(1, batch_size)
+		self.counters = dict(enqueued=0, processed=0, errors=0, process_time=0.0)
+		self._queue = None
+		self._worker = None
+		self._running = None
+
+	def start(self):
+		"Must be called from within the running event loop"
+		self._queue = asyncio.Queue(self.maxsize)
+		self._worker = asyncio.ensure_future(self._work())
+
+	def offer(self, message, source=None):
+		"Enqueue a message. Returns a coroutine, which must be awaited, if the queue is full."
+		item = (copy_message(message), source)
+		self.counters['enqueued'] += 1
+		if self._queue.full():
+			return self._queue.put(item)
+		self._queue.put_nowait(item)
+
+	async def drain(self):
+		"Wait until all queued messages have been delivered to the writers"
+		await self._queue.join()
+
+	async def stop(self):
+		"Cancel the worker after the batch in process. Queued messages are lost."
+		if self._worker:
+			self._worker.cancel()
+			try:
+				await self._worker
+			except asyncio.CancelledError:
+				pass
+		if self._running:
+			await asyncio.wait([self._running])
+		if self._queue and not self._queue.empty():
+			logger.warning(f'Discarded {self._queue.qsize()} unfiltered messages of {self.name}')
+
+	def _process_items(self, items):
+		"Runs in the executor. Returns (writer, record, source) of all items."
+		started = time.perf_counter()
+		out = []
+		for source, group in groupby(items, key=itemgetter(1)):
+			messages = [message for message, _ in group]
+			try:
+				out += [(writer, record, source) for writer, record in self._process(messages, source)]
+			except Exception as e:
+				self.counters['errors'] += len(messages)
+				logger.error(f'Filters of {self.name} failed on {len(messages)} messages: {e}')
+		self.counters['processed'] += len(items)
+		self.counters['process_time'] += time.perf_counter() - started
+		return out
+
+	async def _work(self):
+		loop = asyncio.get_running_loop()
+		while True:
+			items = [await self._queue.get()]
+			while len(items) < self.batch_size and not self._queue.empty():
+				items.append(self._queue.get_nowait())
+			try:
+				self._running = loop.run_in_executor(None, self._process_items, items)
+				out = await asyncio.shield(self._running)
+				self._running = None
+				for writer, record, source in out:
+					waiting = self._deliver(writer, record, source)
+					if waiting:
+						await waiting
+			finally:
+				for item in items:
+					self._queue.task_done()
+
+	def stats(self):
+		"Queue depth, counters and the mean filter time per message in µs"
+		depth = self._queue.qsize() if self._queue else 0
+		processed = self.counters['processed']
+		per_message = round(1e6*self.counters['process_time']/processed, 1) if processed else None
+		return dict(self.counters, depth=depth, maxsize=self.maxsize, us_per_message=per_message)
@@ -0,0 +1,122 @@
+################################################################################################
+# HDF5 files must not be written by more than one process. The H5 store server is the single
+# writer of one h5store.H5Store, to which any number of datalogger processes send their records
+# through a unix socket (see writers.H5StoreWriter). Each sensor gets a dataset of its own, all
+# datasets share one file and get a time index.
+#
+# A frame is the length of the packed message (4 bytes, little endian) followed by the message,
+# packed as msgpack or json (see codec.getCodec):
+#
+#	["table", name, fields, units]	declares the dataset name, before rows are sent to it
+#	["rows", name, [[v0, v1, ...], ...]]
+#	["sync"]			answered by ["ok"], if all frames since the last sync were stored
+#
+# A frame, which can't be stored, e.g. a table declared with fields other than those of the
+# dataset, is answered by ["error", message] and the connection is closed, such no later rows
+# end up in the wrong table. The client must reconnect and declare its tables again.
+# Buffered rows are written every flush_time seconds and on shutdown.
+################################################################################################
+import logging, asyncio, struct, os
+from codec import getCodec
+from h5store import H5Store
+
+logger = logging.getLogger(__name__)
+
+FRAME = struct.Struct('<I')
+
+def pack_frame(dumps, message):
+	body = dumps(message)
+	return FRAME.pack(len(body)) + body
+
+class H5StoreServer:
+
+	def __init__(self, filename, socket_path='h5store.sock', format='msgpack', flush_time=5.0, index_interval=3600, **store_kw):
+		"store_kw are passed to h5store.H5Store, e.g. chunk_rows, compression, swmr"
+		self.socket_path = socket_path
+		self.flush_time = flush_time
+		self.dumps, self.loads = getCodec(format)
+		self.store = H5Store(filename, index_interval=index_interval, **store_kw)
+		self.metrics = dict(clients=0, frames=0, rows=0, errors=0)
+		self._server = None
+
+	def handle(self, message):
+		"Apply one unpacked message to the store"
+		kind, name = message[0], message[1]
+		if kind == 'table':
+			self.store.table(name, message[2], message[3])
+		elif kind == 'rows':
+			self.store.tables[name].append(message[2])
+			self.metrics['rows'] += len(message[2])
+		else:
+			raise ValueError(f'Unknown message {kind}')
+
+	async def _serve_client(self, reader, writer):
+		self.metrics['clients'] += 1
+		logger.info('Client connected')
+		try:
+			while True:
+				try:
+					size, = FRAME.unpack(await reader.readexactly(FRAME.size))
+					body = await reader.readexactly(size)
+				except (asyncio.IncompleteReadError, ConnectionError):
+					break
+				self.metrics['frames'] += 1
+				try:
+					message = self.loads(body)
+					if message[0] == 'sync':
+						writer.write(pack_frame(self.dumps, ['ok']))
+						await writer.drain()
+						continue
+					self.handle(message)
+				except Exception as e:
+					self.metrics['errors'] += 1
+					logger.error(f'Could not store frame, closing the connection: {e}')
+					writer.write(pack_frame(self.dumps, ['error', str(e)]))
+					break
+		finally:
+			self.metrics['clients'] -= 1
+			writer.close()
+			logger.info('Client disconnected')
+
+	async def _flush_forever(self):
+		while True:
+			await asyncio.sleep(self.flush_time)
+			self.store.flush()
+
+	async def serve_forever(self):
+		if os.path.exists(self.socket_path):
+			os.remove(self.socket_path)	# left over from an earlier run
+		self._server = await asyncio.start_unix_server(self._serve_client, self.socket_path)
+		logger.info(f'Serving {self.store.filename} on {self.socket_path}')
+		flusher = asyncio.ensure_future(self._flush_forever())
+		try:
+			async with self._server:
+				await self._server.serve_forever()
+		finally:
+			flusher.cancel()
+			self.store.close()
+			if os.path.exists(self.socket_path):
+				os.remove(self.socket_path)
+			logger.info(f'Statistics: {self.metrics}')
+
+if __name__=='__main__':
+	'''
+	HDF5 Schreibdienst starten
+	'''
+	import argparse
+	logging.basicConfig(format='%(asctime)s:[%(levelname)s][%(module)s][%(funcName)s][%(lineno)d] %(message)s',level=logging.INFO)
+	server = argparse.ArgumentParser(description="Startet den HDF5 Schreibdienst")
+	server.add_argument("-f", "--file", help="Pfad zur h5-Datei", type=str, required=True)
+	server.add_argument("-s", "--socket", help="Pfad zum Unix-Socket", type=str, default='h5store.sock')
+	server.add_argument("--format", help="msgpack oder json", type=str, default='msgpack')
+	server.add_argument("--chunk-rows", help="Zeilen pro Chunk", type=int, default=1024)
+	server.add_argument("--compression", help="gzip oder lzf", type=str, default=None)
+	server.add_argument("--swmr", help="Lesen während des Schreibens erlauben", action='store_true')
+	server.add_argument("--index-interval", help="Intervall des Zeitindex in Sekunden", type=float, default=3600)
+	opts = server.parse_args()
+	h5 = H5StoreServer(opts.file, opts.socket, opts.format, index_interval=opts.index_interval,
+			chunk_rows=opts.chunk_rows, compression=opts.compression, swmr=opts.swmr)
+	try:
+		asyncio.run(h5.serve_forever())
+	except KeyboardInterrupt:
+		logger.warning('H5 store server closed.')
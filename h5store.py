@@ -0,0 +1,253 @@
+################################################################################################
+# HDF5 storage kept open for the whole run. Each table is a one dimensional dataset of float
+# records (missing values are NaN), to which rows are appended through a preallocated buffer of
+# chunk_rows rows, such the file is written in whole chunks. Datasets grow geometrically, the
+# number of valid rows is kept in the attribute "rows" and the surplus is cut off on close.
+#
+# With swmr, the file is opened in single writer multiple reader mode and datasets grow exactly
+# by the rows written, such dashboards may read it while it is written:
+#
+#	f = h5py.File(filename, 'r', libver='latest', swmr=True)
+#	dataset = f[name]; ...; dataset.refresh()
+#
+# Datasets can't be created in SWMR mode, such the file is reopened to add a table; readers
+# must then reopen it as well.
+#
+# With an index_interval in seconds, each table gets a time index _index/<name> of the first
+# row of each interval, by which read finds the rows of a time range without a full scan. Rows
+# are expected in about chronological order, a row older than the last indexed interval is not
+# indexed.
+#
+# H5Reader reads the tables without writing, e.g. while the H5 store server is running.
+################################################################################################
+import logging
+import numpy as np
+import h5py
+
+logger = logging.getLogger(__name__)
+
+COMPRESSIONS = (None, 'gzip', 'lzf')
+
+class H5Table:
+	"One dataset, written from a preallocated buffer"
+
+	def __init__(self, dataset, chunk_rows=1024, swmr=False, index=None, index_interval=None):
+		self.dataset = dataset
+		self.swmr = swmr
+		self.fields = dataset.dtype.names
+		self.rows = int(dataset.attrs.get('rows', len(dataset)))
+		self._buffer = np.empty(chunk_rows, dtype=dataset.dtype)
+		self._values = self._buffer.view(np.float64).reshape(chunk_rows, len(self.fields))
+		self._pending = 0
+		self.index = index	# H5Table of (timestamp, row)
+		self.index_interval = index_interval and index_interval*1000
+		self._bucket = -np.inf
+		if index is not None and index.rows:
+			self._bucket = index.dataset[index.rows-1]['timestamp']//self.index_interval
+
+	def __len__(self):
+		return self.rows + self._pending
+
+	def append(self, rows):
+		"Append sequences of values in the order of the fields. None is stored as NaN."
+		for values in rows:
+			self._values[self._pending] = values
+			self._pending += 1
+			if self._pending == len(self._buffer):
+				self.flush()
+
+	def flush(self):
+		"Write the buffered rows to the dataset"
+		n = self._pending
+		if not n:
+			return
+		self._reserve(self.rows + n)
+		self.dataset[self.rows:self.rows+n] = self._buffer[:n]
+		if self.index is not None:
+			self._update_index(n)
+		self.rows += n
+		self.dataset.attrs['rows'] = self.rows
+		self._pending = 0
+
+	def _update_index(self, n):
+		"Index the first buffered row of each interval not seen before"
+		buckets = self._values[:n,0]//self.index_interval
+		latest = np.fmax.accumulate(np.concatenate(([self._bucket], buckets)))
+		new = np.flatnonzero(buckets > latest[:-1])
+		self.index.append(zip(buckets[new]*self.index_interval, self.rows + new))
+		self.index.flush()
+		self._bucket = latest[-1]
+
+	def _reserve(self, rows):
+		size = len(self.dataset)
+		if rows > size:
+			self.dataset.resize((rows if self.swmr else max(rows, 2*size),))
+
+	def trim(self):
+		"Flush and cut off the rows reserved, but not written"
+		self.flush()
+		if len(self.dataset) > self.rows:
+			self.dataset.resize((self.rows,))
+
+def select(dataset, rows, index=None, start=None, end=None):
+	"The first rows of dataset with start <= timestamp < end, found by the time index array if given"
+	first, last = 0, rows
+	if index is not None and len(index):
+		if start is not None:
+			i = np.searchsorted(index['timestamp'], start, side='right') - 1
+			first = int(index['row'][i]) if i >= 0 else 0
+		if end is not None:
+			i = np.searchsorted(index['timestamp'], end, side='left')
+			last = int(index['row'][i]) if i < len(index) else rows
+	data = dataset[first:last]
+	fields = dataset.dtype.names
+	ts = data['timestamp'] if 'timestamp' in fields else data[fields[0]]
+	mask = np.ones(len(data), dtype=bool)
+	if start is not None:
+		mask &= ts >= start
+	if end is not None:
+		mask &= ts < end
+	return data[mask]
+
+class H5Store:
+	"""
+	One open HDF5 file with a H5Table per dataset name. compression is gzip or lzf,
+	compression_opts the gzip level.
+	"""
+
+	def __init__(self, filename, chunk_rows=1024, compression=None, compression_opts=None, swmr=False, index_interval=None):
+		if compression not in COMPRESSIONS:
+			raise ValueError(f'Unknown compression "{compression}". Choose one of {COMPRESSIONS}')
+		self.filename = filename
+		self.chunk_rows = chunk_rows
+		self.compression = compression
+		self.compression_opts = compression_opts
+		self.swmr = swmr
+		self.index_interval = index_interval
+		self.tables = {}
+		self._file = None
+
+	def open(self):
+		if self._file is None:
+			self._file = h5py.File(self.filename, 'a', libver='latest' if self.swmr else 'earliest')
+			logger.info(f'Opened {self.filename}')
+			for name, table in self.tables.items():
+				table.dataset = self._file[name]
+			if self.swmr:
+				self._file.swmr_mode = True
+		return self._file
+
+	def table(self, name, fields, units=None):
+		"The table name with fields, created if it does not exist"
+		fields = tuple(fields)
+		if name not in self.tables:
+			f = self.open()
+			if name not in f:
+				f = self._create(name, fields, units)
+			index = None
+			if self.index_interval and not name.startswith('_index/'):
+				index = self.table(f'_index/{name}', ('timestamp','row'))
+				f = self._file
+			self.tables[name] = H5Table(f[name], self.chunk_rows, self.swmr, index, self.index_interval)
+		table = self.tables[name]
+		if table.fields != fields:
+			raise ValueError(f'Dataset {name} in {self.filename} has the fields {table.fields}, not {fields}')
+		return table
+
+	def _create(self, name, fields, units):
+		if self.swmr:
+			self.close()
+			f = self._file = h5py.File(self.filename, 'a', libver='latest')
+		else:
+			f = self._file
+		dtype = [(k, float) for k in fields]
+		dataset = f.create_dataset(name, shape=(0,), maxshape=(None,), chunks=(self.chunk_rows,), dtype=dtype,
+				fillvalue=np.array(tuple([np.nan]*len(fields)), dtype=dtype),
+				compression=self.compression, compression_opts=self.compression_opts)
+		dataset.attrs['rows'] = 0
+		if units:
+			dataset.attrs['units'] = [u or '' for u in units]
+		logger.info(f'Created dataset {name} in {self.filename}')
+		if self.swmr:
+			self._file = None
+			f.close()
+			f = self.open()
+		return f
+
+	def read(self, name, start=None, end=None):
+		"Rows of table name with start <= timestamp < end (msec), found by the time index if there is one"
+		table = self.tables[name]
+		self.flush()
+		index = table.index.dataset[:table.index.rows] if table.index is not None else None
+		return select(table.dataset, table.rows, index, start, end)
+
+	def flush(self):
+		for table in self.tables.values():
+			table.flush()
+		if self._file is not None:
+			self._file.flush()
+
+	def reopen(self, filename):
+		"Close the file and continue in filename, where the tables are looked up again"
+		try:
+			self.close()
+		except OSError as e:
+			logger.error(f'Could not close {self.filename}: {e}')
+			self._file = None
+		self.tables.clear()
+		self.filename = filename
+
+	def close(self):
+		"Flush all tables and close the file"
+		if self._file is None:
+			return
+		for table in reversed(list(self.tables.values())):	# tables before their index
+			table.flush() if self.swmr else table.trim()
+		self._file.close()
+		self._file = None
+		logger.info(f'Closed {self.filename}')
+
+class H5Reader:
+	"""
+	Read only access to a file written by H5Store, with swmr also while it is written. The
+	fields of a table are those of its dataset, the time index is read from _index/<name>.
+	"""
+
+	def __init__(self, filename, swmr=True):
+		self.filename = filename
+		self.swmr = swmr
+		self._file = None
+
+	def open(self):
+		if self._file is None:
+			self._file = h5py.File(self.filename, 'r', libver='latest', swmr=True) if self.swmr else h5py.File(self.filename, 'r')
+		return self._file
+
+	def _dataset(self, name):
+		dataset = self.open()[name]
+		if self.swmr:
+			dataset.refresh()
+		return dataset, int(dataset.attrs.get('rows', len(dataset)))
+
+	def names(self):
+		"Names of the tables"
+		names = []
+		self.open().visititems(lambda name, item: names.append(name) if isinstance(item, h5py.Dataset) and not name.startswith('_index/') else None)
+		return names
+
+	def fields(self, name):
+		return self.open()[name].dtype.names
+
+	def read(self, name, start=None, end=None):
+		"Rows of table name with start <= timestamp < end (msec), found by the time index if there is one"
+		dataset, rows = self._dataset(name)
+		index = None
+		if f'_index/{name}' in self._file:
+			index, index_rows = self._dataset(f'_index/{name}')
+			index = index[:index_rows]
+		return select(dataset, rows, index, start, end)
+
+	def close(self):
+		if self._file is not None:
+			self._file.close()
+			self._file = None
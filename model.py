@@ -28,3 +28,32 @@ class XiaomiMiData(db.Document):
 	temperature = db.FloatField()
 	humidity = db.FloatField()
 
+
+class SensorBucket(db.Document):
+	"""
+	All readings of one sensor in one time bucket (see writers.MongoBucketWriter): the value 
+	arrays of each field in the order of timestamps and its min, max, sum and count.
+	"""
+	sensor = db.StringField(required=True)
+	start = db.IntField(required=True)
+	end = db.IntField()
+	count = db.IntField()
+	timestamps = db.ListField(db.IntField())
+	values = db.DictField()
+	stats = db.DictField()
+	units = db.DictField()
+	meta = {'indexes': [{'fields': ['sensor','start'], 'unique': True}]}
+	
+	def summary(self):
+		"min, max, mean and count of each field"
+		return {name:dict(min=s.get('min'), max=s.get('max'), count=s.get('count',0), mean=s['sum']/s['count'] if s.get('count') else None) for name,s in self.stats.items()}
+	
+	@classmethod
+	def summaries(cls, sensor, start=None, end=None):
+		"(start, summary) of the buckets of sensor overlapping [start, end) in msec, without loading the values"
+		query = cls.objects(sensor=sensor)
+		if start is not None:
+			query = query.filter(end__gt=start)
+		if end is not None:
+			query = query.filter(start__lt=end)
+		return [(b.start, b.summary()) for b in query.only('start','stats').order_by('start')]
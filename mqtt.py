@@ -434,3 +434,18 @@ class Mqtt:
 		self.client.on_log = handler
 		return handler
 
+
+_clients: Dict[Tuple[str, str], Mqtt] = {}
+
+
+def getMqtt(broker_url: str, client_id: str, **kwargs) -> Mqtt:
+	"""Lazily initialize one Mqtt client per broker and client id.
+
+	Several writers publishing to the same broker share the connection instead
+	of opening one each.
+
+	"""
+	key = (broker_url, client_id)
+	if key not in _clients:
+		_clients[key] = Mqtt(broker_url, client_id, **kwargs)
+	return _clients[key]
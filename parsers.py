@@ -1,6 +1,7 @@
-import io, json, logging, sys, re
+import io, json, logging, sys, re, struct
 from datetime import datetime
 from parsers import *
+from record import Record, getSchema
 
 logger = logging.getLogger(__name__)
 
@@ -33,15 +34,144 @@ class Parser(object):
 		
 
 ##############################################################################################
-# P C E A Q D 2 0 
-pat_PCEAQD20 = re.compile('FTDI USB Serial Device converter now attached to (ttyUSB\d)')
+# F r a m e B u f f e r
+class FrameBuffer:
+	"""
+	Preallocated byte buffer for decoders of binary streams. Fed bytes are appended behind the 
+	unconsumed rest, which is moved to the buffer front when the space at the end runs out. 
+	Decoders index the bytearray directly instead of slicing and decoding lines.
+	"""
+	
+	def __init__(self, size=4096):
+		self.buffer = bytearray(size)
+		self.start = 0
+		self.end = 0
+
+	def feed(self, data):
+		n = len(data)
+		if self.end + n > len(self.buffer):
+			self.compact()
+			if self.end + n > len(self.buffer):
+				self.buffer.extend(bytes(max(n, len(self.buffer))))
+		self.buffer[self.end:self.end+n] = data
+		self.end += n
+
+	def find(self, sub, start=None, end=None):
+		"Absolute position of sub in the unconsumed bytes or -1"
+		start = self.start if start is None else start
+		end = self.end if end is None else min(end, self.end)
+		return self.buffer.find(sub, start, end)
+
+	def consume(self, end):
+		"Discard everything before the absolute position end"
+		self.start = min(end, self.end)
+		if self.start == self.end:
+			self.start = self.end = 0
+
+	def compact(self):
+		n = self.end - self.start
+		self.buffer[:n] = self.buffer[self.start:self.end]
+		self.start, self.end = 0, n
+
+	def __len__(self):
+		return self.end - self.start
 
+##############################################################################################
+# J S O N S p l i t t e r
+class JSONSplitter:
+	"""
+	Incrementally splits a byte stream into json objects. Only the new bytes are scanned, and 
+	only for structural characters, such partial or concatenated reads cost no rescanning. 
+	Complete objects are returned as soon as their closing brace arrives.
+	"""
+	TOKENS = re.compile(rb'[{}"\\]')
+	
+	def __init__(self, max_size=4096):
+		self.max_size = max_size
+		self._buffer = bytearray()
+		self._pos = 0		# scanned up to here
+		self._start = 0		# start of the pending object
+		self._depth = 0
+		self._in_string = False
+		self._escaped = -1	# position of an escaped character
+
+	def feed(self, data):
+		"Returns the list of objects completed by data"
+		buf = self._buffer
+		buf += data
+		objects = []
+		for m in self.TOKENS.finditer(buf, self._pos):
+			i = m.start()
+			if i == self._escaped:
+				continue
+			c = buf[i]
+			if self._in_string:
+				if c == 0x5c:
+					self._escaped = i+1
+				elif c == 0x22:
+					self._in_string = False
+			elif c == 0x22:
+				self._in_string = self._depth > 0
+			elif c == 0x7b:
+				if not self._depth:
+					self._start = i
+				self._depth += 1
+			elif c == 0x7d and self._depth:
+				self._depth -= 1
+				if not self._depth:
+					objects.append(bytes(buf[self._start:i+1]))
+		self._pos = len(buf)
+		self._trim()
+		return objects
+
+	def _trim(self):
+		"Discard everything, that is not part of a pending object"
+		if not self._depth:
+			del self._buffer[:]
+			self._pos = 0
+			self._escaped = -1
+			return
+		if len(self._buffer) - self._start > self.max_size:
+			logger.warning(f'Discarded json object exceeding {self.max_size} bytes')
+			self._depth, self._in_string = 0, False
+			return self._trim()
+		del self._buffer[:self._start]
+		self._pos -= self._start
+		self._escaped -= self._start
+		self._start = 0
+
+##############################################################################################
+# P C E A Q D 2 0 
 class PCEAQD20Parser(Parser):
+	"""
+	A dataset consists of 5 frames of 16 bytes, one per measuring type:
+	STX '4' type(1) unit(2) sign(1) decimals(1) value(8) CR
+	"""
 	UNITS = ['H0','04','02','78','19','80','01','91','G4']
+	UNIT_NAMES = {'H0':'µg/m³', '04':'%', '01':'°C', 'G4':'ppm', '91':'hPa'}
 	MEASURING_TYPES = ['pm25','humidity','temperature','co2','pressure']
 	START = '\x02'
 	STOP = b'\r'
 	INIT = '1'
+	FRAME_SIZE = 16
+
+	DEFAULT_UNITS = ('µg/m³','%','°C','ppm','hPa')
+
+	def __init__(self):
+		super().__init__()
+		self._frames = FrameBuffer()
+		self._dataset = None
+		self._last_type = 0
+		self._started = False
+		# bytes-level lookup tables for decode
+		self._units = {ord(u[0])<<8|ord(u[1]):self.UNIT_NAMES.get(u,u) for u in self.UNITS}
+		self._types = {ord(str(i+1)):(i+1,t) for i,t in enumerate(self.MEASURING_TYPES)}
+		self._set_schema(self.DEFAULT_UNITS)
+
+	def _set_schema(self, units):
+		"The logger may be switched to other units, e.g. °F, which changes the schema"
+		self._schema_units = tuple(units)
+		self.schema = getSchema('PCEAQD20', (('timestamp','msec'),) + tuple(zip(self.MEASURING_TYPES, units)))
 
 	def _check_validity(self, word):
 		super()._check_validity(word)
@@ -59,18 +189,7 @@ class PCEAQD20Parser(Parser):
 		t = w[2] 
 		t = self.MEASURING_TYPES[int(t)-1] 
 		u = w[3:5] 
-		if u=='H0': 
-			unit = 'µg/m³' 
-		elif u=='04': 
-			unit = '%' 
-		elif u == '01': 
-			unit = '°C' 
-		elif u == 'G4': 
-			unit = 'ppm' 
-		elif u ==  '91': 
-			unit = 'hPa' 
-		else: 
-			unit = u 
+		unit = self.UNIT_NAMES.get(u,u)
 		s = w[5] 
 		sign = 1 if s == '0' else -1 
 		d = w[6] 
@@ -78,12 +197,126 @@ class PCEAQD20Parser(Parser):
 		val = int(w[7:15])/div 
 		return {t:dict(value=val, unit=unit)} 
 
+	def _decode_frame(self, buf, p):
+		"""
+		Decode the frame starting with STX at buf[p]. Returns (index, name, value, unit) or 
+		None, if the frame is corrupt.
+		"""
+		if buf[p+1] != 0x34 or buf[p+15] != 0x0d:
+			return None
+		index, name = self._types.get(buf[p+2], (None,None))
+		unit = self._units.get(buf[p+3]<<8|buf[p+4])
+		digits = buf[p+7:p+15]
+		if index is None or unit is None or not digits.isdigit() or not 0x30 <= buf[p+6] <= 0x39:
+			return None
+		div = 10**(buf[p+6]-0x30)
+		val = int(digits)/div
+		return index, name, -val if buf[p+5] != 0x30 else val, unit
+
+	def decode(self, data):
+		"""
+		Feed raw bytes and return the list of records completed by them. Frames are located by 
+		their start byte, such a truncated or corrupt frame only costs its own measurement: the 
+		decoder resyncs at the next start byte and a record missing a line is still returned
+		with None in its place. The timestamp is left to the reader.
+		"""
+		frames = self._frames
+		frames.feed(data)
+		buf = frames.buffer
+		datasets = []
+		p = frames.find(b'\x02')
+		while p >= 0 and frames.end - p >= self.FRAME_SIZE:
+			resync = frames.find(b'\x02', p+1, p+self.FRAME_SIZE)
+			frame = None if resync >= 0 else self._decode_frame(buf, p)
+			if frame is None:
+				logger.warning(f'Discarded corrupt or truncated frame {bytes(buf[p:p+self.FRAME_SIZE])}')
+				p = resync if resync >= 0 else frames.find(b'\x02', p+1)
+				continue
+			index, name, val, unit = frame
+			p += self.FRAME_SIZE
+			if p < frames.end and buf[p] != 0x02:
+				p = frames.find(b'\x02', p)	# bytes between frames, e.g. a line feed
+			if not self._started:
+				if index != int(self.INIT):
+					continue
+				self._started = True
+			if index <= self._last_type and self._dataset:
+				logger.warning(f'Incomplete dataset {self._dataset}')
+				datasets.append(self._dataset)
+				self._dataset = None
+			if unit != self._schema_units[index-1]:
+				units = list(self._schema_units)
+				units[index-1] = unit
+				self._set_schema(units)
+			if self._dataset is None:
+				self._dataset = self.schema.record()
+			self._dataset.schema = self.schema
+			self._dataset.values[index] = val
+			self._last_type = index
+			if index == len(self.MEASURING_TYPES):
+				datasets.append(self._dataset)
+				self._dataset = None
+				self._last_type = 0
+		frames.consume(p if p >= 0 else frames.end)
+		return datasets
+
+	def parse_many(self, buffer):
+		"""
+		Vectorized decode of a whole buffer of frames into a NumPy structured array with one row 
+		per dataset and NaN for missing measurements. A dataset ends where the measuring type 
+		does not increase.
+		"""
+		import numpy as np
+		raw = np.frombuffer(buffer, dtype=np.uint8)
+		starts = np.flatnonzero(raw[:max(0, len(raw)-self.FRAME_SIZE+1)] == 0x02)
+		frames = raw[starts[:,None] + np.arange(self.FRAME_SIZE)]
+		units = frames[:,3].astype(np.uint16)<<8 | frames[:,4]
+		types = frames[:,2].astype(np.int64) - 0x31
+		digits = frames[:,6:15].astype(np.int64) - 0x30
+		valid = (
+			(frames[:,1] == 0x34) & (frames[:,15] == 0x0d) 
+			& ~(frames[:,1:] == 0x02).any(axis=1)		# truncated frame
+			& (types >= 0) & (types < len(self.MEASURING_TYPES))
+			& np.isin(units, list(self._units)) & ((digits >= 0) & (digits <= 9)).all(axis=1)
+		)
+		frames, units, types, digits = frames[valid], units[valid], types[valid], digits[valid]
+		values = digits[:,1:] @ 10**np.arange(7,-1,-1) / 10.0**digits[:,0]
+		values[frames[:,5] != 0x30] *= -1
+		if not len(types):
+			return np.empty(0, dtype=self.dtype())
+		dataset = np.cumsum(np.r_[True, types[1:] <= types[:-1]]) - 1
+		out = np.full(dataset[-1]+1, np.nan, dtype=self.dtype(dict(zip(types.tolist(), units.tolist()))))
+		for i,name in enumerate(self.MEASURING_TYPES):
+			rows = types == i
+			out[name][dataset[rows]] = values[rows]
+		return out
+
+	def dtype(self, units={}):
+		"units maps the index of a measuring type to its unit code"
+		return structured_dtype([(name, self._units.get(units.get(i))) for i,name in enumerate(self.MEASURING_TYPES)])
+
 ##############################################################################################
 # P l a n t o w e r 
 class PlantowerParser(Parser):
 	START = '{'
 	STOP = b'}'
 	INIT = START
+	# (name, json key, unit) of each measurement in a dataset
+	FIELDS = (
+		('cpm25','cpm2.5','µg/m³'),
+		('cpm10','cpm1.0','µg/m³'),
+		('cpm100','cpm10','µg/m³'),
+		('apm25','apm2.5','µg/m³'),
+		('apm10','apm1.0','µg/m³'),
+		('apm100','apm10','µg/m³'),
+		('temperature','t','°C'),
+		('humidity','r','%'),
+	)
+	
+	def __init__(self):
+		super().__init__()
+		self._splitter = JSONSplitter()
+		self.schema = getSchema('Plantower', (('timestamp','msec'),) + tuple((name,unit) for name,key,unit in self.FIELDS))
 	
 	def _check_validity(self, j):
 		try:
@@ -94,49 +327,180 @@ class PlantowerParser(Parser):
 	
 	def parse_word(self,j):
 		self._check_validity(j)
-		pat = re.compile('\{.*?\}')
-		r = pat.match(j)
+		for obj in JSONSplitter().feed(j.encode()):
+			res = self.parse_object(json.loads(obj))
+			if res:
+				return res
+		raise ValueError(f'No dataset found in {j}')
 
-		while r:
-			if len(r.group().split(',')) == 16:
-				break
-			start, end = r.span()
-			j = j[end:]
-			r = pat.match(j)
+	def parse_object(self, d):
+		"Map a decoded json object to a record. Returns None for objects, that aren't datasets."
+		try:
+			return Record(self.schema, [None] + [float(d[key]) for name,key,unit in self.FIELDS])
+		except (KeyError, TypeError, ValueError):
+			logger.debug(f'Skipped json object {d}')
+			return None
 
-		d = json.loads(j)
-		
-		res = dict(
-			cpm25 = getDim(float(d['cpm2.5']),'µg/m³'),
-			cpm10 = getDim(float(d['cpm1.0']),'µg/m³'),
-			cpm100 = getDim(float(d['cpm10']),'µg/m³'),
-			apm25 = getDim(float(d['apm2.5']),'µg/m³'),
-			apm10 = getDim(float(d['apm1.0']),'µg/m³'),
-			apm100 = getDim(float(d['apm10']),'µg/m³'),
-			# aqi = int(d['aqi']),
-			temperature = getDim(float(d.pop('t')),'°C'),
-			humidity = getDim(float(d.pop('r')),'%')
-		)
-		return res
+	def decode(self, data):
+		"Feed raw bytes and return the list of records completed by them"
+		datasets = []
+		for obj in self._splitter.feed(data):
+			try:
+				res = self.parse_object(json.loads(obj))
+			except ValueError:
+				logger.warning(f'Discarded invalid json object {obj}')
+				continue
+			if res:
+				datasets.append(res)
+		return datasets
+
+	def parse_many(self, buffer):
+		"Decode all datasets of buffer into a NumPy structured array"
+		import numpy as np
+		rows = []
+		for obj in JSONSplitter(max_size=len(buffer)).feed(buffer):
+			try:
+				d = json.loads(obj)
+				rows.append(tuple(float(d[key]) for name,key,unit in self.FIELDS))
+			except (KeyError, TypeError, ValueError):
+				continue
+		return np.array(rows, dtype=self.dtype())
+
+	def dtype(self):
+		return structured_dtype([(name,unit) for name,key,unit in self.FIELDS])
 
 def getDim(val,unit):
 	return dict(value=val,unit=unit)		
 
+def structured_dtype(fields):
+	"""
+	NumPy dtype for parse_many results: one float column per (name, unit) in fields. The unit 
+	is kept once in the metadata of the column, e.g. array.dtype['pm25'].metadata['unit'].
+	"""
+	import numpy as np
+	return np.dtype([(name, np.dtype(np.float64, metadata=dict(unit=unit))) for name,unit in fields])
+
+##############################################################################################
+# P M S 5 0 0 3 
+class PMS5003Parser(Parser):
+	"""
+	Native binary protocol of the Plantower PMS5003 (see manual v2.3): 32 byte frames of
+	start characters 'BM', frame length, 13 big endian data words and a checksum over all
+	preceding bytes. Produces the same datasets as PlantowerParser apart from temperature 
+	and humidity, which the bare sensor does not measure.
+	"""
+	START = b'BM'
+	FRAME = struct.Struct('>2sH13HH')
+	FRAME_LENGTH = 28	# value of the length field, i.e. 2*13 data + 2 checksum bytes
+	# (name, index of the data word, unit)
+	FIELDS = (
+		('cpm10',0,'µg/m³'),
+		('cpm25',1,'µg/m³'),
+		('cpm100',2,'µg/m³'),
+		('apm10',3,'µg/m³'),
+		('apm25',4,'µg/m³'),
+		('apm100',5,'µg/m³'),
+	)
+	# particles beyond a diameter per 0.1 l of air
+	COUNTS = (
+		('n03',6,'1/0.1l'),
+		('n05',7,'1/0.1l'),
+		('n10',8,'1/0.1l'),
+		('n25',9,'1/0.1l'),
+		('n50',10,'1/0.1l'),
+		('n100',11,'1/0.1l'),
+	)
+	
+	def __init__(self, with_counts=False):
+		super().__init__()
+		self._frames = FrameBuffer()
+		self._fields = self.FIELDS + self.COUNTS if with_counts else self.FIELDS
+		self._words = [i for name,i,unit in self._fields]
+		self.schema = getSchema('PMS5003', (('timestamp','msec'),) + tuple((name,unit) for name,i,unit in self._fields))
+
+	def matches_init_condition(self, word):
+		return word[:2] == self.START
+
+	def _decode_frame(self, buf, p):
+		"Returns the record of the frame at buf[p] or None if it is corrupt"
+		start, length, *words, checksum = self.FRAME.unpack_from(buf, p)
+		if length != self.FRAME_LENGTH or checksum != sum(buf[p:p+self.FRAME.size-2]):
+			return None
+		return Record(self.schema, [None] + [float(words[i]) for i in self._words])
+
+	def parse_word(self, word):
+		if len(word) < self.FRAME.size or not self.matches_init_condition(word):
+			raise ValueError(f'{word} is not a PMS5003 frame')
+		res = self._decode_frame(word, 0)
+		if not res:
+			raise ValueError(f'Checksum error in frame {word}')
+		return res
+
+	def decode(self, data):
+		"Feed raw bytes and return the list of records completed by them"
+		frames = self._frames
+		frames.feed(data)
+		datasets = []
+		p = frames.find(self.START)
+		while p >= 0 and frames.end - p >= self.FRAME.size:
+			res = self._decode_frame(frames.buffer, p)
+			if res is None:
+				logger.warning(f'Discarded corrupt frame {bytes(frames.buffer[p:p+self.FRAME.size])}')
+				p = frames.find(self.START, p+1)
+				continue
+			datasets.append(res)
+			p = frames.find(self.START, p+self.FRAME.size)
+		if p < 0 and frames.buffer[frames.end-1:frames.end] == self.START[:1]:
+			p = frames.end-1	# keep a split start sequence
+		frames.consume(p if p >= 0 else frames.end)
+		return datasets
+
 ##############################################################################################
 # X i a o m i M i T e m p e r a t u r e L o g g e r
 class XiaomiMiTemperatureLoggerParser(Parser):
+	SCHEMA = getSchema('XiaomiMiTemperature', (('timestamp','msec'),('temperature','°C'),('humidity','%')))
 
-	def parse(self,data):
-		msg = dict(timestamp=round(datetime.now().timestamp()*1000))
+	def parse(self,data,timestamp=None):
+		timestamp = round((timestamp or datetime.now().timestamp())*1000)
 		sign = int(data[1]) & 1<<7
 		val = (int(data[1])&0x7f)<<8|int(data[0])
 		if sign:
 			val -= 32767
-		msg.update(
-			temperature = val/100,
-			humidity = int(data[2])
-		)
-		return msg
+		return Record(self.SCHEMA, [timestamp, val/100, int(data[2])])
+
+	# Service data 0x181a broadcast by the custom firmwares of github.com/pvvx/ATC_MiThermometer.
+	# The pvvx format starts the readings with the same little endian temperature in 0.01 °C as
+	# the notifications, the older atc1441 format is big endian in 0.1 °C.
+	ADV_PVVX = struct.Struct('<6shHHBBB')	# mac, temperature, humidity (0.01 %), mV, battery %, counter, flags
+	ADV_ATC = struct.Struct('>6shBBHB')	# mac, temperature, humidity (%), battery %, mV, counter
+	
+	def parse_advertisement(self,data,timestamp=None):
+		timestamp = round((timestamp or datetime.now().timestamp())*1000)
+		if len(data) == self.ADV_PVVX.size:
+			mac, t, h, *_ = self.ADV_PVVX.unpack(data)
+			return Record(self.SCHEMA, [timestamp, t/100, h/100])
+		elif len(data) == self.ADV_ATC.size:
+			mac, t, h, *_ = self.ADV_ATC.unpack(data)
+			return Record(self.SCHEMA, [timestamp, t/10, h])
+		raise ValueError(f'Unknown advertisement format {data}')
+
+	def parse_many(self, buffer, frame_size=5):
+		"""
+		Decode a buffer of concatenated notifications of frame_size bytes into a NumPy 
+		structured array, just like parse does for a single one.
+		"""
+		import numpy as np
+		raw = np.frombuffer(buffer, dtype=np.uint8)
+		raw = raw[:len(raw)//frame_size*frame_size].reshape(-1, frame_size)
+		val = (raw[:,1].astype(np.int64) & 0x7f)<<8 | raw[:,0]
+		val[raw[:,1] & 0x80 != 0] -= 32767
+		out = np.empty(len(raw), dtype=self.dtype())
+		out['temperature'] = val/100
+		out['humidity'] = raw[:,2]
+		return out
+
+	def dtype(self):
+		return structured_dtype([('temperature','°C'),('humidity','%')])
 		
 
 
@@ -0,0 +1,151 @@
+################################################################################################
+# The filter chains of all writers fed by a reader are merged into one tree: writers, whose
+# chains start with the same filter configurations, share the nodes of this common prefix, such
+# each record is checked and averaged once, however many writers need the result. A writer is
+# attached to the node, whose output it writes.
+#
+# Writers with a resolution get rollups (see stats.Rollup) of the output of the first filter of
+# their chain, usually the plausibility check. The rollup tiers of a node are subtrees of their
+# own, fed by one Rollup per source.
+#
+# Filters are stateful, such every node keeps one filter instance per source. A batch of records
+# passes each node at once, such filters with a process_many (e.g. rules.RuleEngine) check it
+# vectorized.
+################################################################################################
+import logging, json
+from record import as_record
+from writers import process_batch
+
+logger = logging.getLogger(__name__)
+
+def cfg_key(cfg):
+	"Filter configurations with equal keys are interchangeable"
+	cfg = dict(cfg)
+	cls = cfg.pop('filter_cls')
+	return f'{cls.__module__}.{cls.__qualname__}', json.dumps(cfg, sort_keys=True, default=str)
+
+class FilterNode:
+
+	def __init__(self, cfg=None):
+		self.cfg = cfg
+		self.children = {}
+		self.writers = []
+		self.tiers = {}	# resolution -> FilterNode fed by the rollups of this node
+		self._filters = {}
+		self._rollups = {}
+
+	def child(self, cfg):
+		key = cfg_key(cfg)
+		if key not in self.children:
+			self.children[key] = FilterNode(cfg)
+		return self.children[key]
+
+	def get_filter(self, source):
+		"Lazily instantiate the filter of source"
+		if source not in self._filters:
+			cfg = dict(self.cfg)
+			filter_cls = cfg.pop('filter_cls')
+			self._filters[source] = filter_cls(**cfg)
+			logger.debug(f'Instantiated {filter_cls.__name__} for {source}')
+		return self._filters[source]
+
+	def get_rollup(self, source, rollup_cfg):
+		if source not in self._rollups:
+			from stats import Rollup
+			self._rollups[source] = Rollup(self.tiers.keys(), **rollup_cfg)
+		return self._rollups[source]
+
+	def describe(self, indent=0, name='input'):
+		"The subtree as text, one node per line"
+		name = cfg_key(self.cfg)[0].rsplit('.',1)[-1] if self.cfg else name
+		lines = ['\t'*indent + f'{name} -> {self.writers}']
+		for res, tier in self.tiers.items():
+			lines += tier.describe(indent+1, f'rollup {res} s')
+		for child in self.children.values():
+			lines += child.describe(indent+1)
+		return lines
+
+class FilterGraph:
+	"""
+	Built from the filter configurations of the writers (see writers.Writer.chain_cfgs).
+	process returns the records each writer has to write.
+	"""
+
+	def __init__(self, rollup_cfg={}):
+		self.root = FilterNode()
+		self.rollup_cfg = dict(rollup_cfg)
+
+	def add(self, writer, cfgs, resolution=None):
+		node = self.root
+		if resolution is not None:
+			for cfg in cfgs[:1]:
+				node = node.child(cfg)
+			node = node.tiers.setdefault(resolution, FilterNode())
+			cfgs = cfgs[1:]
+		for cfg in cfgs:
+			node = node.child(cfg)
+		node.writers.append(writer)
+
+	def process(self, record, source=None):
+		"List of (writer, record) resulting from record"
+		return self.process_many([record], source)
+
+	def process_many(self, records, source=None):
+		"""
+		List of (writer, record) resulting from the records of source. Each node filters the
+		whole batch at once, by the process_many of its filter if it has one.
+		"""
+		out = []
+		self._run(self.root, [as_record(r) for r in records], source, out)
+		return out
+
+	def _run(self, node, records, source, out):
+		if node.cfg is not None:
+			records = process_batch(node.get_filter(source), records)
+			if not records:
+				return
+		for writer in node.writers:
+			out += [(writer, record) for record in records]
+		if node.tiers:
+			rollup = node.get_rollup(source, self.rollup_cfg)
+			completed = {}
+			for record in records:
+				for res, rec in rollup.put(record):
+					completed.setdefault(res, []).append(rec)
+			for res, recs in completed.items():
+				self._run(node.tiers[res], recs, source, out)
+		children = list(node.children.values())
+		for i, child in enumerate(children):
+			# filters may change a record in place, which must not affect other branches
+			shared = node.writers or node.tiers or i < len(children)-1
+			self._run(child, [r.copy() for r in records] if shared else records, source, out)
+
+	def flush(self):
+		"(writer, record, source) of all pending rollups, e.g. at shutdown"
+		out = []
+		self._flush(self.root, out)
+		return out
+
+	def _flush(self, node, out):
+		for source, rollup in node._rollups.items():
+			for res, rec in rollup.flush():
+				res_out = []
+				self._run(node.tiers[res], [rec], source, res_out)
+				out += [(writer, r, source) for writer, r in res_out]
+		for tier in node.tiers.values():
+			self._flush(tier, out)
+		for child in node.children.values():
+			self._flush(child, out)
+
+	def rollup_stats(self):
+		stats = {}
+		def collect(node):
+			for source, rollup in node._rollups.items():
+				stats[source] = rollup.metrics
+			for n in list(node.tiers.values()) + list(node.children.values()):
+				collect(n)
+		collect(self.root)
+		return stats
+
+	def describe(self):
+		return '\n'.join(self.root.describe())
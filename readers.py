@@ -1,20 +1,62 @@
-import io, json, asyncio, logging, sys, re
+import io, json, asyncio, logging, sys, time, random
 from datetime import datetime
 import serial
-from bleak import BleakClient, BleakError
-from utils import getObserver, get_serial_if_fname
+from bleak import BleakClient, BleakError, BleakScanner
+from utils import getObserver, observers, find_serial_port, device_registry, NoSerialInterfaceFoundError
 from parsers import *
+from transport import SerialTransport
+from capture import CaptureWriter, ReplayTransport
+from record import Record, as_record
 
 logger = logging.getLogger(__name__)
 
 class DataLogger:
+	"""
+	Without tty the serial interface is looked up by the USB_ID of the adapter and optionally 
+	its serial_number or the usb_path of the port it is plugged into (see utils.DeviceRegistry).
+	
+	capture names a file, to which all raw data is recorded. With replay set to a capture file
+	the reader reads the capture instead of the serial interface, in real time or speed times 
+	faster. speed = 0 replays as fast as possible.
+	
+	If the interface gets lost, read_forever reconnects after exponentially growing delays 
+	starting with backoff and limited to max_backoff seconds, or as soon as the adapter has 
+	been plugged in again.
+	"""
+	# Errors indicating a lost interface, upon which read_forever reconnects
+	CONNECTION_ERRORS = (serial.SerialException, OSError, NoSerialInterfaceFoundError)
+	USB_ID = None	# (vendor id, product id) of the USB serial adapter
+	BAUDRATE = 9600
+	# Should be shorter than the time gap between 2 messages and longer
+	# than the time gap between 2 bytes to discern messages this way 
+	IDLE = 0.1
 
-	def __init__( self, tty, **kwargs):
+	def __init__( self, tty=None, serial_number=None, usb_path=None, capture=None, replay=None, speed=1.0, 
+			backoff=1.0, max_backoff=60.0, **kwargs):
+		self.device_id = None
+		if replay:
+			tty = tty or replay
+		elif not tty and self.USB_ID:
+			vid, pid = self.USB_ID
+			self.device_id = dict(vid=vid, pid=pid, serial_number=serial_number, usb_path=usb_path)
+			# the port is only known after connect, which claims it (see utils.DeviceRegistry)
+			tty = f'usb:{vid:04x}:{pid:04x}' + (f':{serial_number or usb_path}' if serial_number or usb_path else '')
+			tty += f'#{sum(1 for name in observers if name.split("#")[0] == tty)}'	# identical adapters
 		self.no_lines = 1
 		self.name = tty
+		self.port = None if self.device_id else tty
 		self.observer = getObserver(tty)
 		self.onread = self.observer.register	# allow registering with @onread!
 		self.has_started_logging = False
+		self.capture = capture
+		self.replay = replay
+		self.speed = speed
+		self.backoff = backoff
+		self.max_backoff = max_backoff
+		self.metrics = dict(reconnects=0, downtime=0.0, connected=False, last_error=None)
+		self._capture = None
+		self._transport = None
+		self._uart = None
 
 	def __enter__(self):
 		self.connect()
@@ -25,15 +67,50 @@ class DataLogger:
 		
 	def connect(self):
 		logger.debug(f"Connecting to {self.name}...")
-		self._uart = serial.Serial( self.name )
-		# Should be shorter than the time gap between 2 messages and longer
-		# than the time gap between 2 bytes to discern messages this way 
-		self._uart.timeout = 0.1 
-		self.flush_input()
+		if self.replay:
+			self._transport = ReplayTransport(self.replay, speed=self.speed, idle=self.IDLE)
+			logger.info(f"Replaying {self.replay}")
+			return
+		if self.device_id:
+			self._open_device()
+		else:
+			self._uart = serial.Serial( self.port, baudrate=self.BAUDRATE, exclusive=True )
+		try:
+			if self.capture:
+				self._capture = CaptureWriter(self.capture)
+			self._transport = SerialTransport(self._uart, idle=self.IDLE, capture=self._capture)
+			self.flush_input()
+		except Exception:
+			self.disconnect()
+			raise
 		logger.info("Data logger is connected!")
+
+	def _open_device(self):
+		"Open the first matching adapter, which no other process has locked"
+		device_registry.watch()
+		locked = []
+		while True:
+			# the port may have changed after a re-enumeration
+			self.port = find_serial_port(owner=self, exclude=locked, **self.device_id)
+			try:
+				self._uart = serial.Serial( self.port, baudrate=self.BAUDRATE, exclusive=True )
+				return
+			except serial.SerialException as e:
+				device_registry.release(self)
+				locked.append(self.port)
+				logger.info(f'Serial interface {self.port} is busy: {e}')
 	
 	def disconnect(self):
-		self._uart.close()
+		if self._transport:
+			self._transport.close()
+		if self._uart:
+			self._uart.close()
+		if self._capture:
+			self._capture.close()
+		self._transport = self._uart = self._capture = None
+		if self.device_id:
+			# the adapter may come back under another port, which connect claims anew
+			device_registry.release(self)
 		logger.info(f"Disconnected reader from {self.name}")
 		
 	def run(self,fun,**kwargs):
@@ -44,7 +121,7 @@ class DataLogger:
 			sys.exit(2)
 	
 	def flush_input(self):
-		self._uart.flushInput()
+		self._transport.flush_input()
 	
 	def _has_started_logging(self, word):
 		if self.has_started_logging:
@@ -54,21 +131,19 @@ class DataLogger:
 			return True
 		return False
 
-	def readline(self):
-		j = b''
-		# Assume, timeout allows for discerning messages
-		while not j: 
-			j = self._uart.readline()
+	async def readline(self):
+		# Assume, the idle time allows for discerning messages
+		j = await self._transport.readline()
 		logger.debug(j)
 		return j.decode('ascii')
 
-	def readlines(self):
+	async def readlines(self):
 		"""
 		Generator in case a complete dataset is formed by multiple lines
 		"""		
 		n = 0
 		while n < self.no_lines:
-			w = self.readline()
+			w = await self.readline()
 			if not w:
 				continue
 			if self._has_started_logging(w):
@@ -77,33 +152,82 @@ class DataLogger:
 			else:
 				continue
 	
-	async def read_forever(self):
-		with self:
+	def new_message(self, record=None):
+		"""
+		Stamp a record or start a new message dict. The timestamp is the arrival time of the 
+		latest data, if the transport knows it.
+		"""
+		timestamp = round((self._transport and self._transport.timestamp or datetime.now().timestamp())*1000)
+		if record is not None:
+			record.values[0] = timestamp
+			return record
+		return dict(timestamp=dict(value=timestamp,unit='msec'))
+
+	async def read_datasets(self):
+		"""
+		Async generator of complete records. If the parser has a decode method, the raw byte
+		stream is fed to it, otherwise datasets are parsed line by line.
+		"""
+		if hasattr(self._parser, 'decode'):
 			while True:
-				msg = dict(timestamp=dict(value=round(datetime.now().timestamp()*1000),unit='msec'))
-#				try:
-				if self.no_lines == 1:
-					line = self.readline()
-					logger.debug(f'Read {line} from {self.name}')
+				data = await self._transport.read()
+				for record in self._parser.decode(data):
+					yield self.new_message(record)
+		while True:
+			msg = self.new_message()
+#			try:
+			if self.no_lines == 1:
+				line = await self.readline()
+				logger.debug(f'Read {line} from {self.name}')
+				res = self._parser.parse_word(line)
+				if isinstance(res, Record):
+					yield self.new_message(res)
+					continue
+				msg.update(res)
+			else:
+				lines = self.readlines()
+				async for line in lines:
 					msg.update(self._parser.parse_word(line))
-				else:
-					lines = self.readlines()
-					for line in lines:
-						msg.update(self._parser.parse_word(line))
-				self.observer.notify(message=msg)
-				logger.debug('Notified observer!')
-#				except ValueError as e:
-#					logger.error(e)
-#					continue
-#				except asyncio.CancelledError:
-#					logger.error('Process interrupted')
-#					break
-#				except KeyboardInterrupt:
-#					logger.error('Process interrupted')
-#					break
-#				except Exception as e:
-#					logger.error(e)
-#					continue
+			yield as_record(msg, self.name)
+#			except ValueError as e:
+#				logger.error(e)
+#				continue
+
+	async def read_forever(self):
+		attempt = 0
+		lost = None
+		while True:
+			try:
+				with self:
+					if lost:
+						self.metrics['downtime'] += time.monotonic() - lost
+						self.metrics['reconnects'] += 1
+						logger.info(f'Reconnected to {self.port} after {time.monotonic() - lost:.1f} s')
+					self.metrics['connected'] = True
+					attempt, lost = 0, None
+					async for msg in self.read_datasets():
+						await self.observer.anotify(message=msg)
+						logger.debug('Notified observer!')
+			except EOFError as e:
+				logger.info(e)
+				return
+			except self.CONNECTION_ERRORS as e:
+				if self.replay:
+					raise
+				self.metrics['connected'] = False
+				self.metrics['last_error'] = str(e)
+				lost = lost or time.monotonic()
+				delay = min(self.max_backoff, self.backoff*2**attempt)*random.uniform(0.5,1)
+				attempt += 1
+				logger.error(f'Lost {self.name}: {e}. Reconnecting in {delay:.1f} s...')
+				await self.wait_for_device(delay)
+
+	async def wait_for_device(self, timeout):
+		"Sleep timeout seconds, but wake up earlier when a serial adapter has been plugged in"
+		if self.device_id:
+			await device_registry.wait_for_change(timeout)
+		else:
+			await asyncio.sleep(timeout)
 
 ##############################################################################################
 # T e s t L o g g e r
@@ -113,34 +237,29 @@ class TestLogger(DataLogger):
 		self._parser = Parser()
 		self._uart = io.StringIO('Nur ein Test')
 	
-	def readline(self):
+	async def readline(self):
+		await asyncio.sleep(0)	# be cooperative to other readers on the loop
 		return self._uart.readline()
 
 ##############################################################################################
 # P C E A Q D 2 0 
-pat_PCEAQD20 = re.compile('FTDI USB Serial Device converter now attached to (ttyUSB\d)')
-
 class PCEAQD20(DataLogger):
 
+	USB_ID = (0x0403, 0x6001)	# FTDI USB serial converter
+	IDLE = 0.5
+
 	def __init__(self, tty = None, **kwargs):
-		tty = get_serial_if_fname(pat_PCEAQD20)
 		super().__init__(tty,**kwargs)
 		self.no_lines = 5
 		self._parser = PCEAQD20Parser()
-
-	def connect(self):
-		super().connect()
-		self._uart.timeout = 0.5
-		self._sio = io.BufferedReader(self._uart)
 	
-	def readline(self):
-		j = self._sio.readline(16)
+	async def readline(self):
+		j = await self._transport.readline(limit=16)
 		logger.debug(f"Read {j} from interface {self.name}")
 		return j.decode('ascii')
 
 ##############################################################################################
 # P l a n t o w e r 
-pat_plantower = re.compile('ch341-uart converter now attached to (ttyUSB\d)')
 class Plantower(DataLogger):
 	"""
 	Unfortunately the interface of the underlying
@@ -151,30 +270,52 @@ class Plantower(DataLogger):
 	the client. The sensor itself is well documented.
 	"""
 
+	USB_ID = (0x1a86, 0x7523)	# ch341-uart converter
+	BAUDRATE = 115200
+
 	def __init__(self,tty = None,**kwargs):
-		tty = get_serial_if_fname(pat_plantower)
 		super().__init__(tty,**kwargs)
 		self._parser = PlantowerParser()
 		
 	def connect(self):
 		super().connect()
-		self._uart.baudrate = 115200
-		self._uart.timeout = 0.1
 		self.start_sending()
 	
 	def disconnect(self):
-		self.stop_sending()
+		try:
+			self.stop_sending()
+		except self.CONNECTION_ERRORS as e:
+			logger.warning(f'Could not stop sending: {e}')
 		super().disconnect( )
 		
 	def start_sending(self):
-		return self._uart.write(b'{"fun":"05","flag":"1"}')
+		return self._transport.write(b'{"fun":"05","flag":"1"}')
 
 	def stop_sending(self):
-		return self._uart.write(b'{"fun":"05","flag":"0"}')
+		return self._transport.write(b'{"fun":"05","flag":"0"}')
 		
-	def get_config(self):
-		self._uart.write(b'{"fun":"80"}')
-		return self.readline()
+	async def get_config(self):
+		self._transport.write(b'{"fun":"80"}')
+		return await self.readline()
+
+##############################################################################################
+# P M S 5 0 0 3 
+class PMS5003(DataLogger):
+	"""
+	Reads the native binary protocol of a Plantower PMS5003 connected by a plain USB-UART 
+	adapter. The sensor is switched to active mode, in which it sends a frame whenever a 
+	new measurement is available.
+	"""
+	USB_ID = (0x1a86, 0x7523)	# ch341-uart converter
+	CMD_ACTIVE_MODE = bytes([0x42,0x4d,0xe1,0x00,0x01,0x01,0x71])
+
+	def __init__(self,tty = None,with_counts=False,**kwargs):
+		super().__init__(tty,**kwargs)
+		self._parser = PMS5003Parser(with_counts=with_counts)
+
+	def connect(self):
+		super().connect()
+		self._transport.write(self.CMD_ACTIVE_MODE)
 
 ##############################################################################################
 # B l u e t o o t h L o g g e r 
@@ -195,15 +336,21 @@ class BluetoothLogger(DataLogger):
 	async def __exit__(self, err_type, err_val,err_trace):
 		await self.disconnect()
 		
-	def __init__(self, identifier, uuid, is_characteristic = False):
+	def __init__(self, identifier, uuid, is_characteristic = False, capture=None, replay=None, speed=1.0):
 		self.name = identifier
 		self.observer = getObserver(identifier)
 		self.onread = self.observer.register	# allow registering with @onread!
-		self.ble = BleakClient(identifier)
+		self.disconnected = asyncio.Event()
+		self.ble = BleakClient(identifier, disconnected_callback=self._on_disconnect)
 		self.uuid = uuid
 		if is_characteristic:
 			self.characteristic = uuid 
 		self.line={}
+		self.capture = capture
+		self.replay = replay
+		self.speed = speed
+		self.metrics = dict(reconnects=0, downtime=0.0, connected=False, last_error=None)
+		self._capture = None
 		
 	async def connect(self):
 		try:
@@ -218,32 +365,218 @@ class BluetoothLogger(DataLogger):
 		raise NotImplementedError
 
 	async def read_forever(self):
-		logger.info(f"Connecting to BluetoothLogger {self.name}...")
-		async with self.ble as client:
-			logger.info(f"Connected to BluetoothLogger {self.name}.")
-			await client.start_notify(self.characteristic, self.handle_data)
+		"""
+		The connection is kept by the BluetoothManager ble_manager, which is shared by all
+		bluetooth readers of the process.
+		"""
+		if self.replay:
+			return await self.replay_forever()
+		if self.capture:
+			self._capture = CaptureWriter(self.capture)
+		try:
+			await ble_manager.keep_connected(self)
+		finally:
+			if self._capture:
+				self._capture.close()
+	
+	def _on_disconnect(self, client):
+		self.disconnected.set()
+	
+	async def replay_forever(self):
+		"Feed the recorded notifications of self.replay to handle_data"
+		transport = ReplayTransport(self.replay, speed=self.speed)
+		try:
 			while True:
-				try:
-					await asyncio.sleep(60)
-				except KeyboardInterrupt:
-					break
-				except asyncio.CancelledError:
-					break
-			logger.info('BluetoothLogger has been disconnected')
-	
-	def handle_data(self,sender,data):
-		msg = self._parser.parse(data)			
+				data = await transport.read()
+				self.handle_data(None, data, transport.timestamp)
+		except EOFError as e:
+			logger.info(e)
+	
+	def handle_data(self,sender,data,timestamp=None):
+		if self._capture:
+			self._capture.write(data)
+		msg = self._parser.parse(data, timestamp)			
 		self.observer.notify(message=msg)
 	
 	async def disconnect(self):
 		await self.ble.disconnect()
 		logger.info('Bluetooth data logger is disconnected!')
 		
+##############################################################################################
+# B l u e t o o t h M a n a g e r
+class BluetoothManager:
+	"""
+	Keeps the connections of many BluetoothLoggers on one event loop. Notifications of all
+	devices run concurrently, but connection attempts are limited to max_connects at a time, 
+	as the adapter handles only few concurrent connects. Dropped devices are reconnected after
+	exponentially growing delays from backoff to max_backoff seconds.
+	"""
+	
+	def __init__(self, max_connects=2, timeout=20.0, backoff=1.0, max_backoff=60.0):
+		self.configure(max_connects, timeout, backoff, max_backoff)
+		self._connects = None
+		self._devices = {}
+	
+	def configure(self, max_connects=2, timeout=20.0, backoff=1.0, max_backoff=60.0):
+		self.max_connects = max_connects
+		self.timeout = timeout
+		self.backoff = backoff
+		self.max_backoff = max_backoff
+	
+	async def _connect(self, reader):
+		"Connect and start the notifications, limited to max_connects concurrent attempts"
+		if self._connects is None:
+			self._connects = asyncio.Semaphore(self.max_connects)
+		async with self._connects:
+			logger.info(f"Connecting to BluetoothLogger {reader.name}...")
+			reader.disconnected.clear()
+			await asyncio.wait_for(reader.ble.connect(), self.timeout)
+			await reader.ble.start_notify(reader.characteristic, reader.handle_data)
+			logger.info(f"Connected to BluetoothLogger {reader.name}.")
+	
+	async def keep_connected(self, reader):
+		self._devices[reader.name] = reader
+		metrics = reader.metrics
+		attempt = 0
+		lost = None
+		try:
+			while True:
+				try:
+					await self._connect(reader)
+					if lost:
+						metrics['downtime'] += time.monotonic() - lost
+						metrics['reconnects'] += 1
+					metrics['connected'] = True
+					attempt, lost = 0, None
+					await reader.disconnected.wait()
+					logger.warning(f'BluetoothLogger {reader.name} has been disconnected')
+				except (BleakError, asyncio.TimeoutError, OSError) as e:
+					metrics['last_error'] = str(e) or repr(e)
+					logger.error(f'Could not connect to {reader.name}: {metrics["last_error"]}')
+					await self._disconnect(reader)
+				metrics['connected'] = False
+				lost = lost or time.monotonic()
+				delay = min(self.max_backoff, self.backoff*2**attempt)*random.uniform(0.5,1)
+				attempt += 1
+				await asyncio.sleep(delay)
+		finally:
+			del self._devices[reader.name]
+			await self._disconnect(reader)
+	
+	async def _disconnect(self, reader):
+		try:
+			await reader.ble.disconnect()
+		except Exception as e:
+			logger.debug(f'Disconnecting {reader.name} failed: {e}')
+	
+	def get_stats(self):
+		return {name:reader.metrics for name,reader in self._devices.items()}
+
+ble_manager = BluetoothManager()
+
 ##############################################################################################
 # X i a o m i M i T e m p e r a t u r e L o g g e r
 class XiaomiMiTemperatureLogger(BluetoothLogger):
 	
-	def __init__(self, identifier, uuid, is_characteristic = False):
-		super().__init__(identifier, uuid, is_characteristic)
+	def __init__(self, identifier, uuid, is_characteristic = False, **kwargs):
+		super().__init__(identifier, uuid, is_characteristic, **kwargs)
+		self._parser = XiaomiMiTemperatureLoggerParser()
+
+##############################################################################################
+# X i a o m i M i A d v e r t i s e m e n t L o g g e r
+class XiaomiMiAdvertisementLogger:
+	"""
+	Passive alternative to XiaomiMiTemperatureLogger for thermometers running a custom firmware,
+	which broadcasts the readings as service data. A single scanner serves any number of 
+	thermometers without connections, limited to the given devices if any. Repeated adverts 
+	of the same reading are dropped. Each message carries the device address in event.device.
+	"""
+	SERVICE_UUID = '0000181a-0000-1000-8000-00805f9b34fb'
+	
+	def __init__(self, identifier='xiaomi_advertisements', devices=None, capture=None, replay=None, speed=1.0):
+		self.name = identifier
+		self.observer = getObserver(identifier)
+		self.onread = self.observer.register	# allow registering with @onread!
+		self.devices = {d.upper() for d in devices} if devices else None
+		self.capture = capture
+		self.replay = replay
+		self.speed = speed
+		self.metrics = dict(adverts=0, duplicates=0, devices=0)
 		self._parser = XiaomiMiTemperatureLoggerParser()
+		self._last = {}
+		self._capture = None
+	
+	async def read_forever(self):
+		if self.replay:
+			return await self.replay_forever()
+		if self.capture:
+			self._capture = CaptureWriter(self.capture)
+		scanner = BleakScanner(detection_callback=self.handle_advertisement, service_uuids=[self.SERVICE_UUID])
+		await scanner.start()
+		logger.info(f'Scanning for advertisements of {self.devices or "all thermometers"}...')
+		try:
+			await asyncio.Event().wait()
+		finally:
+			await scanner.stop()
+			if self._capture:
+				self._capture.close()
+	
+	async def replay_forever(self):
+		"A record of the capture is the 6 byte device address followed by the service data"
+		transport = ReplayTransport(self.replay, speed=self.speed)
+		try:
+			while True:
+				data = await transport.read()
+				address = ':'.join(f'{b:02X}' for b in data[:6])
+				self.handle_data(address, data[6:], transport.timestamp)
+		except EOFError as e:
+			logger.info(e)
+	
+	def handle_advertisement(self, device, advertisement_data):
+		data = advertisement_data.service_data.get(self.SERVICE_UUID)
+		if data and (self.devices is None or device.address.upper() in self.devices):
+			self.handle_data(device.address.upper(), data)
+	
+	def handle_data(self, address, data, timestamp=None):
+		self.metrics['adverts'] += 1
+		if self._last.get(address) == data:
+			self.metrics['duplicates'] += 1
+			return
+		self._last[address] = data
+		self.metrics['devices'] = len(self._last)
+		if self._capture:
+			self._capture.write(bytes.fromhex(address.replace(':','')) + data)
+		try:
+			msg = self._parser.parse_advertisement(data, timestamp)
+		except ValueError as e:
+			logger.warning(f'{address}: {e}')
+			return
+		self.observer.notify(message=msg, device=address)
 
+class SharedMemoryReader:
+	"""
+	Reads the records published by a writers.SharedMemoryWriter of another process. Every
+	process reading the same ring must have its own consumer number. The source of each
+	message is the source in the publishing process. The ring is polled every poll seconds.
+	"""
+	
+	def __init__(self, ring_name, consumer=0, poll=0.05, identifier=None):
+		from shm import RingConsumer
+		self.name = identifier or f'{ring_name}/{consumer}'
+		self.observer = getObserver(self.name)
+		self.onread = self.observer.register	# allow registering with @onread!
+		self.poll = poll
+		self._ring = RingConsumer(ring_name, consumer)
+		self.metrics = self._ring.metrics
+	
+	async def read_forever(self):
+		logger.info(f'Reading ring buffer {self._ring.name} as consumer {self._ring.consumer}')
+		try:
+			while True:
+				batch = self._ring.read(limit=1000)
+				for record, source in batch:
+					await self.observer.anotify(message=record, device=source)
+				if len(batch) < 1000:
+					await asyncio.sleep(self.poll)
+		finally:
+			self._ring.close()
@@ -0,0 +1,121 @@
+################################################################################################
+# Readings travel through the pipeline as Records: the values of one dataset in a list plus a
+# reference to the Schema of the sensor, which holds field names and units once. The first field
+# of every schema is the timestamp in msec.
+#
+# A Record can be read like a dict of values (record['pm25'], keys(), items()). as_dict() gives
+# the traditional {name: {value, unit}} form, as_record() converts such dicts into records.
+################################################################################################
+import logging
+
+logger = logging.getLogger(__name__)
+
+class Schema:
+	__slots__ = ('name','fields','units','index')
+
+	def __init__(self, name, fields):
+		"fields is a sequence of (name, unit) pairs"
+		self.name = name
+		self.fields = tuple(f for f,u in fields)
+		self.units = tuple(u for f,u in fields)
+		self.index = {f:i for i,f in enumerate(self.fields)}
+
+	def record(self, values=None):
+		"A new record with the given values or all values None"
+		return Record(self, list(values) if values is not None else [None]*len(self.fields))
+
+	def unit(self, name):
+		return self.units[self.index[name]]
+
+	def items(self):
+		"(name, unit) pairs"
+		return zip(self.fields, self.units)
+
+	def __len__(self):
+		return len(self.fields)
+
+	def __repr__(self):
+		return f'Schema({self.name}, {list(self.items())})'
+
+class Record:
+	__slots__ = ('schema','values')
+
+	def __init__(self, schema, values):
+		self.schema = schema
+		self.values = values
+
+	def __getitem__(self, name):
+		return self.values[self.schema.index[name]]
+
+	def __setitem__(self, name, value):
+		self.values[self.schema.index[name]] = value
+
+	def get(self, name, default=None):
+		i = self.schema.index.get(name)
+		return default if i is None else self.values[i]
+
+	def __contains__(self, name):
+		return name in self.schema.index
+
+	def __iter__(self):
+		return iter(self.schema.fields)
+
+	def __len__(self):
+		return len(self.values)
+
+	def __eq__(self, other):
+		return isinstance(other, Record) and self.schema.fields == other.schema.fields and self.values == other.values
+
+	def keys(self):
+		return self.schema.fields
+
+	def items(self):
+		"(name, value) pairs"
+		return zip(self.schema.fields, self.values)
+
+	def unit(self, name):
+		return self.schema.unit(name)
+
+	@property
+	def timestamp(self):
+		return self.values[0]
+
+	def copy(self):
+		return Record(self.schema, list(self.values))
+
+	def as_values(self):
+		"{name: value}"
+		return dict(zip(self.schema.fields, self.values))
+
+	def as_dict(self):
+		"{name: {value, unit}}, the message format of former versions"
+		return {f:dict(value=v, unit=u) for f,u,v in zip(self.schema.fields, self.schema.units, self.values)}
+
+	def __repr__(self):
+		return f'Record({self.schema.name}, {self.as_values()})'
+
+_schemas = {}
+
+def getSchema(name, fields):
+	"Lazily initialize a Schema, such records of equal layout share one"
+	key = (name, tuple(fields))
+	if key not in _schemas:
+		_schemas[key] = Schema(name, fields)
+	return _schemas[key]
+
+def as_record(message, name=None):
+	"""
+	Convert a dict of {value, unit} dicts or of plain values into a Record. Records are passed
+	through unchanged.
+	"""
+	if isinstance(message, Record) or message is None:
+		return message
+	fields, values = [], []
+	for k,v in message.items():
+		if isinstance(v, dict):
+			fields.append((k, v.get('unit')))
+			values.append(v.get('value'))
+		else:
+			fields.append((k, 'msec' if k == 'timestamp' else None))
+			values.append(v)
+	return Record(getSchema(name, fields), values)
@@ -0,0 +1,197 @@
+################################################################################################
+# Plausibility rules. A rule applies to one field, or with field "*" to all fields without a rule
+# of the same kind, and is one of
+#
+#	range: [low, high]		static limits, either may be null
+#	rate: limit			maximum change per second against the last accepted value
+#	hampel: {window: 7, k: 3}	outlier, if farther than k scaled MADs from the median of
+#					the last window accepted values
+#
+# Rules are compiled once per schema into vectors over the fields. Failing fields are masked
+# with None, the record is only dropped, if no measurement is left. Each rule counts its
+# rejections in counters.
+################################################################################################
+import logging, warnings
+import numpy as np
+from record import as_record
+
+logger = logging.getLogger(__name__)
+
+KINDS = ('range','rate','hampel')
+MAD_SCALE = 1.4826	# MAD of a normal distribution to its standard deviation
+
+DEFAULT_RULES = (
+	dict(field='temperature', range=[-30, 80]),
+	dict(field='pressure', range=[800, 1200]),
+	dict(field='humidity', range=[0, 100]),
+	dict(field='*', range=[0, None]),
+)
+
+class _Compiled:
+	"The rules as vectors over the fields of one schema"
+
+	def __init__(self, schema, rules):
+		n = len(schema)
+		self.low = np.full(n, -np.inf)
+		self.high = np.full(n, np.inf)
+		self.rate = np.full(n, np.inf)
+		self.names = {kind:[None]*n for kind in KINDS}	# rule name of each field, for the counters
+		hampel = {}
+		for kind in KINDS:
+			explicit = {r['field'] for r in rules if kind in r}
+			for rule in rules:
+				if kind not in rule:
+					continue
+				fields = [f for f in schema.fields[1:] if f not in explicit] if rule['field'] == '*' else [rule['field']]
+				for f in fields:
+					if f not in schema.index:
+						continue
+					j = schema.index[f]
+					self.names[kind][j] = f'{kind}:{rule["field"]}'
+					if kind == 'range':
+						low, high = rule['range']
+						self.low[j] = -np.inf if low is None else low
+						self.high[j] = np.inf if high is None else high
+					elif kind == 'rate':
+						self.rate[j] = rule['rate']
+					else:
+						hampel[j] = dict(dict(window=7, k=3), **rule['hampel'])
+		self.has_rate = np.isfinite(self.rate).any()
+		# hampel fields are grouped by window size, such each group is one ring buffer
+		self.hampel = []
+		for window in sorted({h['window'] for h in hampel.values()}):
+			fields = np.array([j for j,h in hampel.items() if h['window'] == window])
+			k = np.array([hampel[j]['k'] for j in fields], dtype=float)
+			self.hampel.append(_HampelGroup(fields, window, k))
+		self.last = np.full(n, np.nan)	# last accepted value
+		self.last_ts = np.full(n, np.nan)
+
+class _HampelGroup:
+	"Ring buffer of the last accepted values of fields with the same window"
+
+	def __init__(self, fields, window, k):
+		self.fields = fields
+		self.k = k
+		self.buffer = np.full((window, len(fields)), np.nan)
+		self.pos = 0
+
+	def check(self, values):
+		"Boolean mask of outliers among values[fields]. Needs half a window of history."
+		v = values[self.fields]
+		filled = np.count_nonzero(~np.isnan(self.buffer), axis=0)
+		if filled.min() == len(self.buffer):
+			median = np.median(self.buffer, axis=0)
+			mad = MAD_SCALE*np.median(np.abs(self.buffer - median), axis=0)
+			return (np.abs(v - median) > self.k*mad) & (mad > 0)
+		with warnings.catch_warnings(), np.errstate(invalid='ignore'):
+			warnings.simplefilter('ignore', RuntimeWarning)	# fields without history
+			median = np.nanmedian(self.buffer, axis=0)
+			mad = MAD_SCALE*np.nanmedian(np.abs(self.buffer - median), axis=0)
+			return (filled >= len(self.buffer)//2) & (np.abs(v - median) > self.k*mad) & (mad > 0)
+
+	def accept(self, values, ok):
+		row = self.buffer[self.pos]
+		row[:] = np.nan
+		np.copyto(row, values[self.fields], where=ok[self.fields])
+		self.pos = (self.pos + 1) % len(self.buffer)
+
+class RuleEngine:
+	"""
+	Filter masking implausible values by rules, a list of dicts as described above, e.g. from
+	the yaml configuration. Configured as a filter it replaces the default PlausiChecker.
+	"""
+
+	def __init__(self, rules=DEFAULT_RULES):
+		self.rules = [dict(r) for r in rules]
+		for rule in self.rules:
+			if 'field' not in rule or not any(kind in rule for kind in KINDS):
+				raise ValueError(f'Invalid rule {rule}. A rule needs a field and one of {KINDS}')
+		self._compiled = {}
+		self.counters = {}
+		self.masked = 0
+		self.dropped = 0
+
+	def compile(self, schema):
+		"Lazily compile the rules for schema"
+		if schema not in self._compiled:
+			self._compiled[schema] = _Compiled(schema, self.rules)
+		return self._compiled[schema]
+
+	def _count(self, c, kind, mask):
+		for j in np.flatnonzero(mask):
+			name = c.names[kind][j]
+			if name not in self.counters:
+				logger.warning(f'Rule {name} rejected a value for the first time')
+			self.counters[name] = self.counters.get(name, 0) + 1
+
+	def check(self, c, values, ts):
+		"Boolean mask of the acceptable values of one record, updating the state of the rules"
+		with np.errstate(invalid='ignore'):
+			bad = (values < c.low) | (values > c.high)
+		self._count(c, 'range', bad)
+		if c.has_rate and ts is not None:
+			with np.errstate(invalid='ignore', divide='ignore'):
+				dt = (ts - c.last_ts)/1000
+				fast = ~bad & (np.abs(values - c.last)/dt > c.rate)
+			self._count(c, 'rate', fast)
+			bad |= fast
+		for group in c.hampel:
+			outliers = np.zeros(len(values), dtype=bool)
+			outliers[group.fields] = group.check(values) & ~bad[group.fields]
+			self._count(c, 'hampel', outliers)
+			bad |= outliers
+		ok = ~bad & ~np.isnan(values)
+		ok[0] = True	# the timestamp
+		for group in c.hampel:
+			group.accept(values, ok)
+		np.copyto(c.last, values, where=ok)
+		if ts is not None:
+			c.last_ts[ok] = ts
+		return ok
+
+	def _apply(self, record, ok):
+		"Mask the values of record failing the rules. Returns None if no measurement is left."
+		for j in np.flatnonzero(~ok):
+			if record.values[j] is not None:
+				record.values[j] = None
+				self.masked += 1
+		if all(v is None for v in record.values[1:]):
+			self.dropped += 1
+			logger.debug(f'Discarded dataset {record} without plausible values')
+			return None
+		return record
+
+	def process(self, dataset):
+		record = as_record(dataset)
+		c = self.compile(record.schema)
+		values = np.array([np.nan if v is None else v for v in record.values], dtype=float)
+		return self._apply(record, self.check(c, values, record.timestamp))
+
+	def process_many(self, records):
+		"""
+		Check a batch of records at once. The static ranges are evaluated over the whole batch,
+		the stateful rules record by record. Returns the records with plausible values left.
+		"""
+		records = [as_record(r) for r in records]
+		oks = [None]*len(records)
+		for schema in {r.schema for r in records}:
+			c = self.compile(schema)
+			index = [i for i,r in enumerate(records) if r.schema is schema]
+			values = np.array([[np.nan if v is None else v for v in records[i].values] for i in index], dtype=float)
+			if c.has_rate or c.hampel:
+				for i, row in zip(index, values):
+					oks[i] = self.check(c, row, records[i].timestamp)
+				continue
+			with np.errstate(invalid='ignore'):
+				bad = (values < c.low) | (values > c.high)
+			for j in np.flatnonzero(bad.any(axis=0)):
+				name = c.names['range'][j]
+				self.counters[name] = self.counters.get(name, 0) + int(bad[:,j].sum())
+			ok = ~bad & ~np.isnan(values)
+			ok[:,0] = True
+			for i, row in zip(index, ok):
+				oks[i] = row
+		return [r for r in (self._apply(r, ok) for r, ok in zip(records, oks)) if r is not None]
+
+	def stats(self):
+		return dict(rejected=dict(self.counters), masked=self.masked, dropped=self.dropped)
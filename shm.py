@@ -0,0 +1,247 @@
+################################################################################################
+# Fan out records to other processes through a ring buffer in shared memory. One publisher
+# writes, any number of consumer processes read at their own pace, such the CPU work of their
+# writers does not share the reader's GIL and the serial port is read once.
+#
+#	header		magic, number of slots, values per slot, last sequence number, meta version,
+#			meta length, process id of the publisher
+#	cursors		next sequence number of each consumer, 0 if unused
+#	meta		json list of the schemas and sources referred to by the slots
+#	slots		sequence number, schema, source, number of values, values as float64
+#
+# Sequence numbers start with 1. The publisher zeroes the sequence number of a slot before
+# overwriting it and sets it afterwards, such a consumer can tell a consistent slot from one
+# being overwritten. A consumer, which fell behind by more than the ring size, has lost the
+# overwritten records. It skips them and reports the loss, the publisher reports consumers
+# getting close to that.
+#
+# A segment of the same name left behind by a crashed publisher is replaced. If its publisher
+# is still running, the new publisher fails instead of cutting it off from its consumers.
+################################################################################################
+import logging, json, math, struct, os
+from multiprocessing import shared_memory
+from record import Record, getSchema
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'DLRING\x02\x00'
+HEADER = struct.Struct('<8sIIQIII')	# magic, slots, fields, write_seq, meta version, meta length, publisher pid
+CURSOR = struct.Struct('<Q')
+SLOT = struct.Struct('<QHHH2x')	# seq, schema, source, number of values
+MAX_CONSUMERS = 16
+META_SIZE = 16384
+CURSORS_OFFSET = HEADER.size
+META_OFFSET = CURSORS_OFFSET + MAX_CONSUMERS*CURSOR.size
+SLOTS_OFFSET = META_OFFSET + META_SIZE
+
+class RingOverrunError(Exception):
+	pass
+
+def _attach(name):
+	"Attach to an existing segment without handing it to the resource tracker of this process"
+	try:
+		return shared_memory.SharedMemory(name, track=False)
+	except TypeError:	# python < 3.13
+		from multiprocessing import resource_tracker
+		shm = shared_memory.SharedMemory(name)
+		resource_tracker.unregister(shm._name, 'shared_memory')
+		return shm
+
+def _publisher_alive(name):
+	"Whether the publisher, which created the existing segment name, is still running"
+	shm = _attach(name)
+	try:
+		magic, pid = (HEADER.unpack_from(shm.buf)[0], HEADER.unpack_from(shm.buf)[-1]) if shm.size >= HEADER.size else (None, 0)
+	finally:
+		shm.close()
+	if magic != MAGIC or not pid:
+		return False	# an earlier version or not initialized
+	try:
+		os.kill(pid, 0)
+	except ProcessLookupError:
+		return False
+	except PermissionError:
+		pass	# running under another user
+	return True
+
+class RingPublisher:
+	"""
+	Creates the ring buffer name with slots records of up to fields values each. A consumer
+	lagging more than warn_level (fraction of slots) behind is reported as slow.
+	"""
+
+	def __init__(self, name, slots=1024, fields=32, warn_level=0.75):
+		self.name = name
+		self.slots = slots
+		self.fields = fields
+		self.warn_level = warn_level
+		self.slot_size = SLOT.size + 8*fields
+		size = SLOTS_OFFSET + slots*self.slot_size
+		try:
+			self._shm = shared_memory.SharedMemory(name, create=True, size=size)
+		except FileExistsError:
+			if _publisher_alive(name):
+				raise FileExistsError(f'Ring buffer {name} is in use by another publisher. Choose another ring_name.')
+			# left behind by a publisher, which was not closed, e.g. after a crash
+			logger.warning(f'Replacing stale ring buffer {name}')
+			stale = shared_memory.SharedMemory(name)
+			stale.close()
+			stale.unlink()
+			self._shm = shared_memory.SharedMemory(name, create=True, size=size)
+		self._buf = self._shm.buf
+		self._pid = os.getpid()
+		self._seq = 0
+		self._schemas = {}	# Schema -> index
+		self._sources = {}
+		self._meta = dict(schemas=[], sources=[])
+		self._meta_version = 0
+		self._slow = set()
+		self.metrics = dict(published=0, slow_consumers=0)
+		self._write_header()
+		logger.info(f'Created ring buffer {name} of {slots} slots')
+
+	def _write_header(self):
+		meta = json.dumps(self._meta).encode()
+		if len(meta) > META_SIZE:
+			raise ValueError(f'Too many schemas and sources for ring buffer {self.name}')
+		self._buf[META_OFFSET:META_OFFSET+len(meta)] = meta
+		self._meta_length = len(meta)
+		HEADER.pack_into(self._buf, 0, MAGIC, self.slots, self.fields, self._seq, self._meta_version, self._meta_length, self._pid)
+
+	def _index(self, record, source):
+		"Indices of the schema and source of record, which are added to the meta data if new"
+		schema = record.schema
+		if schema not in self._schemas:
+			self._schemas[schema] = len(self._meta['schemas'])
+			self._meta['schemas'].append([schema.name, list(schema.fields), list(schema.units)])
+			self._meta_version += 1
+		if source not in self._sources:
+			self._sources[source] = len(self._meta['sources'])
+			self._meta['sources'].append(source)
+			self._meta_version += 1
+		return self._schemas[schema], self._sources[source]
+
+	def publish(self, record, source=None):
+		if len(record.values) > self.fields:
+			raise ValueError(f'{record} has more than {self.fields} values')
+		version = self._meta_version
+		schema, source = self._index(record, source)
+		if version != self._meta_version:
+			self._write_header()
+		seq = self._seq + 1
+		p = SLOTS_OFFSET + (seq-1)%self.slots*self.slot_size
+		SLOT.pack_into(self._buf, p, 0, 0, 0, 0)	# invalidate the slot while it is written
+		values = [math.nan if v is None else v for v in record.values]
+		struct.pack_into(f'<{len(values)}d', self._buf, p+SLOT.size, *values)
+		SLOT.pack_into(self._buf, p, seq, schema, source, len(values))
+		self._seq = seq
+		HEADER.pack_into(self._buf, 0, MAGIC, self.slots, self.fields, seq, self._meta_version, self._meta_length, self._pid)
+		self.metrics['published'] += 1
+		if seq % 64 == 0:
+			self.check_consumers()
+
+	def lags(self):
+		"Number of unread records of each registered consumer"
+		cursors = [CURSOR.unpack_from(self._buf, CURSORS_OFFSET + i*CURSOR.size)[0] for i in range(MAX_CONSUMERS)]
+		return {i:self._seq + 1 - c for i,c in enumerate(cursors) if c}
+
+	def check_consumers(self):
+		"Report consumers, that got slow or caught up again"
+		for i,lag in self.lags().items():
+			if lag > self.warn_level*self.slots and i not in self._slow:
+				self._slow.add(i)
+				self.metrics['slow_consumers'] += 1
+				logger.warning(f'Consumer {i} of {self.name} is {lag} records behind, {self.slots} fit into the ring')
+			elif lag <= self.warn_level*self.slots/2 and i in self._slow:
+				self._slow.discard(i)
+				logger.info(f'Consumer {i} of {self.name} caught up')
+
+	def stats(self):
+		return dict(self.metrics, seq=self._seq, lags=self.lags())
+
+	def close(self):
+		if self._shm is None:
+			return
+		self._buf = None
+		self._shm.close()
+		self._shm.unlink()
+		self._shm = None
+
+class RingConsumer:
+	"""
+	Reads the ring buffer name as consumer number consumer (0...MAX_CONSUMERS-1). Each
+	consumer process must use its own number. Reading starts with the next published record.
+	"""
+
+	def __init__(self, name, consumer=0):
+		if not 0 <= consumer < MAX_CONSUMERS:
+			raise ValueError(f'consumer must be in range(0,{MAX_CONSUMERS})')
+		self.name = name
+		self.consumer = consumer
+		self._shm = _attach(name)
+		self._buf = self._shm.buf
+		magic, self.slots, self.fields, seq, version, length, pid = HEADER.unpack_from(self._buf)
+		if magic != MAGIC:
+			raise ValueError(f'{name} is not a ring buffer')
+		self.slot_size = SLOT.size + 8*self.fields
+		self._meta_version = None
+		self._schemas, self._sources = [], []
+		self.metrics = dict(read=0, lost=0)
+		self._set_cursor(seq + 1)
+
+	def _set_cursor(self, seq):
+		self._cursor = seq
+		CURSOR.pack_into(self._buf, CURSORS_OFFSET + self.consumer*CURSOR.size, seq)
+
+	def _load_meta(self):
+		magic, slots, fields, seq, version, length, pid = HEADER.unpack_from(self._buf)
+		if version != self._meta_version:
+			meta = json.loads(bytes(self._buf[META_OFFSET:META_OFFSET+length]))
+			self._schemas = [getSchema(name, tuple(zip(fields, units))) for name,fields,units in meta['schemas']]
+			self._sources = meta['sources']
+			self._meta_version = version
+
+	def _read_slot(self, seq):
+		"Returns (record, source) or raises RingOverrunError, if the slot has been overwritten"
+		p = SLOTS_OFFSET + (seq-1)%self.slots*self.slot_size
+		s, schema, source, n = SLOT.unpack_from(self._buf, p)
+		if s != seq:
+			raise RingOverrunError(seq)
+		values = struct.unpack_from(f'<{n}d', self._buf, p+SLOT.size)
+		if SLOT.unpack_from(self._buf, p)[0] != seq:
+			raise RingOverrunError(seq)
+		if schema >= len(self._schemas) or source >= len(self._sources):
+			self._load_meta()
+		values = [None if math.isnan(v) else v for v in values]
+		if values and values[0] is not None:
+			values[0] = int(values[0])	# timestamp in msec
+		return Record(self._schemas[schema], values), self._sources[source]
+
+	def read(self, limit=None):
+		"List of (record, source) published since the last call, at most limit"
+		seq = HEADER.unpack_from(self._buf)[3]
+		if seq - self._cursor + 1 > self.slots:
+			self._skip(seq - self.slots + 1)
+		res = []
+		while self._cursor <= seq and (limit is None or len(res) < limit):
+			try:
+				res.append(self._read_slot(self._cursor))
+			except RingOverrunError:
+				self._skip(HEADER.unpack_from(self._buf)[3] - self.slots + 1)
+				continue
+			self._cursor += 1
+		self._set_cursor(self._cursor)
+		self.metrics['read'] += len(res)
+		return res
+
+	def _skip(self, seq):
+		lost = seq - self._cursor
+		self.metrics['lost'] += lost
+		logger.warning(f'Consumer {self.consumer} of {self.name} is too slow, lost {lost} records')
+		self._cursor = seq
+
+	def close(self):
+		if self._buf is not None:
+			CURSOR.pack_into(self._buf, CURSORS_OFFSET + self.consumer*CURSOR.size, 0)
+			self._buf = None
+			self._shm.close()
@@ -0,0 +1,375 @@
+################################################################################################
+# Windowed statistics in O(1) per sample. All fields of a record are kept in one preallocated
+# ring buffer of the last size samples:
+#
+#	mean, var	running sums of the values and their squares, corrected by the leaving sample
+#	min, max	monotonic deques of sample numbers per field, themselves ring buffers
+#	percentiles	histogram counts over a configured value range, interpolated within a bin
+#
+# Missing values (None, NaN) are not counted. The running sums are recomputed from the buffer
+# once per window to stop rounding errors from accumulating.
+################################################################################################
+import logging
+import numpy as np
+from record import Record, getSchema, as_record
+
+logger = logging.getLogger(__name__)
+
+STATS = ('mean','var','std','min','max','count')
+
+class WindowedStats:
+	"""
+	Statistics of nfields fields over the last size samples. histograms maps a field index
+	to (low, high, bins) of the value range, over which its percentiles are approximated.
+	"""
+
+	def __init__(self, nfields, size=30, histograms={}):
+		self.nfields = nfields
+		self.size = size
+		self._values = np.zeros((size, nfields))
+		self._valid = np.zeros((size, nfields), dtype=bool)
+		self._sum = np.zeros(nfields)
+		self._sumsq = np.zeros(nfields)
+		self._count = np.zeros(nfields, dtype=np.int64)
+		self._scratch = np.zeros(nfields)
+		self._mask = np.zeros(nfields, dtype=bool)
+		self._objects = np.empty(nfields, dtype=object)	# the pushed values, None is cast to NaN
+		# monotonic deques (k=0 min, k=1 max) of sample numbers and values per field, as plain
+		# lists, which are faster than numpy for scalar access. head and tail count the entries.
+		self._qseq = [[[0]*size for j in range(nfields)] for k in range(2)]
+		self._qval = [[[0.0]*size for j in range(nfields)] for k in range(2)]
+		self._heads = [[0]*nfields for k in range(2)]
+		self._tails = [[0]*nfields for k in range(2)]
+		self._hists = {}
+		for j,(low, high, bins) in histograms.items():
+			self._hists[j] = (low, (high-low)/bins, np.zeros(bins, dtype=np.int64), np.zeros(size, dtype=np.int64))
+		self.n = 0	# samples in the window
+		self._seq = 0	# samples pushed since the last reset
+
+	def reset(self):
+		"Empty the window without reallocating"
+		self._valid[:] = False
+		self._sum[:] = 0
+		self._sumsq[:] = 0
+		self._count[:] = 0
+		for k in range(2):
+			self._heads[k][:] = self._tails[k][:] = [0]*self.nfields
+		for low, width, counts, bins in self._hists.values():
+			counts[:] = 0
+		self.n = self._seq = 0
+
+	def is_full(self):
+		return self.n == self.size
+
+	def push(self, values):
+		"Add a sample, a sequence of nfields floats with NaN or None for missing values"
+		seq = self._seq
+		i = seq % self.size
+		row, valid = self._values[i], self._valid[i]
+		if self.n == self.size:
+			# remove the leaving sample
+			np.subtract(self._sum, row, out=self._sum, where=valid)
+			np.multiply(row, row, out=self._scratch)
+			np.subtract(self._sumsq, self._scratch, out=self._sumsq, where=valid)
+			self._count -= valid
+			for j, (low, width, counts, bins) in self._hists.items():
+				if valid[j]:
+					counts[bins[i]] -= 1
+		else:
+			self.n += 1
+		if isinstance(values, np.ndarray):
+			np.copyto(row, values)
+			source = row
+		else:
+			source = self._objects
+			source[:] = values
+			np.copyto(row, source, casting='unsafe')
+		np.isnan(row, out=self._mask)
+		np.logical_not(self._mask, out=valid)
+		np.copyto(row, 0.0, where=self._mask)
+		np.add(self._sum, row, out=self._sum, where=valid)
+		np.multiply(row, row, out=self._scratch)
+		np.add(self._sumsq, self._scratch, out=self._sumsq, where=valid)
+		self._count += valid
+		for j in range(self.nfields):
+			if valid[j]:
+				value = source[j]
+				self._push_deque(0, j, seq, value)
+				self._push_deque(1, j, seq, value)
+		for j, (low, width, counts, bins) in self._hists.items():
+			if valid[j]:
+				b = min(max(int((row[j]-low)//width), 0), len(counts)-1)
+				bins[i] = b
+				counts[b] += 1
+		self._seq = seq + 1
+		if self._seq % self.size == 0 and self.n == self.size:
+			self._resum()
+
+	def _push_deque(self, k, j, seq, value):
+		"""
+		Append sample seq to the deque of field j after dropping the samples, that left the 
+		window, and those, that can't be the minimum (k=0) or maximum (k=1) anymore.
+		"""
+		size = self.size
+		qseq, qval = self._qseq[k][j], self._qval[k][j]
+		head, tail = self._heads[k][j], self._tails[k][j]
+		while tail > head and qseq[head%size] <= seq - size:
+			head += 1
+		while tail > head and ((qval[(tail-1)%size] <= value) if k else (qval[(tail-1)%size] >= value)):
+			tail -= 1
+		qseq[tail%size] = seq
+		qval[tail%size] = value
+		self._heads[k][j], self._tails[k][j] = head, tail + 1
+
+	def _resum(self):
+		np.sum(self._values, axis=0, where=self._valid, out=self._sum)
+		np.multiply(self._values, self._values).sum(axis=0, where=self._valid, out=self._sumsq)
+
+	def _extremum(self, k):
+		res = np.full(self.nfields, np.nan)
+		oldest = self._seq - self.size
+		for j in range(self.nfields):
+			qseq, head, tail = self._qseq[k][j], self._heads[k][j], self._tails[k][j]
+			while tail > head and qseq[head%self.size] < oldest:
+				head += 1
+			self._heads[k][j] = head
+			if tail > head:
+				res[j] = self._qval[k][j][head%self.size]
+		return res
+
+	def count(self):
+		return self._count.copy()
+
+	def mean(self):
+		with np.errstate(invalid='ignore', divide='ignore'):
+			return self._sum/self._count
+
+	def var(self):
+		"Sample variance"
+		with np.errstate(invalid='ignore', divide='ignore'):
+			mean = self._sum/self._count
+			return np.maximum(self._sumsq - self._count*mean*mean, 0)/(self._count-1)
+
+	def std(self):
+		return np.sqrt(self.var())
+
+	def min(self):
+		return self._extremum(0)
+
+	def max(self):
+		return self._extremum(1)
+
+	def percentile(self, j, q):
+		"Approximate q-th percentile (0-100) of field j, which must have a histogram"
+		low, width, counts, bins = self._hists[j]
+		total = counts.sum()
+		if not total:
+			return np.nan
+		cum = np.cumsum(counts)
+		rank = q/100*total
+		b = int(np.searchsorted(cum, rank))
+		b = min(b, len(counts)-1)
+		before = cum[b] - counts[b]
+		res = low + width*(b + (rank-before)/counts[b] if counts[b] else b)
+		return min(max(res, self._extremum(0)[j]), self._extremum(1)[j])	# the bins may be coarse
+
+def check_stats(stats):
+	for s in stats:
+		if s not in STATS:
+			raise ValueError(f'Unknown statistic "{s}". Choose from {STATS}')
+
+def stats_schema(schema, stats, percentiles={}):
+	"""
+	Schema of the statistics of records of schema. The mean keeps the field name, the other 
+	statistics are appended with an underscore, e.g. pm25_max. percentiles maps the index of
+	a field to the list of its percentiles, named like pm25_p95.
+	"""
+	if list(stats) == ['mean'] and not percentiles:
+		return schema	# averages keep the layout
+	fields = [('timestamp', schema.units[0])]
+	for j, (name, unit) in enumerate(schema.items()):
+		if j == 0:
+			continue
+		for s in stats:
+			if s == 'mean':
+				fields.append((name, unit))
+			elif s == 'var':
+				fields.append((f'{name}_var', f'({unit})²'))
+			elif s == 'count':
+				fields.append((f'{name}_count', None))
+			else:
+				fields.append((f'{name}_{s}', unit))
+		fields += [(f'{name}_p{q}', unit) for q in percentiles.get(j, ())]
+	return getSchema(f'{schema.name}_stats', tuple(fields))
+
+class StatsFilter:
+	"""
+	Filter emitting statistics of the last interval records. With mode "sliding" a result is
+	emitted for every record, or every step records, once the window is full; with mode
+	"tumbling" once per interval records, after which the window starts over.
+
+	stats are any of mean, var, std, min, max and count (see stats_schema for the field names).
+	percentiles is a list like [50, 95] of fields with a histogram, which maps the field name 
+	to [low, high, bins].
+	"""
+
+	def __init__(self, interval=30, mode='tumbling', step=1, stats=['mean'], percentiles=[], histograms={}):
+		if mode not in ('sliding','tumbling'):
+			raise ValueError(f'Unknown mode "{mode}". Choose sliding or tumbling')
+		check_stats(stats)
+		self.interval = interval
+		self.mode = mode
+		self.step = step
+		self.stats = list(stats)
+		self.percentiles = list(percentiles)
+		self.histograms = dict(histograms)
+		self._schema = None
+		self._window = None
+		self._out = None
+
+	def _init_window(self, schema):
+		self._schema = schema
+		hists = {schema.index[f]:tuple(h) for f,h in self.histograms.items() if f in schema.index}
+		self._window = WindowedStats(len(schema), self.interval, hists)
+		self._out = stats_schema(schema, self.stats, {j:self.percentiles for j in hists})
+
+	def put(self, record):
+		record = as_record(record)
+		if record.schema is not self._schema:
+			self._init_window(record.schema)
+		self._window.push(record.values)
+
+	def is_full(self):
+		return self._window is not None and self._window.is_full()
+
+	def reset(self):
+		"Start a new window"
+		if self._window is not None:
+			self._window.reset()
+
+	def get_data(self):
+		"Record of the statistics of the current window. The timestamp is the mean of the window."
+		w, schema = self._window, self._schema
+		results = {s:getattr(w, s)() for s in self.stats}
+		mean = results['mean'] if 'mean' in results else w.mean()
+		values = [None if np.isnan(mean[0]) else int(mean[0])]
+		for j in range(1, len(schema)):
+			for s in self.stats:
+				v = results[s][j]
+				values.append(None if np.isnan(v) else float(v))
+			if j in w._hists:
+				for q in self.percentiles:
+					v = w.percentile(j, q)
+					values.append(None if np.isnan(v) else float(v))
+		return Record(self._out, values)
+
+	def process(self, dataset):
+		self.put(dataset)
+		if not self.is_full():
+			return
+		if self.mode == 'tumbling':
+			res = self.get_data()
+			self.reset()
+			return res
+		if (self._window._seq - self.interval) % self.step == 0:
+			return self.get_data()
+
+class _Bucket:
+	"Accumulated values of one time bucket"
+	__slots__ = ('sum','sumsq','count','min','max')
+
+	def __init__(self, nfields):
+		self.sum = np.zeros(nfields)
+		self.sumsq = np.zeros(nfields)
+		self.count = np.zeros(nfields, dtype=np.int64)
+		self.min = np.full(nfields, np.inf)
+		self.max = np.full(nfields, -np.inf)
+
+	def add(self, values, valid):
+		np.add(self.sum, values, out=self.sum, where=valid)
+		np.add(self.sumsq, values*values, out=self.sumsq, where=valid)
+		self.count += valid
+		np.fmin(self.min, values, out=self.min, where=valid)
+		np.fmax(self.max, values, out=self.max, where=valid)
+
+	def result(self, stat):
+		with np.errstate(invalid='ignore', divide='ignore'):
+			mean = self.sum/self.count
+			if stat == 'mean':
+				return mean
+			if stat in ('var','std'):
+				var = np.maximum(self.sumsq - self.count*mean*mean, 0)/(self.count-1)
+				return var if stat == 'var' else np.sqrt(var)
+			if stat == 'count':
+				return self.count.astype(float)
+			res = getattr(self, stat)
+			return np.where(self.count > 0, res, np.nan)
+
+class Rollup:
+	"""
+	Aggregates a stream of records into buckets of several resolutions in seconds at once, 
+	e.g. [10, 60, 3600]. Buckets are aligned to the wall clock (UTC), not to the number of 
+	records, such dropped records don't shift them. The timestamp of a result is the start 
+	of its bucket.
+
+	A bucket is emitted once a record arrives lateness seconds after its end. Records for an 
+	already emitted bucket are dropped and counted as late.
+	"""
+
+	def __init__(self, resolutions, lateness=0, stats=['mean']):
+		check_stats([s for s in stats if s != 'count'])
+		self.resolutions = sorted(set(resolutions))
+		self.lateness = lateness*1000
+		self.stats = list(stats)
+		self._buckets = {res:{} for res in self.resolutions}	# res -> {(start, schema): _Bucket}
+		self._closed = {res:None for res in self.resolutions}	# end of the last emitted bucket
+		self._watermark = None
+		self.metrics = dict(records=0, late=0, emitted=0)
+
+	def put(self, record):
+		"Add a record, returns the list of (resolution, record) completed by it"
+		record = as_record(record)
+		ts = record.timestamp
+		self.metrics['records'] += 1
+		values = np.array([np.nan if v is None else v for v in record.values], dtype=float)
+		valid = ~np.isnan(values)
+		for res in self.resolutions:
+			span = res*1000
+			start = ts - ts%span
+			closed = self._closed[res]
+			if closed is not None and start < closed:
+				self.metrics['late'] += 1
+				continue
+			key = (start, record.schema)
+			bucket = self._buckets[res].get(key)
+			if bucket is None:
+				bucket = self._buckets[res][key] = _Bucket(len(values))
+			bucket.add(values, valid)
+		if self._watermark is None or ts - self.lateness > self._watermark:
+			self._watermark = ts - self.lateness
+		return self._emit(self._watermark)
+
+	def flush(self):
+		"Emit all open buckets, e.g. at shutdown"
+		return self._emit(None)
+
+	def _emit(self, watermark):
+		results = []
+		for res in self.resolutions:
+			span = res*1000
+			buckets = self._buckets[res]
+			done = sorted((k for k in buckets if watermark is None or k[0] + span <= watermark), key=lambda k: k[0])
+			for key in done:
+				start, schema = key
+				results.append((res, self._result(start, schema, buckets.pop(key))))
+				self._closed[res] = max(self._closed[res] or 0, start + span)
+		self.metrics['emitted'] += len(results)
+		return results
+
+	def _result(self, start, schema, bucket):
+		out = stats_schema(schema, self.stats)
+		stats = [bucket.result(s) for s in self.stats]
+		values = [int(start)]
+		for j in range(1, len(schema)):
+			values += [None if np.isnan(r[j]) else float(r[j]) for r in stats]
+		return Record(out, values)
@@ -0,0 +1,40 @@
+import os
+from writers import CSVWriter
+from record import getSchema
+
+X = getSchema('X', (('timestamp','msec'),('pm25','ug')))
+Y = getSchema('Y', (('timestamp','msec'),('pm10','ug'),('temperature','C')))
+T0 = 1700000000000
+
+def lines(filename):
+	with open(filename) as f:
+		return f.read().splitlines()
+
+def test_segment_per_schema(tmp_path):
+	w = CSVWriter('desc', str(tmp_path), 'x.csv')
+	for i in range(20):
+		w.write_filtered(X.record([T0+i, 1.0]) if i%2 else Y.record([T0+i, 2.0, 20.0]), 'a' if i%2 else 'b')
+	w.close()
+	assert sorted(os.listdir(tmp_path)) == ['1_x.csv', '2_x.csv']
+	assert lines(tmp_path/'1_x.csv')[1] == 'timestamp (msec);pm10 (ug);temperature (C)'
+	assert lines(tmp_path/'2_x.csv')[1] == 'timestamp (msec);pm25 (ug)'
+	assert len(lines(tmp_path/'1_x.csv')) == len(lines(tmp_path/'2_x.csv')) == 12
+
+def test_restart_continues_segment_of_schema(tmp_path):
+	w = CSVWriter('desc', str(tmp_path), 'x.csv')
+	w.write_filtered(Y.record([T0, 2.0, 20.0]))
+	w.write_filtered(X.record([T0, 1.0]))
+	w.close()
+	w = CSVWriter('desc', str(tmp_path), 'x.csv')
+	w.write_filtered(X.record([T0+1, 1.0]))
+	w.close()
+	assert sorted(os.listdir(tmp_path)) == ['1_x.csv', '2_x.csv']
+	assert len(lines(tmp_path/'2_x.csv')) == 4
+
+def test_rotate_size(tmp_path):
+	w = CSVWriter('desc', str(tmp_path), 'x.csv', rotate_size=200)
+	w.write_filtered_batch([X.record([T0+i, float(i)]) for i in range(20)])
+	w.close()
+	files = sorted(os.listdir(tmp_path), key=lambda f: int(f.split('_')[0]))
+	assert len(files) > 1
+	assert sum(len(lines(tmp_path/f)) - 2 for f in files) == 20
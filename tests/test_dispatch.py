@@ -0,0 +1,104 @@
+import asyncio, os, time
+from dispatch import WriterQueue, FilterQueue
+from pipeline import FilterGraph
+from record import getSchema
+
+X = getSchema('X', (('timestamp','msec'),('pm25','ug')))
+
+class SlowWriter:
+	def __init__(self, delay=0.0):
+		self.delay = delay
+		self.written = []
+		self.closed = False
+	def write(self, record, source=None):
+		time.sleep(self.delay)
+		self.written.append(record.timestamp)
+	def write_batch(self, records, source=None):
+		for record in records:
+			self.write(record, source)
+	def flush(self):
+		pass
+	def close(self):
+		self.closed = True
+
+def records(n):
+	return [X.record([i, float(i)]) for i in range(n)]
+
+def run(coro):
+	return asyncio.run(coro)
+
+def test_spill_keeps_order(tmp_path):
+	spill = str(tmp_path/'w.spill')
+	w = SlowWriter(0.001)
+	async def main():
+		q = WriterQueue(w, 'w', maxsize=5, policy='spill', spill_path=spill)
+		q.start()
+		for record in records(200):
+			q.offer(record)
+		assert q.counters['spilled'] > 100
+		await q.drain()
+		await q.stop()
+		return q
+	q = run(main())
+	assert w.written == list(range(200))
+	assert not os.path.exists(spill) and not os.path.exists(spill+'.offset')
+
+def test_spill_continues_after_restart(tmp_path):
+	spill = str(tmp_path/'w.spill')
+	w = SlowWriter(0.01)
+	async def first():
+		q = WriterQueue(w, 'w', maxsize=5, policy='spill', spill_path=spill)
+		q.start()
+		for record in records(30):
+			q.offer(record)
+		await asyncio.sleep(0.1)
+		await q.stop()
+	run(first())
+	written = list(w.written)
+	assert os.path.exists(spill)
+	w2 = SlowWriter()
+	async def second():
+		q = WriterQueue(w2, 'w', maxsize=5, policy='spill', spill_path=spill)
+		q.start()
+		await q.drain()
+		await q.stop()
+	run(second())
+	# messages queued at stop are spilled behind those still on disk
+	assert sorted(written + w2.written) == list(range(30))
+
+def test_stop_waits_for_write():
+	w = SlowWriter(0.2)
+	async def main():
+		q = WriterQueue(w, 'w')
+		q.start()
+		q.offer(records(1)[0])
+		await asyncio.sleep(0.05)
+		await q.stop()
+	run(main())
+	assert w.written == [0] and w.closed
+
+class BatchFilter:
+	"Drops odd values, counts the batches it gets"
+	batches = []
+	def process(self, record):
+		raise AssertionError('the broker must filter batches')
+	def process_many(self, records):
+		BatchFilter.batches.append(len(records))
+		return [r for r in records if r.values[1] % 2 == 0]
+
+def test_filter_queue_filters_batches():
+	BatchFilter.batches = []
+	graph = FilterGraph()
+	graph.add('w', [dict(filter_cls=BatchFilter)])
+	delivered = []
+	async def main():
+		q = FilterQueue(graph.process_many, lambda writer, record, source: delivered.append((record.timestamp, source)), 'r', batch_size=100)
+		q.start()
+		for record in records(20):
+			q.offer(record, 'a' if record.timestamp < 10 else 'b')
+		await q.drain()
+		await q.stop()
+		return q
+	q = run(main())
+	assert delivered == [(i, 'a' if i < 10 else 'b') for i in range(0, 20, 2)]
+	assert BatchFilter.batches == [10, 10] and q.counters['errors'] == 0
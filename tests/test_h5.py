@@ -0,0 +1,46 @@
+import os
+import pytest
+
+h5py = pytest.importorskip('h5py')
+from writers import H5Writer
+from h5store import H5Reader
+from record import getSchema
+
+X = getSchema('X', (('timestamp','msec'),('pm25','ug')))
+Y = getSchema('Y', (('timestamp','msec'),('pm10','ug'),('temperature','C')))
+T0 = 1700000000000
+
+def test_dataset_per_source(tmp_path):
+	w = H5Writer('site/{source}', str(tmp_path/'x.h5'))
+	for i in range(10):
+		w.write_filtered(X.record([T0+i, 1.0]) if i%2 else Y.record([T0+i, 2.0, 20.0]), 'a' if i%2 else 'b')
+	w.close()
+	assert os.listdir(tmp_path) == ['1_x.h5']
+	r = H5Reader(str(tmp_path/'1_x.h5'), swmr=False)
+	assert sorted(r.names()) == ['site/a', 'site/b']
+	assert r.fields('site/b') == Y.fields
+	assert len(r.read('site/a')) == len(r.read('site/b')) == 5
+	r.close()
+
+def test_inaccessible_file(tmp_path):
+	w = H5Writer('data', str(tmp_path/'missing'/'x.h5'))
+	for i in range(3):
+		with pytest.raises(OSError):
+			w.write_filtered(X.record([T0+i, 1.0]), 'a')
+	assert w.index == 1
+	assert w.filename == str(tmp_path/'missing'/'1_x.h5')
+	os.mkdir(tmp_path/'missing')
+	w.write_filtered(X.record([T0, 1.0]), 'a')
+	w.close()
+	assert os.listdir(tmp_path/'missing') == ['1_x.h5']
+
+def test_next_file_if_not_accessible(tmp_path):
+	with open(tmp_path/'1_x.h5', 'w') as f:
+		f.write('no hdf5 file')
+	w = H5Writer('data', str(tmp_path/'x.h5'))
+	w.write_filtered_batch([X.record([T0+i, 1.0]) for i in range(3)], 'a')
+	w.close()
+	assert w.filename == str(tmp_path/'2_x.h5')
+	r = H5Reader(w.filename, swmr=False)
+	assert len(r.read('data')) == 3
+	r.close()
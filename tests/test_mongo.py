@@ -0,0 +1,178 @@
+import time, itertools
+import pytest
+
+pytest.importorskip('mongomock')
+mongoengine = pytest.importorskip('mongoengine')
+from pymongo.errors import AutoReconnect
+from writers import MongoDBWriter
+from record import getSchema
+import model
+
+AQ = getSchema('AQ', (('timestamp','msec'),('pm25','ug'),('temperature','C')))
+T0 = 1700000000000
+databases = itertools.count()
+
+def records(n, start=0):
+	return [AQ.record([T0 + 1000*i, float(i), 20.0]) for i in range(start, start+n)]
+
+@pytest.fixture
+def url():
+	yield f'mongomock://localhost/test{next(databases)}'
+	mongoengine.disconnect()
+
+def count():
+	return model.AQData.objects.count()
+
+def test_bulk_rows(url):
+	w = MongoDBWriter(url, model.AQData, bulk=True, bulk_rows=3, flush_time=60)
+	for record in records(2):
+		w.write_filtered(record, 'a')
+	assert count() == 0
+	w.write_filtered(records(1, 2)[0], 'a')
+	assert count() == 3
+	assert w.metrics['inserted'] == 3
+
+def test_flush_time(url):
+	w = MongoDBWriter(url, model.AQData, bulk=True, bulk_rows=1000, flush_time=0.05)
+	assert w.flush_interval == 0.05
+	w.write_filtered(records(1)[0], 'a')
+	assert count() == 0
+	time.sleep(0.06)
+	w.write_filtered(records(1, 1)[0], 'a')
+	assert count() == 2
+
+def test_close_flushes(url):
+	w = MongoDBWriter(url, model.AQData, bulk=True, bulk_rows=1000, flush_time=60)
+	w.write_filtered_batch(records(5), 'a')
+	assert count() == 0
+	w.close()
+	assert count() == 5
+
+def test_duplicate_key(url):
+	w = MongoDBWriter(url, model.AQData, bulk=True, bulk_rows=1000, flush_time=60)
+	w._get_collection().create_index('timestamp', unique=True)
+	w.write_filtered_batch(records(3) + records(1, 1) + records(2, 3), 'a')
+	w.flush()
+	assert w.metrics['errors'] == 1
+	assert w.metrics['inserted'] == 5
+	assert count() == 5
+
+def test_inserts_per_s(url):
+	w = MongoDBWriter(url, model.AQData, bulk=True, bulk_rows=100, flush_time=60)
+	w.write_filtered_batch(records(250), 'a')
+	w.close()
+	assert w.metrics['inserted'] == 250
+	assert w.metrics['inserts_per_s'] == round(250/w._insert_time, 1) > 0
+
+def test_lost_connection_keeps_documents(url, monkeypatch):
+	w = MongoDBWriter(url, model.AQData, bulk=True, bulk_rows=1000, flush_time=60)
+	w.write_filtered_batch(records(4), 'a')
+	collection = w._get_collection()
+	def lost(*args, **kwargs):
+		raise AutoReconnect('connection lost')
+	monkeypatch.setattr(collection, 'insert_many', lost)
+	with pytest.raises(AutoReconnect):
+		w.flush()
+	monkeypatch.undo()
+	w.close()
+	assert count() == 4
+	assert w.metrics['inserted'] == 4
+
+def test_write_concern_errors(url, monkeypatch):
+	from pymongo.errors import BulkWriteError
+	w = MongoDBWriter(url, model.AQData, bulk=True, bulk_rows=1000, flush_time=60)
+	w.write_filtered_batch(records(2), 'a')
+	def unsatisfied(docs, ordered):
+		raise BulkWriteError(dict(nInserted=len(docs), writeErrors=[], writeConcernErrors=[dict(errmsg='waiting for replication timed out')]))
+	monkeypatch.setattr(w._get_collection(), 'insert_many', unsatisfied)
+	w.flush()
+	assert w.metrics['write_concern_errors'] == 1
+	assert w.metrics['errors'] == 0
+	assert w.metrics['inserted'] == 2
+	assert not w._buffer
+
+@pytest.fixture
+def buckets(url, monkeypatch):
+	"MongoBucketWriter factory. mongomock's bulk_write does not take the UpdateOne of recent pymongo versions."
+	import mongomock
+	from pymongo.errors import BulkWriteError, WriteError
+	from writers import MongoBucketWriter
+	def bulk_write(collection, ops, ordered=True):
+		errors = []
+		for i, op in enumerate(ops):
+			try:
+				collection.update_one(op._filter, op._doc, upsert=op._upsert)
+			except WriteError as e:
+				errors.append(dict(index=i, code=e.code, errmsg=str(e)))
+		if errors:
+			raise BulkWriteError(dict(writeErrors=errors, writeConcernErrors=[]))
+	monkeypatch.setattr(mongomock.collection.Collection, 'bulk_write', bulk_write)
+	return lambda **kwargs: MongoBucketWriter(url, **dict(dict(bucket=60, bulk_rows=1000, flush_time=60), **kwargs))
+
+def lost(*args, **kwargs):
+	raise AutoReconnect('connection lost')
+
+def test_buckets(buckets):
+	w = buckets(sensor='site/{source}')
+	w.write_filtered_batch(records(90), 'a')
+	w.flush()
+	assert w.metrics['upserts'] == 2 and w.metrics['inserted'] == 90
+	w.write_filtered_batch(records(30, 90), 'a')	# partly pushed to the second bucket
+	w.close()
+	buckets = model.SensorBucket.objects(sensor='site/a').order_by('start')
+	# T0 is 20 s into a minute
+	assert [(b.start - T0, b.end - T0, b.count) for b in buckets] == [(-20000, 40000, 40), (40000, 100000, 60), (100000, 160000, 20)]
+	assert buckets[1].timestamps == [T0 + 1000*i for i in range(40, 100)]
+	assert buckets[1].values['pm25'] == [float(i) for i in range(40, 100)]
+	assert buckets[1].summary()['pm25'] == dict(min=40.0, max=99.0, count=60, mean=69.5)
+	assert buckets[1].units == dict(pm25='ug', temperature='C')
+	assert w.metrics['inserted'] == 120
+
+def test_bucket_errors(buckets):
+	w = buckets()
+	w._get_collection().create_index('end', unique=True)	# fails the second sensor
+	w.write_filtered_batch(records(3), 'a')
+	w.write_filtered_batch(records(2), 'b')
+	w.flush()
+	assert w.metrics['errors'] == 1
+	assert w.metrics['inserted'] == 3
+	assert model.SensorBucket.objects(sensor='a').first().count == 3
+
+def test_bucket_lost_connection(buckets):
+	w = buckets()
+	collection = w._get_collection()
+	w.write_filtered_batch(records(5), 'a')
+	with pytest.MonkeyPatch.context() as m:
+		m.setattr(collection, 'find', lost)
+		with pytest.raises(AutoReconnect):
+			w.flush()	# the stored counts can't be looked up
+	w.write_filtered_batch(records(5, 5), 'a')
+	with pytest.MonkeyPatch.context() as m:
+		m.setattr(collection, 'bulk_write', lost)
+		with pytest.raises(AutoReconnect):
+			w.flush()
+	assert w._rows == 10
+	w.close()
+	assert model.SensorBucket.objects(sensor='a').first().count == 10
+	assert w.metrics['inserted'] == 10
+
+def test_bucket_limit(buckets):
+	w = buckets(max_readings=4)
+	w.write_filtered_batch(records(3), 'a')
+	w.close()
+	w = buckets(max_readings=4)
+	w.write_filtered_batch(records(3, 3), 'a')
+	w.close()
+	assert model.SensorBucket.objects(sensor='a').first().count == 4
+	assert w.metrics['dropped'] == 2
+	assert w.metrics['inserted'] == 1
+
+def test_bucket_default_limit(buckets):
+	import writers
+	w = buckets(bucket=3600)
+	limit = writers.MAX_DOCUMENT_BYTES//2//(writers.BSON_VALUE_BYTES*len(AQ.fields))
+	w._counts[('a', T0 - T0 % 3600000)] = limit - 1
+	w.write_filtered_batch(records(2), 'a')
+	w.flush()
+	assert w.metrics['dropped'] == 1
+	assert w.metrics['inserted'] == 1
@@ -0,0 +1,111 @@
+################################################################################################
+# Non-blocking serial transport for asyncio. The port is put into non-blocking mode and its
+# file descriptor is registered with the event loop. Readers await complete lines or chunks and
+# are only woken when bytes actually arrive, such many readers can share one event loop.
+################################################################################################
+import asyncio, logging, os, time
+
+logger = logging.getLogger(__name__)
+
+class SerialTransport:
+	"""
+	Wraps an opened serial.Serial. Incoming bytes are collected in a buffer by a reader callback
+	of the event loop. self.idle replaces the serial timeout: a pending line without separator
+	is returned after the line has been silent for idle seconds. All chunks are recorded to 
+	capture, if given (see capture.CaptureWriter).
+	"""
+
+	def __init__(self, uart, idle=0.1, bufsize=4096, capture=None):
+		self._uart = uart
+		self.capture = capture
+		self._uart.timeout = 0
+		self._fd = uart.fileno()
+		self.idle = idle
+		self.bufsize = bufsize
+		self.timestamp = None	# arrival time of the last chunk
+		self._buffer = bytearray()
+		self._scanned = 0	# number of bytes already searched for a separator
+		self._waiter = None
+		self._exception = None
+		self._loop = asyncio.get_running_loop()
+		self._loop.add_reader(self._fd, self._on_readable)
+
+	def _on_readable(self):
+		try:
+			data = os.read(self._fd, self.bufsize)
+			if not data:
+				raise ConnectionError(f'Serial interface {self._uart.port} has been closed')
+		except OSError as e:
+			logger.error(f'Reading from {self._uart.port} failed: {e}')
+			self._set_exception(e)
+			return
+		self.timestamp = time.time()
+		if self.capture:
+			self.capture.write(data, self.timestamp)
+		self._buffer += data
+		self._wakeup()
+
+	def _wakeup(self):
+		if self._waiter is not None and not self._waiter.done():
+			self._waiter.set_result(None)
+
+	def _set_exception(self, exc):
+		self._exception = exc
+		self._loop.remove_reader(self._fd)
+		if self._waiter is not None and not self._waiter.done():
+			self._waiter.set_exception(exc)
+
+	async def _wait(self, timeout=None):
+		"Wait for the next chunk. Returns False on timeout."
+		if self._exception:
+			raise self._exception
+		self._waiter = self._loop.create_future()
+		try:
+			await asyncio.wait_for(self._waiter, timeout)
+			return True
+		except asyncio.TimeoutError:
+			return False
+		finally:
+			self._waiter = None
+
+	def _take(self, n):
+		chunk = bytes(self._buffer[:n])
+		del self._buffer[:n]
+		self._scanned = 0
+		return chunk
+
+	async def read(self):
+		"Return all buffered bytes, waiting for at least one."
+		while not self._buffer:
+			await self._wait()
+		return self._take(len(self._buffer))
+
+	async def readline(self, sep=b'\n', limit=None):
+		"""
+		Behaves like serial.Serial.readline with a timeout: returns at sep, after limit bytes
+		or when a started line has been idle for self.idle seconds. Never returns empty.
+		"""
+		while True:
+			start = max(self._scanned - len(sep) + 1, 0)
+			i = self._buffer.find(sep, start)
+			if i >= 0 and (limit is None or i + len(sep) <= limit):
+				return self._take(i + len(sep))
+			if limit is not None and len(self._buffer) >= limit:
+				return self._take(limit)
+			self._scanned = len(self._buffer)
+			if not self._buffer:
+				await self._wait()
+			elif not await self._wait(self.idle):
+				return self._take(len(self._buffer))
+
+	def write(self, data):
+		return self._uart.write(data)
+
+	def flush_input(self):
+		self._uart.reset_input_buffer()
+		self._buffer.clear()
+		self._scanned = 0
+
+	def close(self):
+		if self._exception is None:
+			self._set_exception(ConnectionError(f'Transport for {self._uart.port} has been closed'))
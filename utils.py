@@ -1,4 +1,6 @@
-import queue, logging, os, subprocess
+import logging, os, asyncio, inspect, socket
+from os import path
+from collections import namedtuple
 logger = logging.getLogger(__name__)
 
 class Event:
@@ -16,14 +18,28 @@ class Observer:
 		logger.debug('Appended a callback')
 		return callback
 		
-	def notify(self,**kwargs):
+	def _call(self,**kwargs):
 		e = Event()
 		e.source = self.name
 		for k,v in kwargs.items():
 			setattr(e,k,v)
+		results = []
 		for callback in self.callbacks:
 			logger.debug('Executing callback')
-			callback(e)
+			results.append(callback(e))
+		return results
+		
+	def notify(self,**kwargs):
+		"Awaitables returned by callbacks are scheduled on the running event loop"
+		for result in self._call(**kwargs):
+			if inspect.isawaitable(result):
+				asyncio.ensure_future(result)
+	
+	async def anotify(self,**kwargs):
+		"Like notify, but waits for awaitables returned by callbacks, e.g. to apply backpressure"
+		for result in self._call(**kwargs):
+			if inspect.isawaitable(result):
+				await result
 			
 observers = {}
 
@@ -35,88 +51,203 @@ def getObserver(name):
 class NoSerialInterfaceFoundError(Exception):
 	pass
 
-def get_serial_if_fname(pat):
-	"Search for busy interfaces with lsof"
-	lines = subprocess.run(['lsof','+d','/dev'], stdout=subprocess.PIPE).stdout.decode('utf-8').split('\n')
-	busy_ifs = [line.split()[-1] for line in lines if line.find('ttyUSB')>0]
-	"Search for serial interface with pattern pat.pattern"
-	lines = subprocess.run(['dmesg'], stdout=subprocess.PIPE).stdout.decode('utf-8').split('\n')
-	serial_ifs = ['/dev/' + pat.search(line).group(1) for line in lines if pat.search(line)]
-	""
-	for sif in serial_ifs:
-		if not sif in busy_ifs and os.path.exists(sif):
-			logger.info(f'Found serial interface {sif}')
-			return sif
-		else:
-			logger.info(f'Serial interface {sif} is busy.')
-	raise NoSerialInterfaceFoundError(f'Could not find a serial interface for the given pattern {pat}!\nIs the interface blocked?')
+##############################################################################################
+# S e r i a l   d e v i c e   d i s c o v e r y
+# USB serial adapters are identified by vendor/product id and, if the adapter has one, serial 
+# number, else by the physical USB port path. Both survive a re-enumeration, the tty name does 
+# not. The device map is read from sysfs and cached until a hotplug event invalidates it.
+SYSFS_TTY = '/sys/class/tty'
+
+SerialDevice = namedtuple('SerialDevice', ['port','vid','pid','serial_number','usb_path'])
+
+def _read_sysfs(dirname, attr):
+	try:
+		with open(path.join(dirname, attr)) as f:
+			return f.read().strip()
+	except OSError:
+		return None
+
+def scan_serial_devices():
+	"Map tty names of USB serial interfaces to their USB identity"
+	devices = {}
+	for name in os.listdir(SYSFS_TTY):
+		if not name.startswith(('ttyUSB','ttyACM')):
+			continue
+		usb = path.realpath(path.join(SYSFS_TTY, name, 'device'))
+		while usb != '/' and not path.exists(path.join(usb, 'idVendor')):
+			usb = path.dirname(usb)
+		if usb == '/':
+			continue
+		devices[name] = SerialDevice(
+			port = '/dev/' + name,
+			vid = int(_read_sysfs(usb, 'idVendor'), 16),
+			pid = int(_read_sysfs(usb, 'idProduct'), 16),
+			serial_number = _read_sysfs(usb, 'serial'),
+			usb_path = path.basename(usb)
+		)
+	return devices
+
+class DeviceRegistry:
+	"""
+	Cached device map plus the ports claimed by readers of this process, such identical 
+	adapters are handed out once. Other processes are kept off by opening ports exclusively.
+	"""
+	
+	def __init__(self):
+		self._devices = None
+		self._claimed = {}
+		self._changed = None
+		self._watcher = None
+		
+	def invalidate(self):
+		self._devices = None
+		if self._changed:
+			self._changed.set()
+	
+	def devices(self):
+		if self._devices is None:
+			self._devices = scan_serial_devices()
+			logger.debug(f'Found serial devices {self._devices}')
+		return self._devices
+	
+	def find(self, vid, pid, serial_number=None, usb_path=None, owner=None, exclude=()):
+		"""
+		Port of the first adapter matching the given identity, that is not claimed by another 
+		owner nor in exclude, e.g. ports locked by other processes. The port is claimed for owner.
+		"""
+		for refresh in (False, True):
+			if refresh:
+				self.invalidate()
+			for dev in sorted(self.devices().values()):
+				if (dev.vid, dev.pid) != (vid, pid):
+					continue
+				if serial_number and dev.serial_number != serial_number:
+					continue
+				if usb_path and dev.usb_path != usb_path:
+					continue
+				if dev.port in exclude:
+					continue
+				if self._claimed.get(dev.port, owner) is not owner:
+					logger.info(f'Serial interface {dev.port} is busy.')
+					continue
+				self._claimed[dev.port] = owner
+				logger.info(f'Found serial interface {dev.port}')
+				return dev.port
+		raise NoSerialInterfaceFoundError(f'Could not find a serial interface {vid:04x}:{pid:04x} {serial_number or usb_path or ""}!\nIs the interface blocked?')
+	
+	def release(self, owner):
+		for port in [p for p,o in self._claimed.items() if o is owner]:
+			del self._claimed[port]
+	
+	def watch(self):
+		"""
+		Listen to kernel uevents for hotplugged tty devices. Must be called from within the 
+		running event loop. Returns False, if uevents are not available; the device map is then 
+		rescanned on each cache miss only.
+		"""
+		if self._watcher:
+			return True
+		try:
+			sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+			sock.bind((0, 1))
+			sock.setblocking(False)
+		except (OSError, AttributeError) as e:
+			logger.warning(f'Hotplug events are not available: {e}')
+			return False
+		self._watcher = sock
+		self._changed = asyncio.Event()
+		asyncio.get_running_loop().add_reader(sock.fileno(), self._on_uevent)
+		return True
+	
+	def _on_uevent(self):
+		try:
+			msg = self._watcher.recv(8192)
+		except OSError:
+			return
+		fields = msg.split(b'\0')
+		if b'SUBSYSTEM=tty' in fields:
+			logger.info(f'Hotplug event {fields[0].decode(errors="replace")}')
+			self.invalidate()
+	
+	async def wait_for_change(self, timeout=None):
+		"Wait for the next hotplug event, or timeout seconds if there are no hotplug events"
+		if not self.watch():
+			await asyncio.sleep(timeout or 1)
+			return
+		self._changed.clear()
+		try:
+			await asyncio.wait_for(self._changed.wait(), timeout)
+		except asyncio.TimeoutError:
+			pass
+
+NETLINK_KOBJECT_UEVENT = 15
+device_registry = DeviceRegistry()
+
+def find_serial_port(vid, pid, serial_number=None, usb_path=None, owner=None, exclude=()):
+	return device_registry.find(vid, pid, serial_number, usb_path, owner, exclude)
 
 class MovingAverage:
-	s = 0
+	"Moving average of the last n values. None is ignored. See stats.WindowedStats for more."
 	
 	def __init__(self,n=30):
-		self.q = queue.Queue()
-		self.q.maxsize = n
+		self.n = n
+		self.values = [0.0]*n
+		self.pos = 0
+		self.count = 0
+		self.s = 0.0
 
 	def next(self,val):
 		"""
 		processes the next value and returns the average value.
-		If the Queue is full, subtract the first value to have a 
-		moving average on maxsize values.
+		If the window is full, subtract the oldest value to have a 
+		moving average on n values.
 		"""
-		if self.q.full():
-			self.s -= self.q.get()
-		if val and isinstance(val,(int,float)):
-			self.q.put(val)	
-			self.s += val
-			return round(self.s/self.q.qsize())
-		return None
+		if not isinstance(val,(int,float)):
+			return self.s/self.count if self.count else None
+		if self.count == self.n:
+			self.s -= self.values[self.pos]
+		else:
+			self.count += 1
+		self.values[self.pos] = val
+		self.s += val
+		self.pos = (self.pos+1)%self.n
+		return self.s/self.count
 		
 	def is_full(self):
-		return self.q.full()
+		return self.count == self.n
 		
 class H5Writer:
-	"Lazily initialize a H5Writer"
+	"Lazily initialize a H5Writer. All of them append to one h5store.H5Store on H5FNAME."
 	H5FNAME = os.environ.get('H5FILE_PATH','default.h5')
 	__writers = {}
+	__store = None
  
 	@classmethod
 	def get_Writer(cls, name,data_dict):
 		if not cls.__writers.get(name,False):
 			cls.__writers[name] = cls(name,data_dict)
 		return cls.__writers[name]
- 
-	@staticmethod
-	def __convert(data_dict):
-		"Take a json frame and convert to a numpy array"
-		dtype = [(k,float) for k,v in data_dict.items()]
-		vals = tuple([v for v in data_dict.values()])
-		return narray([vals],dtype=dtype)
+	
+	@classmethod
+	def get_store(cls):
+		if cls.__store is None:
+			import atexit
+			from h5store import H5Store
+			cls.__store = H5Store(cls.H5FNAME)
+			atexit.register(cls.__store.close)
+		return cls.__store
  
 	def __init__(self,name,data_dict):
-		from h5py import File
-		from numpy import array as narray
 		self.name = name
-		if not os.path.exists(self.H5FNAME):
-			with File(self.H5FNAME,'w') as f:
-				logger.info(f"Create new file {name}")
-				f.create_dataset(name,data=self.__convert(data_dict),maxshape=(None,),chunks=True)
-		else:
-			with File(self.H5FNAME,'a') as f:
-				try:
-					f.create_dataset(name,data=self.__convert(data_dict),maxshape=(None,),chunks=True)
-				except Exception as e:
-					logger.warning(e)
+		self._table = self.get_store().table(name, data_dict.keys())
+		self.append(data_dict)
  
 	def append(self,data_dict):
-		"append one frame"
-		with File(self.H5FNAME,'a') as f:
-			h5 = f[self.name]
-			h5.resize(h5.size+1,axis=0)
-			h5[-1] = self.__convert(data_dict)
+		"append one frame, written with the next full chunk or on exit"
+		self._table.append([list(data_dict.values())])
  
 class Reducer:
-	dataset = {}
+	"Averages interval datasets into one"
 	interval = 30
 	_reducers = {}
 	
@@ -128,37 +259,23 @@ class Reducer:
 		return cls._reducers[type]
 		
 	def __init__(self,name=None,interval=30):
+		from stats import StatsFilter
 		self.name = name
 		self.interval = interval
-		self.averagers = {}
+		self._stats = StatsFilter(interval, mode='tumbling')
 		logger.debug(f"Initialized reducer for topic {self.name}")
 		
 	def put(self,obj):
-		"""
-		Lazily initialize an Averager for each measurement in obj 
-		and process each value, i.e. feed them to the
-		avergers and update the averages container with the current avarage values
-		"""
+		"Feed the values of obj to the window, see stats.StatsFilter"
 		logger.debug(f"Going to process {obj}")
-		if not self.averagers:
-			for key in obj.keys():
-				logger.debug(f"Initializing averager for key {key}")
-				self.averagers.update({ key:MovingAverage( self.interval ) })
-		for key in obj.keys():
-			if isinstance(obj.get(key,0),(int,float)):
-				val = self.averagers[key].next(obj.get(key,0))
-				self.dataset.update({key:val})
-			else:
-				val = self.averagers[key].next(obj.get(key).get('value',0))
-				obj[key].update(value=val)
-				self.dataset.update({key:obj[key]})
+		self._stats.put(obj)
 	
 	def get_data(self):
 		"Returns the averaged data obj"
-		return self.dataset
+		return self._stats.get_data()
 	
 	def is_full(self):
-		return self.averagers.get('timestamp').is_full()
+		return self._stats.is_full()
 	
 	def process(self, dataset):
 		self.put(dataset)
@@ -166,37 +283,28 @@ class Reducer:
 		if not self.is_full():
 			return
 		else:
-			rval = dict( self.get_data() ) # Clone return value to not delete it in the next step
+			rval = self.get_data()
 			self.reset()
 			return rval
 		
 	def reset(self):
-		self.dataset = {}
-		self.averagers = {}
+		self._stats.reset()
 	
 class PlausiChecker:
+	"Masks implausible values by rules, the DEFAULT_RULES if None (see rules.RuleEngine)"
+	
+	def __init__(self, rules=None):
+		from rules import RuleEngine, DEFAULT_RULES
+		self._engine = RuleEngine(DEFAULT_RULES if rules is None else rules)
+		
 	def process(self,dataset):
 		logger.debug(f'Going to check {dataset} for plausibility...')
-		for k,v in dataset.items():
-			"Discard dataset if one value is not in an allowed range"
-			logger.debug(f"Checking {k}...")
-			if k == 'temperature':
-				if (not v['value'] and v['value'] != 0) or v['value'] < -30 or v['value'] > 80:
-					logger.warning(f'Discarded dataset {dataset} due to invalid value for {k}')
-					return
-			elif k == 'pressure':
-				if (not v['value'] and v['value'] != 0)  or v['value'] < 800 or v['value'] > 1200:
-					logger.warning(f'Discarded dataset {dataset} due to invalid value for {k}')
-					return
-			elif k == 'humidity':
-				if (not v['value'] and v['value'] != 0)  or v['value'] > 100 or v['value'] <  0:
-					logger.warning(f'Discarded dataset {dataset} due to invalid value for {k}')
-					return
-			else:
-				if v['value'] < 0 or (not v['value'] and v['value'] != 0):
-					logger.warning(f'Discarded dataset {dataset} due to invalid value {v} for {k}')
-					return
-			logger.debug(f"{k} passed check.")
-		return dataset
+		return self._engine.process(dataset)
+	
+	def process_many(self, datasets):
+		return self._engine.process_many(datasets)
+	
+	def stats(self):
+		return self._engine.stats()
 				
 
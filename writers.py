@@ -1,40 +1,163 @@
-import logging, json
+import logging, json, os, time, gzip, shutil, threading
 from os import path, mkdir
-from datetime import datetime
+from datetime import datetime, timedelta
+from itertools import groupby
+from operator import attrgetter
 from utils import PlausiChecker
+from record import as_record
 logger = logging.getLogger(__name__)
 
+def process_batch(filt, records):
+	"Run a filter over a list of records, by its process_many if it has one"
+	if hasattr(filt, 'process_many'):
+		return filt.process_many(records)
+	return [r for r in (filt.process(record) for record in records) if r]
+
 class Writer(object):
 
 	def __init__(self, filters=[]):
-		"For each filter_cfg in filters instantiate Filter and append to _filters"
-		self._filters = [PlausiChecker()]
-		logger.debug(f"Appended PlausiChecker to {self._filters}")
-		for cfg in filters:
+		"""
+		Keep the filter configurations. A separate filter chain is instantiated for each source,
+		such one writer can be shared by several readers without mixing their data in stateful 
+		filters.
+		"""
+		self._filter_cfgs = [dict(cfg) for cfg in filters]
+		self._chains = {}
+		self.source = None
+		self.flush_interval = None
+	
+	def chain_cfgs(self):
+		"Filter configurations of the chain, which starts with a PlausiChecker unless a rules.RuleEngine is configured"
+		from rules import RuleEngine
+		cfgs = [dict(cfg) for cfg in self._filter_cfgs]
+		if not any(issubclass(cfg['filter_cls'], RuleEngine) for cfg in cfgs):
+			cfgs.insert(0, dict(filter_cls=PlausiChecker))
+		return cfgs
+	
+	def _build_filters(self):
+		"For each filter_cfg in chain_cfgs instantiate Filter and append to filters"
+		filters = []
+		for cfg in self.chain_cfgs():
 			filter_cls = cfg.pop('filter_cls')
-			self._filters.append(filter_cls(**cfg))
-			logger.debug(f"Appended {filter_cls} to {self._filters}")
+			filters.append(filter_cls(**cfg))
+			logger.debug(f"Appended {filter_cls} to {filters}")
+		return filters
+	
+	def get_filters(self, source=None):
+		"Lazily initialize the filter chain of source"
+		if source not in self._chains:
+			self._chains[source] = self._build_filters()
+		return self._chains[source]
 	
-	def write(self,dataset):
+	def write(self,dataset,source=None):
 		"""
-		For each Filter in _filters process dataset and finally _write_dataset it, if 
-		there is something to write. _write_dataset must be subclassed.
+		For each Filter in the filter chain of source process dataset and finally _write_dataset 
+		it, if there is something to write. _write_dataset must be subclassed.
 		"""
-		self.dataset = dataset
-		for filt in self._filters:
+		self.source = source
+		self.dataset = as_record(dataset)
+		for filt in self.get_filters(source):
 			self.dataset = filt.process(self.dataset)
 			logger.debug(f"Filter {filt} stored {self.dataset}.")
 			if not self.dataset:
 				logger.debug(f'Filter {filt} returned without result. Interrupting write process...')
 				return # nothing to do anymore
 		self._write_dataset()
-		
-		def _write_dataset(self):
-			raise NotImplementedError(f'No write process defined for {self}!')
+	
+	def write_filtered(self,dataset,source=None):
+		"Write a dataset, that already passed the filters, e.g. of the broker's pipeline.FilterGraph"
+		self.source = source
+		self.dataset = as_record(dataset)
+		self._write_dataset()
+	
+	def write_batch(self,datasets,source=None):
+		"Like write for a list of datasets, which are handed to the sink at once by _write_batch"
+		self.source = source
+		batch = [as_record(d) for d in datasets]
+		for filt in self.get_filters(source):
+			batch = process_batch(filt, batch)
+			if not batch:
+				return # nothing to do anymore
+		self.write_filtered_batch(batch, source)
+	
+	def write_filtered_batch(self,datasets,source=None):
+		self.source = source
+		self.batch = [as_record(d) for d in datasets]
+		if self.batch:
+			self._write_batch()
+	
+	def _write_dataset(self):
+		raise NotImplementedError(f'No write process defined for {self}!')
+	
+	def _write_batch(self):
+		"Write self.batch. Sinks with a bulk path override this, the default writes one by one."
+		for self.dataset in self.batch:
+			self._write_dataset()
+	
+	def flush(self):
+		"Write buffered data. Writers, which buffer, set flush_interval to be flushed when idle."
+		pass
+	
+	def close(self):
+		self.flush()
 
 ##############################################################################################
 # C S V  W r i t e r 
+# Each schema, e.g. of each reader feeding the writer, has a segment of its own, which stays
+# open and to which rows are buffered. A new segment is started, when it exceeds rotate_size 
+# bytes or the calendar rotate_period of the record timestamps ends. Segments are named 
+# <index>_<filename>, with a rotate_period <period>_<index>_<filename>, the segments of several
+# schemas get different indices. Closed segments are gzipped in background threads.
+CSV_PERIODS = dict(hour='%Y%m%d%H', day='%Y%m%d', month='%Y%m')
+CSV_SYNC = ('buffered','flush','fsync')
+
+def period_bounds(ts, period):
+	"Start and end in msec of the calendar period containing ts"
+	start = datetime.fromtimestamp(ts/1000)
+	if period == 'hour':
+		start = start.replace(minute=0, second=0, microsecond=0)
+		end = start + timedelta(hours=1)
+	elif period == 'day':
+		start = start.replace(hour=0, minute=0, second=0, microsecond=0)
+		end = start + timedelta(days=1)
+	else:
+		start = start.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+		end = (start + timedelta(days=32)).replace(day=1)
+	return start.timestamp()*1000, end.timestamp()*1000
+
+def compress_segment(filename):
+	"gzip filename next to it and remove it"
+	with open(filename,'rb') as src, gzip.open(filename+'.gz.tmp','wb') as dst:
+		shutil.copyfileobj(src, dst)
+	os.replace(filename+'.gz.tmp', filename+'.gz')
+	os.remove(filename)
+	logger.info(f'Compressed {filename}')
+
+class CSVSegment:
+	"The open file and the buffered rows of one schema in a CSVWriter"
+
+	def __init__(self, schema, label, index, filename):
+		self.schema = schema
+		self.label = label
+		self.index = index
+		self.filename = filename
+		self.file = None
+		self.rows = []
+		self.size = path.getsize(filename) if path.exists(filename) else 0
+
+	def close(self):
+		if self.file:
+			try:
+				self.file.close()
+			except OSError:
+				pass
+			self.file = None
+
 class CSVWriter(Writer):
+	"""
+	Rows are written, when flush_rows rows are buffered or flush_time seconds have passed. 
+	With sync "flush" every batch is written at once, with "fsync" it is also forced to disk.
+	"""
 
 	@staticmethod
 	def __check_basedir(pathname):
@@ -45,119 +168,602 @@ class CSVWriter(Writer):
 			if not path.exists(testpath):
 				mkdir(testpath)
 
-	def __init__(self,description,basedir,filename,separator=';',filters=[]):
+	def __init__(self,description,basedir,filename,separator=';',flush_rows=100,flush_time=5.0,sync='buffered',rotate_size=None,rotate_period=None,compress=False,filters=[]):
 		super().__init__(filters = filters)
+		if sync not in CSV_SYNC:
+			raise ValueError(f'Unknown sync "{sync}". Choose one of {CSV_SYNC}')
+		if rotate_period and rotate_period not in CSV_PERIODS:
+			raise ValueError(f'Unknown rotate_period "{rotate_period}". Choose one of {tuple(CSV_PERIODS)}')
 		logger.debug(f"Setting {description} and {filename}...")
 		self.basedir = basedir
 		self.__check_basedir(basedir)
 		self.description = description
 		self.basename = filename
 		self.separator = separator 
-		self.filename = path.join(self.basedir,'1_'+filename)
-		self.index = 1
- 
+		self.flush_rows = flush_rows
+		self.flush_time = flush_time
+		self.sync = sync
+		self.rotate_size = rotate_size
+		self.rotate_period = rotate_period
+		self.compress = compress
+		self.flush_interval = flush_time if sync == 'buffered' else None
+		self._segments = {}	# schema -> CSVSegment
+		self._pending = 0
+		self._period = (None, None)
+		self._last_flush = time.monotonic()
+		self._second = (None, '')	# the formatted second of the last timestamp
+		self._compressors = []
+
+	def _segment_name(self, label, index):
+		prefix = f'{label}_' if label else ''
+		return path.join(self.basedir, f'{prefix}{index}_{self.basename}')
+
+	def _period_label(self, ts):
+		start, end = self._period
+		if start is None or not start <= ts < end:
+			self._period = period_bounds(ts, self.rotate_period)
+			self._period_name = datetime.fromtimestamp(ts/1000).strftime(CSV_PERIODS[self.rotate_period])
+		return self._period_name
+
+	def _start_segment(self, schema, label):
+		"Close the current segment of schema and continue in the next one"
+		old = self._segments.pop(schema, None)
+		rotate = old is not None and label == old.label
+		if old is not None:
+			self._close_segment(old)
+		index = old.index+1 if rotate else 1
+		# segments of earlier runs are continued, if not full and of the same columns, but never overwritten
+		while self._is_taken(self._segment_name(label, index), rotate, self._headings(schema)):
+			index += 1
+		segment = self._segments[schema] = CSVSegment(schema, label, index, self._segment_name(label, index))
+		return segment
+
+	def _is_taken(self, filename, rotate, headings):
+		if path.exists(filename+'.gz') or any(s.filename == filename for s in self._segments.values()):
+			return True
+		if not path.exists(filename):
+			return False
+		if rotate or self._is_full(path.getsize(filename)):
+			return True
+		with open(filename) as f:
+			lines = [f.readline() for i in range(2)]
+		return bool(lines[0]) and lines[1] != headings
+
+	def _is_full(self, size):
+		return bool(self.rotate_size) and size >= self.rotate_size
+
+	def _add(self, record):
+		label = self._period_label(record.timestamp) if self.rotate_period else ''
+		segment = self._segments.get(record.schema)
+		if segment is None or label != segment.label or self._is_full(segment.size):
+			segment = self._start_segment(record.schema, label)
+		row = self.__convert(record)
+		segment.rows.append(row)
+		segment.size += len(row)
+		self._pending += 1
+
 	def _write_dataset(self):
 		"append one frame"
-		if not path.exists(self.filename):
-			with open(self.filename,'w') as f:
-				logger.info(f"Create new file {self.filename}")
-				f.write(f'"{self.description}"'+'\n')
-				f.write(self.__convert(self.dataset,True))
-				f.write(self.__convert(self.dataset))
-		else:
+		self.batch = [self.dataset]
+		self._write_batch()
+
+	def _write_batch(self):
+		"buffer the frames of self.batch"
+		for record in self.batch:
+			self._add(record)
+			if self._pending >= self.flush_rows:
+				self.flush()
+		if self.sync != 'buffered' or time.monotonic() - self._last_flush >= self.flush_time:
+			self.flush()
+
+	def _write_rows(self, segment):
+		if not segment.file:
+			segment.file = open(segment.filename,'a')
+			if not segment.file.tell():
+				logger.info(f"Create new file {segment.filename}")
+				header = f'"{self.description}"'+'\n' + self._headings(segment.schema)
+				segment.file.write(header)
+				segment.size += len(header)
+		segment.file.write(''.join(segment.rows))
+		segment.file.flush()
+		if self.sync == 'fsync':
+			os.fsync(segment.file.fileno())
+		segment.rows = []
+
+	def flush(self):
+		"Write the buffered rows of all segments"
+		try:
+			for segment in self._segments.values():
+				self._flush_segment(segment)
+		finally:
+			self._pending = sum(len(segment.rows) for segment in self._segments.values())
+		self._last_flush = time.monotonic()
+
+	def _flush_segment(self, segment):
+		"If the segment is not accessible, the next one is tried once"
+		if not segment.rows:
+			return
+		try:
+			self._write_rows(segment)
+		except OSError as e:
+			failed = segment.filename
+			segment.close()
+			segment.index += 1
+			while self._is_taken(self._segment_name(segment.label, segment.index), True, None):
+				segment.index += 1
+			segment.filename = self._segment_name(segment.label, segment.index)
+			segment.size = 0
+			logger.error(f'Problem accessing {failed}: {e}. Writing in new file {segment.filename}.')
 			try:
-				with open(self.filename,'a') as f:
-					f.write(self.__convert(self.dataset))
-			except:
-				self.index+=1
-				logger.error(f'Problem accessing {self.filename}. Writing in new file {self.index}_{self.basename}.')
-				self.filename = path.join(self.basedir,f'{self.index}_{self.basename}')
-				self._write_dataset()
-
-	def __convert(self,data_dict,filter_headings=False):
-		if filter_headings:
-			headings = [f'{k} ({v["unit"]})' for k,v in data_dict.items()]
-			return self.separator.join(headings) + "\n"
-		else:
-			data_dict['timestamp']['value'] = datetime.fromtimestamp(data_dict['timestamp']['value']/1000).strftime('%d.%m.%Y %H:%M:%S.%f')
-			datastr = [str(v['value']) for v in data_dict.values()]
-			return self.separator.join(datastr) + "\n"
+				self._write_rows(segment)
+			except OSError:
+				logger.error(f'Discarded {len(segment.rows)} rows')
+				segment.rows = []
+				raise
+
+	def _close_segment(self, segment):
+		self._flush_segment(segment)
+		closed = segment.file is not None
+		segment.close()
+		if closed and self.compress:
+			self._compressors = [t for t in self._compressors if t.is_alive()]
+			t = threading.Thread(target=compress_segment, args=(segment.filename,), name=f'gzip {segment.filename}')
+			t.start()
+			self._compressors.append(t)
+
+	def close(self):
+		"Flush and close the open segments and wait for the compression of closed segments"
+		try:
+			for segment in self._segments.values():
+				self._close_segment(segment)
+		finally:
+			self._segments = {}
+			self._pending = 0
+		for t in self._compressors:
+			t.join()
+
+	def _timestamp(self, ts):
+		"Formatted timestamp, strftime is called once per second only"
+		ts = int(ts)
+		second, formatted = self._second
+		if ts//1000 != second:
+			formatted = datetime.fromtimestamp(ts//1000).strftime('%d.%m.%Y %H:%M:%S')
+			self._second = (ts//1000, formatted)
+		return f'{formatted}.{ts%1000*1000:06d}'
+
+	def _headings(self,schema):
+		return self.separator.join(f'{k} ({u})' for k,u in schema.items()) + "\n"
+
+	def __convert(self,record):
+		datastr = [self._timestamp(record.timestamp)] + ['' if v is None else str(v) for v in record.values[1:]]
+		return self.separator.join(datastr) + "\n"
 			
  
 ##############################################################################################
 # H 5 W r i t e r 
 class H5Writer(Writer):
+	"""
+	Appends the records to the dataset dataset_name of an h5store.H5Store, which keeps the file
+	open and writes whole chunks of chunk_rows rows. dataset_name may contain the placeholders
+	{source} and {schema}, such a writer fed by several readers writes a dataset per reader or
+	schema. Buffered rows are written at the latest after flush_time seconds. compression is 
+	gzip or lzf, swmr lets other processes read the file while it is written.
+	"""
  
-	@staticmethod
-	def __convert(data_dict):
-		if not 'narray' in globals().keys():
-			from numpy import array as narray
-		"Take a json frame and convert to a numpy array"
-		dtype = [(k,float) for k,v in data_dict.items()]
-		vals = tuple([v for v in data_dict.values()])
-		return narray([vals],dtype=dtype)
- 
-	def __init__(self,dataset_name,filename,filters=[]):
+	def __init__(self,dataset_name,filename,chunk_rows=1024,flush_time=5.0,compression=None,compression_opts=None,swmr=False,filters=[]):
 		super().__init__(filters = filters)
+		from h5store import H5Store
 		logger.debug(f"Setting {dataset_name} and {filename}...")
 		self.name = dataset_name
 		self.basename = filename
-		self.filename = '1_'+filename
 		self.index = 1
+		self.filename = self._file_name()
+		self.flush_time = flush_time
+		self.flush_interval = flush_time
+		self._store = H5Store(self.filename, chunk_rows, compression, compression_opts, swmr)
+		self._last_flush = time.monotonic()
+
+	def _file_name(self):
+		directory, name = path.split(self.basename)
+		return path.join(directory, f'{self.index}_{name}')
  
 	def _write_dataset(self):
-		if not 'File' in globals().keys():
-			from h5py import File
 		"append one frame"
-		if not path.exists(self.filename):
-			with File(self.filename,'w') as f:
-				logger.info(f"Create new file {self.filename}")
-				f.create_dataset(self.name,data=self.__convert(self.dataset),maxshape=(None,),chunks=True)
-		else:
+		self.batch = [self.dataset]
+		self._write_batch()
+
+	def _get_table(self, schema):
+		"The table of schema. If the file is not accessible, the next one is tried once."
+		name = self.name.format(source=self.source, schema=schema.name)
+		try:
+			return self._store.table(name, schema.fields, schema.units)
+		except OSError as e:
+			failed = self.filename
+			self.index += 1
+			self.filename = self._file_name()
+			logger.error(f'Problem accessing {failed}: {e}. Writing in new file {self.filename}.')
+			self._store.reopen(self.filename)
 			try:
-				with File(self.filename,'a') as f:
-					h5 = f.get(self.name,False)
-					if not h5:
-						f.create_dataset(self.name,data=self.__convert(self.dataset),maxshape=(None,),chunks=True)
-					else:
-						h5.resize(h5.size+1,axis=0)
-						h5[-1] = self.__convert(self.dataset)
-			except:
-				self.index+=1
-				logger.error(f'Problem accessing {self.filename}. Writing in new file {self.index}_{self.basename}.')
-				self.filename = f'{self.index}_{self.basename}'
-				self._write_dataset()
+				return self._store.table(name, schema.fields, schema.units)
+			except OSError:
+				# stay with the file, the next write tries it again
+				self.index -= 1
+				self.filename = failed
+				self._store.reopen(failed)
+				raise
+
+	def _write_batch(self):
+		"append the frames of self.batch"
+		for schema, records in groupby(self.batch, key=attrgetter('schema')):
+			self._get_table(schema).append(record.values for record in records)
+		if time.monotonic() - self._last_flush >= self.flush_time:
+			self.flush()
+
+	def flush(self):
+		self._store.flush()
+		self._last_flush = time.monotonic()
+
+	def close(self):
+		self._store.close()
+
+
+##############################################################################################
+# H 5 S t o r e W r i t e r 
+class H5StoreWriter(Writer):
+	"""
+	Sends the records to the H5 store server listening on socket_path (see h5server), which
+	writes the data of all logger processes into one file. dataset may contain the placeholder
+	{source} like the mqtt topic, such each sensor gets its own dataset. Each write waits up to
+	timeout seconds for the server to confirm, that the records are stored.
+	"""
+
+	def __init__(self,socket_path='h5store.sock',dataset='{source}',format='msgpack',timeout=10.0,filters=[]):
+		super().__init__(filters = filters)
+		from codec import getCodec
+		self.socket_path = socket_path
+		self.dataset_name = dataset
+		self.timeout = timeout
+		self.dumps, self.loads = getCodec(format)
+		self._socket = None
+		self._declared = {}	# dataset name -> schema declared on the current connection
+
+	def _connect(self):
+		if self._socket is None:
+			import socket
+			self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			self._socket.settimeout(self.timeout)
+			try:
+				self._socket.connect(self.socket_path)
+			except OSError:
+				self._socket.close()
+				self._socket = None
+				raise
+			self._declared = {}
+			logger.info(f'Connected to the H5 store server at {self.socket_path}')
+		return self._socket
+
+	def _frames(self):
+		from h5server import pack_frame
+		name = self.dataset_name.format(source=self.source)
+		frames = []
+		for schema, records in groupby(self.batch, key=attrgetter('schema')):
+			if self._declared.get(name) is not schema:
+				frames.append(pack_frame(self.dumps, ['table', name, list(schema.fields), list(schema.units)]))
+				self._declared[name] = schema
+			frames.append(pack_frame(self.dumps, ['rows', name, [record.values for record in records]]))
+		frames.append(pack_frame(self.dumps, ['sync']))
+		return b''.join(frames)
+
+	def _reply(self, sock):
+		"The answer of the server to sync"
+		from h5server import FRAME
+		size, = FRAME.unpack(self._receive(sock, FRAME.size))
+		return self.loads(self._receive(sock, size))
+
+	def _receive(self, sock, size):
+		data = b''
+		while len(data) < size:
+			chunk = sock.recv(size - len(data))
+			if not chunk:
+				raise ConnectionError('Connection closed by the H5 store server')
+			data += chunk
+		return data
+
+	def _write_dataset(self):
+		self.batch = [self.dataset]
+		self._write_batch()
+
+	def _write_batch(self):
+		"Send self.batch and wait for the server to store it, reconnecting once if the connection was lost"
+		for attempt in (1, 2):
+			try:
+				sock = self._connect()
+				sock.sendall(self._frames())
+				reply = self._reply(sock)
+				break
+			except OSError as e:
+				self.close()
+				if attempt == 2:
+					raise
+				logger.warning(f'Lost connection to the H5 store server: {e}')
+		if reply[0] != 'ok':
+			self.close()	# the server closed the connection, the tables are declared again on the next one
+			raise ValueError(f'H5 store server rejected {self.source}: {reply[-1]}')
+
+	def close(self):
+		if self._socket is not None:
+			self._socket.close()
+			self._socket = None
 
 
 ##############################################################################################
 # M o n g o D B W r i t e r 
 class MongoDBWriter(Writer):
+	"""
+	Writes the records as documents of data_cls, a mongoengine Document class (see model). 
+	Batches are inserted unordered with insert_many on the raw collection, bypassing the 
+	validation of the documents. With bulk, also single records are buffered until bulk_rows 
+	are collected or flush_time seconds have passed. write_concern, e.g. {w: 1, j: false}, 
+	applies to these inserts. A database_url mongomock://... connects to the in memory 
+	stand-in of the package mongomock.
 
-	def __init__(self,database_url,data_cls,filters=[]):
+	If the database can't be reached, the documents stay buffered for the next flush. Documents
+	rejected by the database are counted as errors, the rest of the bulk is inserted.
+	"""
+
+	def __init__(self,database_url,data_cls,bulk=False,bulk_rows=1000,flush_time=5.0,write_concern=None,filters=[]):
 		if not 'connect' in globals().keys():
 			from mongoengine import connect
 		super().__init__(filters = filters)
-		logger.debug(self._filters)
-		connect(host=database_url)
+		if database_url.startswith('mongomock://'):
+			import mongomock
+			connect(host='mongodb://'+database_url[len('mongomock://'):], mongo_client_class=mongomock.MongoClient)
+		else:
+			connect(host=database_url)
 		self._table = data_cls
+		self._fields = {name:field for name,field in data_cls._fields.items() if name != 'id'}
+		self.bulk = bulk
+		self.bulk_rows = bulk_rows
+		self.flush_time = flush_time
+		self.flush_interval = flush_time if bulk else None
+		self.write_concern = write_concern
+		self.metrics = dict(inserted=0, errors=0, write_concern_errors=0, inserts_per_s=0.0)
+		self._collection = None
+		self._buffer = []
+		self._insert_time = 0.0
+		self._last_flush = time.monotonic()
 
 		logger.info(f"Initialized {self}")
 	
+	def _document(self, record):
+		return self._table(**{k:v for k,v in record.items() if k in self._fields})
+	
+	def _raw(self, record):
+		"The record as raw document, converted by the fields of data_cls"
+		return {self._fields[k].db_field:self._fields[k].to_mongo(v) for k,v in record.items() if k in self._fields and v is not None}
+	
+	def _get_collection(self):
+		if self._collection is None:
+			self._collection = self._table._get_collection()
+			if self.write_concern:
+				from pymongo.write_concern import WriteConcern
+				self._collection = self._collection.with_options(write_concern=WriteConcern(**self.write_concern))
+		return self._collection
+	
 	def _write_dataset(self):
-		ds = self._table(**self.dataset)
+		if self.bulk:
+			self.batch = [self.dataset]
+			self._write_batch()
+			return
+		ds = self._document(self.dataset)
 		ds.save()
 		logger.debug(f'Wrote to database: {self.dataset}')
+	
+	def _write_batch(self):
+		self._buffer += [self._raw(record) for record in self.batch]
+		if not self.bulk or len(self._buffer) >= self.bulk_rows or time.monotonic() - self._last_flush >= self.flush_time:
+			self.flush()
+	
+	def _bulk_errors(self, e, total, what):
+		"Count and log the errors of the BulkWriteError e. Returns the indices of the failed operations."
+		errors = e.details.get('writeErrors', [])
+		concern_errors = e.details.get('writeConcernErrors', [])
+		if errors:
+			self.metrics['errors'] += len(errors)
+			logger.error(f'{len(errors)} of {total} {what}: {errors[0]["errmsg"]}')
+		if concern_errors:
+			# the documents are written, but not as durable as asked for
+			self.metrics['write_concern_errors'] += len(concern_errors)
+			logger.error(f'Write concern {self.write_concern} failed: {concern_errors[0]["errmsg"]}')
+		return [error['index'] for error in errors]
+
+	def flush(self):
+		"""
+		One unordered bulk insert of the buffered documents. If it fails for other reasons than
+		the documents, e.g. a lost connection, the documents stay buffered and the error is raised.
+		"""
+		self._last_flush = time.monotonic()
+		if not self._buffer:
+			return
+		from pymongo.errors import BulkWriteError
+		docs = self._buffer	# insert_many sets their _id, such a retry can't insert them twice
+		started = time.perf_counter()
+		try:
+			inserted = len(self._get_collection().insert_many(docs, ordered=False).inserted_ids)
+		except BulkWriteError as e:
+			# unordered, such all documents but the failing ones are inserted
+			inserted = e.details['nInserted']
+			self._bulk_errors(e, len(docs), 'documents were not inserted')
+		self._buffer = []
+		self._insert_time += time.perf_counter() - started
+		self.metrics['inserted'] += inserted
+		self.metrics['inserts_per_s'] = round(self.metrics['inserted']/self._insert_time, 1)
+		logger.debug(f'Wrote {inserted} documents to database')
+	
+	def close(self):
+		self.flush()
+		logger.info(f'{self._table.__name__}: {self.metrics}')
+
+##############################################################################################
+# M o n g o B u c k e t W r i t e r 
+# One document per sensor and time bucket (see model.SensorBucket) instead of one per reading.
+# The readings of a bucket are collected and written by one upsert, which appends them to the
+# value arrays ($push) and updates the statistics ($inc, $min, $max), such dashboards read the
+# summaries instead of the raw values.
+#
+# A document must not exceed 16 MB. A value takes about BSON_VALUE_BYTES in the arrays, such a 
+# bucket takes at most as many readings as fill half of that, or max_readings. The readings
+# stored in a bucket are looked up on the first flush to it, readings beyond the limit are
+# dropped and counted.
+MAX_DOCUMENT_BYTES = 16*1024*1024
+BSON_VALUE_BYTES = 16	# type, array index as key and a double
+
+class MongoBucketWriter(MongoDBWriter):
+	"""
+	bucket is the length of the buckets in seconds, sensor the name of the sensor, which may
+	contain the placeholder {source}. The upserts are buffered like the inserts of a bulk 
+	MongoDBWriter and stay buffered, if the database can't be reached.
+	"""
+
+	def __init__(self,database_url,data_cls=None,bucket=3600,sensor='{source}',max_readings=None,bulk_rows=1000,flush_time=5.0,write_concern=None,filters=[]):
+		if data_cls is None:
+			from model import SensorBucket as data_cls
+		super().__init__(database_url,data_cls,bulk=True,bulk_rows=bulk_rows,flush_time=flush_time,write_concern=write_concern,filters=filters)
+		self.bucket = int(bucket*1000)
+		self.sensor = sensor
+		self.max_readings = max_readings
+		self.metrics.update(upserts=0, dropped=0)
+		self._buckets = {}	# (sensor, start) -> pending readings
+		self._counts = {}	# (sensor, start) -> readings stored
+		self._full = set()	# buckets reported as full
+		self._rows = 0
+
+	def _add(self, sensor, record):
+		ts = int(record.timestamp)
+		start = ts - ts % self.bucket
+		b = self._buckets.get((sensor, start))
+		if b is None:
+			b = self._buckets[(sensor, start)] = dict(timestamps=[], values={}, units={})
+		b['timestamps'].append(ts)
+		for (name, unit), v in zip(list(record.schema.items())[1:], record.values[1:]):
+			b['values'].setdefault(name, []).append(v)
+			b['units'][name] = unit
+		self._rows += 1
+
+	def _load_counts(self, keys):
+		"Look up the readings stored in the buckets keys"
+		if keys:
+			docs = self._get_collection().find({'$or': [{'sensor': sensor, 'start': start} for sensor, start in keys]}, {'sensor': 1, 'start': 1, 'count': 1})
+			found = {(doc['sensor'], doc['start']): doc.get('count', 0) for doc in docs}
+			for key in keys:
+				self._counts[key] = found.get(key, 0)
+
+	def _limit(self, key, b):
+		"Cut the pending readings of bucket key to the free space. Returns the number dropped."
+		limit = self.max_readings or MAX_DOCUMENT_BYTES//2//(BSON_VALUE_BYTES*(1 + len(b['values'])))
+		free = max(0, limit - self._counts[key])
+		dropped = len(b['timestamps']) - free
+		if dropped <= 0:
+			return 0
+		if key not in self._full:
+			self._full.add(key)
+			logger.warning(f'Bucket {key[1]} of {key[0]} is full with {limit} readings, dropping the rest. Choose a shorter bucket.')
+		b['timestamps'] = b['timestamps'][:free]
+		b['values'] = {name: values[:free] for name, values in b['values'].items()}
+		self.metrics['dropped'] += dropped
+		return dropped
+
+	def _update(self, start, b):
+		"The upsert of the pending readings of a bucket"
+		push = {'timestamps': {'$each': b['timestamps']}}
+		push.update({f'values.{name}': {'$each': values} for name,values in b['values'].items()})
+		stats = {}
+		for name, values in b['values'].items():
+			numbers = [v for v in values if isinstance(v, (int, float))]
+			if numbers:
+				stats[name] = dict(sum=sum(numbers), count=len(numbers), min=min(numbers), max=max(numbers))
+		inc = {'count': len(b['timestamps'])}
+		inc.update({f'stats.{name}.{k}': s[k] for name,s in stats.items() for k in ('sum','count')})
+		update = {'$push': push, '$inc': inc, '$setOnInsert': {'end': start + self.bucket},
+			'$set': {f'units.{name}': unit for name,unit in b['units'].items()}}
+		if stats:
+			update['$min'] = {f'stats.{name}.min': s['min'] for name,s in stats.items()}
+			update['$max'] = {f'stats.{name}.max': s['max'] for name,s in stats.items()}
+		return update
+
+	def _write_batch(self):
+		sensor = self.sensor.format(source=self.source)
+		for record in self.batch:
+			self._add(sensor, record)
+		if self._rows >= self.bulk_rows or time.monotonic() - self._last_flush >= self.flush_time:
+			self.flush()
+
+	def flush(self):
+		"""
+		One unordered bulk of upserts, one per pending bucket. If it fails for other reasons than
+		the buckets, e.g. a lost connection, the buckets stay pending and the error is raised.
+		"""
+		self._last_flush = time.monotonic()
+		if not self._buckets:
+			return
+		from pymongo import UpdateOne
+		from pymongo.errors import BulkWriteError
+		self._load_counts([key for key in self._buckets if key not in self._counts])
+		for key, b in list(self._buckets.items()):
+			self._rows -= self._limit(key, b)
+			if not b['timestamps']:
+				del self._buckets[key]
+		buckets = self._buckets
+		keys = list(buckets)
+		ops = [UpdateOne({'sensor': sensor, 'start': start}, self._update(start, buckets[(sensor, start)]), upsert=True) for sensor, start in keys]
+		failed = set()
+		started = time.perf_counter()
+		try:
+			if ops:
+				self._get_collection().bulk_write(ops, ordered=False)
+		except BulkWriteError as e:
+			failed = set(self._bulk_errors(e, len(keys), 'buckets were not updated'))
+		self._buckets, self._rows = {}, 0
+		self._insert_time += time.perf_counter() - started
+		rows = 0
+		for i, key in enumerate(keys):
+			if i not in failed:
+				n = len(buckets[key]['timestamps'])
+				self._counts[key] += n
+				rows += n
+		self.metrics['inserted'] += rows
+		self.metrics['upserts'] += len(keys)
+		self.metrics['inserts_per_s'] = round(self.metrics['inserted']/self._insert_time, 1) if self._insert_time else 0.0
+		latest = max(start for sensor, start in self._counts)
+		self._counts = {key:n for key,n in self._counts.items() if key[1] >= latest - self.bucket}
+		self._full &= set(self._counts)
+		logger.debug(f'Wrote {rows} readings in {len(keys)} buckets to database')
 
 ##############################################################################################
 # M q t t  W r i t e r 
 class MqttWriter(Writer):	
-	def __init__(self,broker_url,client_id,topic, username=None, password=None,filters=[]):
+	"""
+	topic may contain the placeholder {source}, which is replaced by the name of the reader 
+	section the data comes from. Writers with the same broker_url and client_id share one
+	connection.
+	
+	With format msgpack or cbor the messages only carry the packed values, their schema is
+	published retained on <topic>/schema (see codec). scales maps field names to factors 
+	applied before rounding the values to int.
+	"""
+	def __init__(self,broker_url,client_id,topic, username=None, password=None,format='json',scales={},filters=[]):
 		super().__init__(filters = filters)
-		if not 'Mqtt' in globals().keys():
-			from mqtt import Mqtt
+		if not 'getMqtt' in globals().keys():
+			from mqtt import getMqtt
 		self.topic = topic
+		self.format = format
+		self._packer = None
+		self._published = {}	# topic -> id of the schema published on it
+		if format != 'json':
+			from codec import RecordPacker
+			self._packer = RecordPacker(format, scales)
 		logger.info(f'Connecting to broker at {broker_url}')
-		self.broker = Mqtt(broker_url,client_id, username=username, password=password)
+		self.broker = getMqtt(broker_url,client_id, username=username, password=password)
 		@self.broker.on_connect
 		def on_connect(client, userdata, flags, rc):
 			if rc == 0:
@@ -165,14 +771,65 @@ class MqttWriter(Writer):
 			else:
 				logger.error("Failed to connect, return code %d\n", rc)
 		
+	def get_topic(self):
+		return self.topic.format(source=self.source)
+		
+	def _publish_schema(self, topic):
+		"Publish the schema of the current record retained, if it differs from the last one"
+		from codec import schema_topic
+		id, desc, scales = self._packer.describe(self.dataset.schema)
+		if self._published.get(topic) != id:
+			result = self.broker.publish(schema_topic(topic), desc, qos=1, retain=True)
+			if result[0] == 0:
+				self._published[topic] = id
+
+	def _publish(self, topic):
+		if self._packer:
+			self._publish_schema(topic)
+			payload = self._packer.pack(self.dataset)
+		else:
+			payload = json.dumps(self.dataset.as_dict())
+		return self.broker.publish(topic, payload)
+
 	def _write_dataset(self):
-		result = self.broker.publish(self.topic, json.dumps(self.dataset))
+		topic = self.get_topic()
+		result = self._publish(topic)
 		status = result[0]
 		if status == 0:
 			logger.debug(self.dataset)
-			logger.debug(f"Send message to topic {self.topic}")
+			logger.debug(f"Send message to topic {topic}")
 		else:
-			logger.error(f"Failed to send message to topic {self.topic}")
+			logger.error(f"Failed to send message to topic {topic}")
 			logger.error(result)
 
+	def _write_batch(self):
+		"Hand all messages to the client's outgoing queue and report failures once"
+		topic = self.get_topic()
+		failed = 0
+		for self.dataset in self.batch:
+			failed += self._publish(topic)[0] != 0
+		if failed:
+			logger.error(f"Failed to send {failed} of {len(self.batch)} messages to topic {topic}")
+		else:
+			logger.debug(f"Send {len(self.batch)} messages to topic {topic}")
+
+
+
+##############################################################################################
+# S h a r e d M e m o r y W r i t e r 
+class SharedMemoryWriter(Writer):
+	"""
+	Publishes the records to the shared memory ring buffer ring_name, from which other 
+	datalogger processes read with readers.SharedMemoryReader (see shm). The ring buffer is
+	removed, when the writer is closed.
+	"""
+	def __init__(self,ring_name,slots=1024,fields=32,filters=[]):
+		super().__init__(filters = filters)
+		from shm import RingPublisher
+		self._ring = RingPublisher(ring_name, slots=slots, fields=fields)
+		
+	def _write_dataset(self):
+		self._ring.publish(self.dataset, self.source)
 
+	def close(self):
+		self._ring.close()